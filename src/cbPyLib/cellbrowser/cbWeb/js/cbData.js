@@ -268,9 +268,10 @@ function CbDbFile(url) {
     /* load config and gene offsets from URL and call func when done */
 
         var doneCount = 0;
+        var fileCount = 2;
         function gotOneFile() {
             doneCount++;
-            if (doneCount===2)
+            if (doneCount===fileCount)
                 onDone(self.name);
         }
 
@@ -281,11 +282,158 @@ function CbDbFile(url) {
            dsUrl = dsUrl+"?"+Math.floor(Math.random()*100000000);
         else
            dsUrl = dsUrl+"?"+md5;
-        cbUtil.loadJson(dsUrl, function(data) { self.conf = data; gotOneFile();});
+        cbUtil.loadJson(dsUrl, function(data) {
+            self.conf = data;
+            // start loading gene offsets in background, this takes a while
+            // big matrices have a binary index instead of exprMatrix.json, see writeGeneIndex() in cellbrowser.py
+            if (data.geneIndex)
+                loadGeneIndex("exprMatrix.idx", function(idx) { self.geneOffsets = idx; gotOneFile();});
+            else
+                loadGeneIndex("exprMatrix.json", function(idx) { self.geneOffsets = idx; gotOneFile();});
+
+            // the precomputed deciles have their own offsets, see loadDiscretVec
+            if (data.discretMatrix) {
+                fileCount++;
+                var discName = "discretMat.json";
+                if (data.geneIndex)
+                    discName = "discretMat.idx";
+                loadGeneIndex(discName, function(idx) { self.discretOffsets = idx; gotOneFile();});
+            }
+            gotOneFile();
+        });
+    };
+
+    function loadGeneIndex(fname, onDone) {
+    /* load a gene index, a .json file or a binary .idx file, and call onDone with it */
+        var url = cbUtil.joinPaths([self.url, fname]);
+        if (fname.endsWith(".json"))
+            cbUtil.loadJson(url, onDone, true);
+        else
+            cbUtil.loadFile(url, Uint8Array, function(buf) { onDone(new GeneIndex(buf)); });
+    }
+
+    function compareBytes(a, b) {
+    /* compare two Uint8Arrays, return <0, 0 or >0. With the UTF-8 bytes of two strings, this
+     * is the order of Python's sorted() on str.encode("utf8"), which JS's "<" on strings is not */
+        var minLen = Math.min(a.length, b.length);
+        for (var i = 0; i < minLen; i++) {
+            var diff = a[i] - b[i];
+            if (diff!==0)
+                return diff;
+        }
+        return a.length - b.length;
+    }
+
+    function GeneIndex(buf) {
+    /* a binary gene index written by writeGeneIndex() in cellbrowser.py. Genes are found with a binary
+     * search in the sorted names, so nothing has to be parsed when it is loaded */
+        if (buf.byteOffset % 4 !== 0)
+            buf = buf.slice(); // typed array views need aligned offsets
+        var dv = new DataView(buf.buffer, buf.byteOffset, buf.byteLength);
+        var flags = dv.getUint16(6, true);
+        var n = dv.getUint32(8, true);
+        var strSize = dv.getUint32(16, true);
+
+        var pos = buf.byteOffset + 24;
+        var offsets = new Uint32Array(buf.buffer, pos, 2*n); // uint64 as pairs of (low, high)
+        pos += 8*n;
+        var lengths = new Uint32Array(buf.buffer, pos, n);
+        pos += 4*n;
+        var strStarts = new Uint32Array(buf.buffer, pos, n+1);
+        pos += 4*(n+1);
+        var lowerOrder = null; // gene indices, sorted by lowercase name
+        if (flags & 1) {
+            lowerOrder = new Uint32Array(buf.buffer, pos, n);
+            pos += 4*n;
+        }
+        var strData = new Uint8Array(buf.buffer, pos, strSize);
+
+        var decoder = new TextDecoder("utf-8");
+        var encoder = new TextEncoder();
+
+        this.geneCount = n;
+        this.matrixMin = dv.getInt32(12, true);
+
+        function nameAt(i) {
+            return decoder.decode(strData.subarray(strStarts[i], strStarts[i+1]));
+        }
+        this.nameAt = nameAt;
+
+        function compareAt(i, key) {
+            /* compare the bytes of name i with the Uint8Array key, return <0, 0 or >0 */
+            var start = strStarts[i];
+            var len = strStarts[i+1] - start;
+            var minLen = Math.min(len, key.length);
+            for (var j = 0; j < minLen; j++) {
+                var diff = strData[start+j] - key[j];
+                if (diff!==0)
+                    return diff;
+            }
+            return len - key.length;
+        }
+
+        this.getOffset = function(name) {
+            /* return [start, length] of the record of name in the matrix or undefined */
+            var key = encoder.encode(name);
+            var lo = 0;
+            var hi = n-1;
+            while (lo <= hi) {
+                var mid = (lo + hi) >>> 1;
+                var cmp = compareAt(mid, key);
+                if (cmp===0)
+                    return [offsets[2*mid] + offsets[2*mid+1]*4294967296, lengths[mid]];
+                if (cmp < 0)
+                    lo = mid+1;
+                else
+                    hi = mid-1;
+            }
+            return undefined;
+        };
+
+        this.searchPrefix = function(prefix) {
+            /* return the names that start with the lowercase string prefix (case-insensitive) */
+            var names = [];
+            if (lowerOrder===null) {
+                for (let i = 0; i < n; i++) {
+                    let name = nameAt(i);
+                    if (name.toLowerCase().startsWith(prefix))
+                        names.push(name);
+                }
+                return names;
+            }
+
+            // find the first name that is not smaller than the prefix. The names are sorted by the
+            // UTF-8 bytes of their lowercase version, so compare bytes, not strings
+            var key = encoder.encode(prefix);
+            var lo = 0;
+            var hi = n;
+            while (lo < hi) {
+                var mid = (lo + hi) >>> 1;
+                if (compareBytes(encoder.encode(nameAt(lowerOrder[mid]).toLowerCase()), key) < 0)
+                    lo = mid+1;
+                else
+                    hi = mid;
+            }
+            for (let i = lo; i < n; i++) {
+                let name = nameAt(lowerOrder[i]);
+                if (!name.toLowerCase().startsWith(prefix))
+                    break;
+                names.push(name);
+            }
+            return names;
+        };
+    }
 
-        // start loading gene offsets in background, this takes a while
-        var osUrl = cbUtil.joinPaths([this.url, "exprMatrix.json"]);
-        cbUtil.loadJson(osUrl, function(data) { self.geneOffsets = data; gotOneFile();}, true);
+    function findOffset(geneIndex, geneSym) {
+    /* return [start, length] of geneSym in a gene index, from a .json or a binary file, or undefined */
+        if (geneIndex instanceof GeneIndex)
+            return geneIndex.getOffset(geneSym);
+        return geneIndex[geneSym];
+    }
+
+    this.getGeneOffset = function(geneSym) {
+    /* return [start, length] of the expression record of geneSym in exprMatrix.bin or undefined */
+        return findOffset(self.geneOffsets, geneSym);
     };
 
     this.loadCoords = function(coordIdx, onDone, onProgress) {
@@ -619,6 +767,159 @@ function CbDbFile(url) {
         return {"dArr": dArr, "binInfo": binInfo};
     }
 
+    function lz4Decompress(src) {
+    /* decompress an LZ4 block that starts with its uncompressed size as 4 bytes, as
+     * written by python's lz4.block.compress(store_size=True). Returns a Uint8Array. */
+        var outLen = (src[0] | src[1] << 8 | src[2] << 16 | src[3] << 24) >>> 0;
+        var dst = new Uint8Array(outLen);
+        var s = 4;
+        var d = 0;
+        var b;
+        while (s < src.length) {
+            // a sequence: token, literals, then a match, except for the last sequence
+            var token = src[s++];
+            var litLen = token >> 4;
+            if (litLen===15) {
+                do {
+                    b = src[s++];
+                    litLen += b;
+                } while (b===255);
+            }
+            dst.set(src.subarray(s, s+litLen), d);
+            s += litLen;
+            d += litLen;
+            if (s >= src.length)
+                break;
+
+            var offset = src[s] | src[s+1] << 8;
+            s += 2;
+            var matchLen = token & 15;
+            if (matchLen===15) {
+                do {
+                    b = src[s++];
+                    matchLen += b;
+                } while (b===255);
+            }
+            matchLen += 4;
+            // byte by byte, as the match can overlap with the bytes it produces
+            var m = d - offset;
+            for (var i = 0; i < matchLen; i++)
+                dst[d++] = dst[m++];
+        }
+        return dst;
+    }
+
+    function decompressExprRecord(comprData) {
+    /* decompress a record from exprMatrix.bin, see compressRecord() in cellbrowser.py */
+        var codec = self.conf.matrixCodec;
+        if (codec===undefined || codec.startsWith("zlib"))
+            return pako.inflate(comprData);
+        else if (codec==="raw")
+            return comprData;
+        else if (codec==="lz4")
+            return lz4Decompress(comprData);
+        else
+            alert("dataset JSON config file: unknown matrixCodec "+codec);
+    }
+
+    function unfilterArr(buf, start, count, isValues) {
+    /* return an ArrayBuffer with count 4-byte numbers from buf at start, reversing the
+     * matrixFilter, see filterArr() in cellbrowser.py */
+        var filter = self.conf.matrixFilter;
+        if (filter===undefined || filter==="none")
+            return buf.slice(start, start+(4*count)).buffer;
+
+        // shuffled: the first bytes of all numbers, then all second bytes, etc.
+        var out = new Uint8Array(4*count);
+        for (var b = 0; b < 4; b++) {
+            var bytePos = start + b*count;
+            for (var i = 0; i < count; i++)
+                out[4*i+b] = buf[bytePos+i];
+        }
+
+        // delta: only on the values of integer matrices. Int32Array wraps around like the python code.
+        if (filter==="deltaShuffle" && isValues && self.conf.matrixArrType!=="Float32") {
+            var ints = new Int32Array(out.buffer);
+            for (var j = 1; j < count; j++)
+                ints[j] = ints[j-1] + ints[j];
+        }
+        return out.buffer;
+    }
+
+    function readValues(buf, start, count, ArrType) {
+    /* read count values from buf at start, return an array of type ArrType */
+        var quant = self.conf.matrixQuant;
+        if (quant===undefined || quant==="none")
+            return new ArrType(unfilterArr(buf, start, count, true));
+
+        // quantized: value = offset + code*scale, see quantizeArr() in cellbrowser.py
+        var dv = new DataView(buf.buffer, buf.byteOffset+start, 8);
+        var offset = dv.getFloat32(0, true);
+        var scale = dv.getFloat32(4, true);
+        start += 8;
+        var codes;
+        if (quant==="uint8")
+            codes = buf.slice(start, start+count);
+        else
+            codes = new Uint16Array(buf.slice(start, start+(2*count)).buffer);
+
+        var vals = new ArrType(count);
+        var isInt = (self.conf.matrixArrType!=="Float32");
+        for (var i = 0; i < count; i++) {
+            var val = offset + codes[i]*scale;
+            if (isInt)
+                val = Math.round(val);
+            vals[i] = val;
+        }
+        return vals;
+    }
+
+    function decodeExprRecord(buf) {
+    /* given an uncompressed record from exprMatrix.bin, return [exprArr, geneDesc] */
+        // see python code in cellbrowser.py, function 'exprEncode':
+        //# The format of a record is:
+        //# - 2 bytes: length of descStr, e.g. gene identifier or else
+        //# - len(descStr) bytes: the descriptive string descStr
+        //# - array of n 4-byte numbers, n = number of cells
+        //# If the highest bit of the length is set, the array is sparse:
+        //# - 4 bytes: number k of non-zero values
+        //# - array of k 4-byte distances between the cell indices, then array of k 4-byte values
+        //# With matrixQuant, each array of values is a 4-byte offset, a 4-byte scale, and 1 or 2-byte codes
+
+        // read the gene description
+        var descLen = buf[0] | buf[1] << 8;
+        var isSparse = ((descLen & 0x8000) !== 0);
+        descLen = descLen & 0x7fff;
+        var arr = buf.slice(2, 2+descLen);
+        var geneDesc = String.fromCharCode.apply(null, arr);
+
+        // read the expression array
+        var sampleCount = self.conf.sampleCount;
+        var matrixType = self.conf.matrixArrType;
+        if (matrixType===undefined)
+            alert("dataset JSON config file: missing matrixArrType attribute");
+        var ArrType = cbUtil.makeType(matrixType);
+
+        var start = 2+descLen;
+        var exprArr;
+        if (isSparse) {
+            var nzCount = cbUtil.baReadOffset(buf, start);
+            start += 4;
+            var cellDiffs = new Uint32Array(unfilterArr(buf, start, nzCount, false));
+            start += 4*nzCount;
+            var vals = readValues(buf, start, nzCount, ArrType);
+            exprArr = new ArrType(sampleCount);
+            var cellIdx = 0;
+            for (var i = 0; i < nzCount; i++) {
+                cellIdx += cellDiffs[i];
+                exprArr[cellIdx] = vals[i];
+            }
+        } else {
+            exprArr = readValues(buf, start, sampleCount, ArrType);
+        }
+        return [exprArr, geneDesc];
+    }
+
     this.loadExprAndDiscretize = function(geneSym, onDone, onProgress) {
     /* given a geneSym (string), retrieve array of array put into binCount bins
      * and call onDone with (array, discretizedArray, geneSymbol, geneDesc,
@@ -638,9 +939,68 @@ function CbDbFile(url) {
             onDone(exprArr, da.dArr, geneSym, geneDesc, da.binInfo);
         }
 
+        // if cbBuild wrote the deciles, load them together with the values, no need to discretize
+        // the precomputed bin0 is for the zeros, so this is only possible if there are no negative values
+        if (self.discretOffsets && findOffset(self.discretOffsets, geneSym)!==undefined && self.getMatrixMin() >= 0) {
+            var exprArr = null;
+            var disc = null;
+            var gotExpr = function(arr, geneSym, geneDesc) {
+                exprArr = arr;
+                if (disc!==null)
+                    onDone(exprArr, disc.dArr, geneSym, geneDesc, disc.binInfo);
+            };
+            var gotDiscret = function(res) {
+                disc = res;
+                if (exprArr!==null)
+                    onDone(exprArr, disc.dArr, geneSym, disc.geneDesc, disc.binInfo);
+            };
+            this.loadDiscretVec(geneSym, gotDiscret, onProgress);
+            this.loadExprVec(geneSym, gotExpr, onProgress);
+            return;
+        }
+
         this.loadExprVec(geneSym, onLoadedVec, onProgress)
     };
 
+    function decodeDiscretRecord(buf) {
+    /* decode an uncompressed record of discretMat.bin, see discretRecord() in cellbrowser.py.
+     * Returns an object with geneDesc, binInfo, a list of (min, max, count) and dArr, the bin index of every cell */
+        var dv = new DataView(buf.buffer, buf.byteOffset, buf.byteLength);
+        var descLen = dv.getUint16(0, true);
+        var geneDesc = String.fromCharCode.apply(null, buf.slice(2, 2+descLen));
+        var start = 2+descLen;
+        var binCount = buf[start];
+        start += 1;
+
+        var binInfo = [];
+        for (var i = 0; i < binCount; i++) {
+            var minVal = dv.getFloat32(start, true);
+            var maxVal = dv.getFloat32(start+4, true);
+            var count = dv.getFloat32(start+8, true);
+            binInfo.push( [minVal, maxVal, count] );
+            start += 12;
+        }
+
+        var dArr = buf.slice(start);
+        return {"geneDesc":geneDesc, "binInfo":binInfo, "dArr":dArr};
+    }
+
+    this.loadDiscretVec = function(geneSym, onDone, onProgress) {
+    /* given a geneSym (string), retrieve the precomputed bin index of every cell and call onDone with
+     * an object with the keys dArr, binInfo and geneDesc */
+        function onGeneDone(comprData, geneSym) {
+            var buf = decompressExprRecord(comprData);
+            onDone(decodeDiscretRecord(buf));
+        }
+
+        var offsData = findOffset(self.discretOffsets, geneSym);
+        var start = offsData[0];
+        var end = start + offsData[1] - 1; // end pos is inclusive
+
+        var url = cbUtil.joinPaths([self.url, "discretMat.bin"]);
+        cbUtil.loadFile(url+"?"+geneSym, Uint8Array, onGeneDone, onProgress, geneSym, start, end);
+    };
+
     this.loadExprVec = function(geneSym, onDone, onProgress, otherInfo) {
     /* given a geneSym (string), retrieve array of values and call onDone with
      * (array, geneSym, geneDesc) */
@@ -649,33 +1009,12 @@ function CbDbFile(url) {
             self.exprCache[geneSym] = comprData;
 
             console.log("Got expression data, size = "+comprData.length+" bytes");
-            var buf = pako.inflate(comprData);
-
-            // see python code in cbAdd, function 'exprRowEncode':
-            //# The format of a record is:
-            //# - 2 bytes: length of descStr, e.g. gene identifier or else
-            //# - len(descStr) bytes: the descriptive string descStr
-            //# - 132 bytes: 11 deciles, encoded as 11 * 3 floats (=min, max, count)
-            //# - array of n bytes, n = number of cells
-            
-            // read the gene description
-            var descLen = cbUtil.baReadUint16(buf, 0);
-            var arr = buf.slice(2, 2+descLen);
-            var geneDesc = String.fromCharCode.apply(null, arr);
-
-            // read the expression array
-            var sampleCount = self.conf.sampleCount;
-            var matrixType = self.conf.matrixArrType;
-            if (matrixType===undefined)
-                alert("dataset JSON config file: missing matrixArrType attribute");
-            var ArrType = cbUtil.makeType(matrixType);
-            var arrData = buf.slice(2+descLen, 2+descLen+(4*sampleCount));
-            var exprArr = new ArrType(arrData.buffer);
-
-            onDone(exprArr, geneSym, geneDesc, otherInfo);
-        }
-
-        var offsData = self.geneOffsets[geneSym];
+            var buf = decompressExprRecord(comprData);
+            var rec = decodeExprRecord(buf);
+            onDone(rec[0], geneSym, rec[1], otherInfo);
+        }
+
+        var offsData = self.getGeneOffset(geneSym);
         if (offsData===undefined) {
             alert("cbData.js: "+geneSym+" is not in the expression matrix");
             onDone(null);
@@ -728,7 +1067,7 @@ function CbDbFile(url) {
     };
 
     this.getGenes = function() {
-    /* return an object with the geneSymbols */
+    /* return an object with the geneSymbols, for big matrices a GeneIndex, see getGeneOffset */
         return self.geneOffsets;
     };
 
@@ -894,33 +1233,12 @@ function CbDbFile(url) {
             self.exprCache[geneSym] = comprData;
 
             console.log("Got expression data, size = "+comprData.length+" bytes");
-            var buf = pako.inflate(comprData);
-
-            // see python code in cbAdd, function 'exprRowEncode':
-            //# The format of a record is:
-            //# - 2 bytes: length of descStr, e.g. gene identifier or else
-            //# - len(descStr) bytes: the descriptive string descStr
-            //# - 132 bytes: 11 deciles, encoded as 11 * 3 floats (=min, max, count)
-            //# - array of n bytes, n = number of cells
-            
-            // read the gene description
-            var descLen = cbUtil.baReadUint16(buf, 0);
-            var arr = buf.slice(2, 2+descLen);
-            var geneDesc = String.fromCharCode.apply(null, arr);
-
-            // read the expression array
-            var sampleCount = self.conf.sampleCount;
-            var matrixType = self.conf.matrixArrType;
-            if (matrixType===undefined)
-                alert("dataset JSON config file: missing matrixArrType attribute");
-            var ArrType = cbUtil.makeType(matrixType);
-            var arrData = buf.slice(2+descLen, 2+descLen+(4*sampleCount));
-            var exprArr = new ArrType(arrData.buffer);
-
-            onDone(exprArr, geneSym, geneDesc, otherInfo);
-        }
-
-        var offsData = self.geneOffsets[geneSym];
+            var buf = decompressExprRecord(comprData);
+            var rec = decodeExprRecord(buf);
+            onDone(rec[0], geneSym, rec[1], otherInfo);
+        }
+
+        var offsData = self.getGeneOffset(geneSym);
         if (offsData===undefined) {
             alert("cbData.js: "+geneSym+" is not in the expression matrix");
             onDone(null);
@@ -940,6 +1258,174 @@ function CbDbFile(url) {
                 start, end);
     };
 
+    this.loadCellExpr = function(cellIdx, onDone, onProgress) {
+    /* call onDone with the non-zero expression values of a cell, as an array of [geneSym, value].
+     * Requires cellMatrix.bin, written by cbBuild with cellMatrix=True, see CellMatrixWriter in
+     * cellbrowser.py. Needs one range request per cell, after the block index has been loaded. */
+        function onBlockDone(comprData) {
+            var buf = decompressExprRecord(comprData);
+            var dv = new DataView(buf.buffer, buf.byteOffset, buf.byteLength);
+            var index = self.cellMatrix;
+            var cellCount = dv.getUint32(0, true);
+            var valCount = dv.getUint32(4, true);
+            var localIdx = cellIdx % index.blockSize;
+            var start = dv.getUint32(8+4*localIdx, true);
+            var end = dv.getUint32(8+4*(localIdx+1), true);
+            var geneStart = 8+4*(cellCount+1);
+            var valStart = geneStart+4*valCount;
+            var isFloat = (index.arrType==="Float32");
+
+            var cellExpr = [];
+            for (var i = start; i < end; i++) {
+                var geneIdx = dv.getUint32(geneStart+4*i, true);
+                var val;
+                if (isFloat)
+                    val = dv.getFloat32(valStart+4*i, true);
+                else
+                    val = dv.getUint32(valStart+4*i, true);
+                cellExpr.push([index.genes[geneIdx], val]);
+            }
+            onDone(cellExpr);
+        }
+
+        function onIndexDone() {
+            var block = self.cellMatrix.blocks[Math.floor(cellIdx / self.cellMatrix.blockSize)];
+            var url = cbUtil.joinPaths([self.url, "cellMatrix.bin"]);
+            cbUtil.loadFile(url, Uint8Array, onBlockDone, onProgress, undefined,
+                block[0], block[0]+block[1]-1);
+        }
+
+        if (self.conf.cellMatrixIndex===undefined) {
+            alert("cbData.js: this dataset has no cell-major matrix, set cellMatrix=True in cellbrowser.conf");
+            onDone(null);
+            return;
+        }
+
+        if (self.cellMatrix)
+            onIndexDone();
+        else {
+            var url = cbUtil.joinPaths([self.url, self.conf.cellMatrixIndex]);
+            cbUtil.loadJson(url, function(data) {
+                self.cellMatrix = data;
+                onIndexDone();
+            });
+        }
+    };
+
+    this.loadClusterAggr = function(geneSym, onDone, onProgress) {
+    /* call onDone with the aggregated expression of a gene per cluster, an object with the keys
+     * "clusters", "cellCounts" and one Float32Array per value in "stats", e.g. "mean", "nonZero",
+     * "p50", with one number per cluster. Requires clusterAggr.bin, written by cbBuild with
+     * clusterAggr=True, see clusterAggrRecords() in cellbrowser.py. */
+        function onRecordDone(buf) {
+            var index = self.clusterAggr;
+            var clusterCount = index.clusters.length;
+            if (buf.byteOffset % 4 !== 0)
+                buf = buf.slice(); // Float32Array views need aligned offsets
+            var vals = new Float32Array(buf.buffer, buf.byteOffset, index.stats.length*clusterCount);
+            var geneAggr = {"clusters" : index.clusters, "cellCounts" : index.cellCounts};
+            for (var i = 0; i < index.stats.length; i++)
+                geneAggr[index.stats[i]] = vals.subarray(i*clusterCount, (i+1)*clusterCount);
+            onDone(geneAggr);
+        }
+
+        function onIndexDone() {
+            var index = self.clusterAggr;
+            var geneIdx = index.geneToIdx[geneSym];
+            if (geneIdx===undefined) {
+                onDone(null);
+                return;
+            }
+            // all records have the same size
+            var recSize = 4*index.stats.length*index.clusters.length;
+            var url = cbUtil.joinPaths([self.url, "clusterAggr.bin"]);
+            cbUtil.loadFile(url+"?"+geneSym, Uint8Array, onRecordDone, onProgress, undefined,
+                geneIdx*recSize, (geneIdx+1)*recSize-1);
+        }
+
+        if (self.conf.clusterAggrIndex===undefined) {
+            alert("cbData.js: this dataset has no cluster aggregates, set clusterAggr=True in cellbrowser.conf");
+            onDone(null);
+            return;
+        }
+
+        if (self.clusterAggr)
+            onIndexDone();
+        else {
+            var url = cbUtil.joinPaths([self.url, self.conf.clusterAggrIndex]);
+            cbUtil.loadJson(url, function(data) {
+                data.geneToIdx = {};
+                for (var i = 0; i < data.genes.length; i++)
+                    data.geneToIdx[data.genes[i]] = i;
+                self.clusterAggr = data;
+                onIndexDone();
+            });
+        }
+    };
+
+    this.loadCoordTiles = function(coordIdx, onDone) {
+    /* call onDone with the tile index of a layout: an object with "levels", "gridSize", "cellCount",
+     * the byte offsets and "tiles", which maps "z/x/y" to [firstCell, cellCount, gridOffset, gridLength].
+     * Requires tiles.bin, written by cbBuild with coordTiles=True, see writeCoordTiles() in cellbrowser.py. */
+        var coordInfo = self.conf.coords[coordIdx];
+        if (coordInfo.tiles===undefined) {
+            alert("cbData.js: this layout has no tiles, set coordTiles=True in cellbrowser.conf");
+            onDone(null);
+            return;
+        }
+        if (self.coordTiles===undefined)
+            self.coordTiles = {};
+        if (self.coordTiles[coordIdx]) {
+            onDone(self.coordTiles[coordIdx]);
+            return;
+        }
+        var url = cbUtil.joinPaths([self.url, "coords", coordInfo.name, "tiles.json"]);
+        cbUtil.loadJson(url+"?"+coordInfo.tiles.jsonMd5, function(data) {
+            self.coordTiles[coordIdx] = data;
+            onDone(data);
+        });
+    };
+
+    this.loadCoordTile = function(coordIdx, tileKey, withCells, onDone, onProgress) {
+    /* call onDone with one tile "z/x/y" of a layout: an object with "grid", a Uint32Array with
+     * gridSize*gridSize cell counts, row by row. If withCells is true, also "cellIdx", a Uint32Array with
+     * the indices of the cells in the tile and "coords", a Uint16Array with their x,y coordinates.
+     * Calls onDone(null) if the tile has no cells. */
+        var coordInfo = self.conf.coords[coordIdx];
+        var binUrl = cbUtil.joinPaths([self.url, "coords", coordInfo.name, "tiles.bin"])+"?"+coordInfo.tiles.md5;
+        var tile = {};
+
+        function onPartDone() {
+            if (tile.grid===undefined || (withCells && (tile.cellIdx===undefined || tile.coords===undefined)))
+                return;
+            onDone(tile);
+        }
+
+        self.loadCoordTiles(coordIdx, function(index) {
+            var tileInfo = index.tiles[tileKey];
+            if (tileInfo===undefined) {
+                onDone(null);
+                return;
+            }
+            var first = tileInfo[0];
+            var count = tileInfo[1];
+            cbUtil.loadFile(binUrl, Uint8Array, function(buf) {
+                tile.grid = new Uint32Array(pako.inflate(buf).buffer);
+                onPartDone();
+            }, onProgress, undefined, tileInfo[2], tileInfo[2]+tileInfo[3]-1);
+            if (withCells) {
+                cbUtil.loadFile(binUrl, Uint32Array, function(arr) {
+                    tile.cellIdx = arr;
+                    onPartDone();
+                }, onProgress, undefined, index.cellIdxOffset+4*first, index.cellIdxOffset+4*(first+count)-1);
+                cbUtil.loadFile(binUrl, Uint16Array, function(arr) {
+                    tile.coords = arr;
+                    onPartDone();
+                }, onProgress, undefined, index.coordOffset+4*first, index.coordOffset+4*(first+count)-1);
+            }
+        });
+    };
+
     this.loadClusterMarkers = function(markerIndex, clusterName, onDone, onProgress) {
     /* given the name of a cluster, return an array of rows with the cluster-specific genes */
         var url = cbUtil.joinPaths([self.url, "markers", "markers_"+markerIndex, clusterName.replace("/", "_")+".tsv"]);
@@ -964,13 +1450,182 @@ function CbDbFile(url) {
                 return metaInfo;
     }
 
+    function loadGeneSearchDir(onDone) {
+    /* load the header and the page directory of the gene search index, see writeGeneSearch() in cellbrowser.py */
+        if (self.geneSearch) {
+            onDone(self.geneSearch);
+            return;
+        }
+
+        var info = self.conf.geneSearch;
+        var url = cbUtil.joinPaths([self.url, info.fname]);
+        cbUtil.loadFile(url, Uint8Array, function(buf) {
+            var dv = new DataView(buf.buffer, buf.byteOffset, buf.byteLength);
+            var pageCount = dv.getUint32(16, true);
+            var dirSize = dv.getUint32(20, true);
+            var gs = {"url" : url};
+            gs.flags = dv.getUint16(6, true);
+            gs.pagesSize = dv.getUint32(24, true);
+            gs.triSize = dv.getUint32(28, true);
+            gs.pageOffset = 32 + dirSize;
+            gs.pageStarts = [];
+            for (var i = 0; i <= pageCount; i++)
+                gs.pageStarts.push(dv.getUint32(32+4*i, true));
+            var keyText = new TextDecoder("utf-8").decode(buf.subarray(32+4*(pageCount+1), 32+dirSize));
+            gs.firstKeys = keyText.replace(/\n+$/, "").split("\n");
+            // the keys are sorted by their UTF-8 bytes, see compareBytes()
+            var encoder = new TextEncoder();
+            gs.firstKeyBytes = gs.firstKeys.map(function(key) { return encoder.encode(key); });
+            self.geneSearch = gs;
+            onDone(gs);
+        }, undefined, undefined, 0, info.dirSize-1);
+    }
+
+    function searchGeneTrigrams(gs, query, onDone) {
+    /* call onDone with the genes that contain query, using the trigram section of the gene search
+     * index. It is loaded completely when it is needed for the first time. */
+        function onTrigramsDone(buf) {
+            if (buf.byteOffset % 4 !== 0)
+                buf = buf.slice(); // typed array views need aligned offsets
+            var dv = new DataView(buf.buffer, buf.byteOffset, buf.byteLength);
+            var triCount = dv.getUint32(0, true);
+            var postCount = dv.getUint32(4, true);
+            var triTextSize = dv.getUint32(8, true);
+            var recTextSize = dv.getUint32(12, true);
+            var pos = 16;
+            var tri = {};
+            tri.starts = new Uint32Array(buf.buffer, buf.byteOffset+pos, triCount+1);
+            pos += 4*(triCount+1);
+            tri.postings = new Uint32Array(buf.buffer, buf.byteOffset+pos, postCount);
+            pos += 4*postCount;
+            var decoder = new TextDecoder("utf-8");
+            var triNames = decoder.decode(buf.subarray(pos, pos+triTextSize)).split("\n");
+            pos += triTextSize;
+            tri.recNames = decoder.decode(buf.subarray(pos, pos+recTextSize)).split("\n");
+            tri.triIdx = {};
+            for (var i = 0; i < triNames.length; i++)
+                tri.triIdx[triNames[i]] = i;
+            gs.tri = tri;
+            searchTrigrams();
+        }
+
+        function searchTrigrams() {
+            var tri = gs.tri;
+            var recCounts = {};
+            var triCount = 0;
+            for (var i = 0; i+3 <= query.length; i++) {
+                var triName = query.substring(i, i+3);
+                if (triName in recCounts) // count every trigram only once
+                    continue;
+                recCounts[triName] = true;
+                triCount++;
+            }
+
+            // the genes that are in the postings of all trigrams of the query
+            var hits = {};
+            for (let triName in recCounts) {
+                var idx = tri.triIdx[triName];
+                if (idx===undefined) {
+                    onDone([]);
+                    return;
+                }
+                for (var j = tri.starts[idx]; j < tri.starts[idx+1]; j++) {
+                    var recIdx = tri.postings[j];
+                    hits[recIdx] = (hits[recIdx] || 0) + 1;
+                }
+            }
+
+            var geneList = [];
+            for (let recIdx in hits) {
+                if (hits[recIdx]!==triCount)
+                    continue;
+                var parts = tri.recNames[recIdx].split("\t");
+                var sym = parts[0];
+                var geneId = parts[1];
+                if (sym.toLowerCase().indexOf(query)!==-1)
+                    geneList.push({"id":sym, "text":sym});
+                else if (geneId.toLowerCase().indexOf(query)!==-1)
+                    geneList.push({"id":sym, "text":sym+" ("+geneId+")"});
+                if (geneList.length===100)
+                    break;
+            }
+            onDone(geneList);
+        }
+
+        if (gs.tri)
+            searchTrigrams();
+        else {
+            var start = gs.pageOffset + gs.pagesSize;
+            cbUtil.loadFile(gs.url, Uint8Array, onTrigramsDone, undefined, undefined, start, start+gs.triSize-1);
+        }
+    }
+
+    function searchGeneIndex(query, onDone) {
+    /* call onDone with the genes whose symbol or ID start with query, using the gene search index.
+     * Needs a single range request for the pages that can contain the query. */
+        loadGeneSearchDir(function(gs) {
+            // the query can only start on the last page with a smaller first key and continue on the next pages
+            var pageCount = gs.firstKeys.length;
+            var queryBytes = new TextEncoder().encode(query);
+            var lo = 0;
+            var hi = pageCount;
+            while (lo < hi) {
+                var mid = (lo + hi) >>> 1;
+                if (compareBytes(gs.firstKeyBytes[mid], queryBytes) < 0)
+                    lo = mid+1;
+                else
+                    hi = mid;
+            }
+            var startPage = Math.max(0, lo-1);
+            var endPage = startPage+1;
+            // short queries can match many pages, do not load more than 64kb
+            while (endPage < pageCount && gs.firstKeys[endPage].startsWith(query) && endPage-startPage < 16)
+                endPage++;
+
+            var start = gs.pageOffset + gs.pageStarts[startPage];
+            var end = gs.pageOffset + gs.pageStarts[endPage] - 1;
+            cbUtil.loadFile(gs.url, Uint8Array, function(buf) {
+                var lines = new TextDecoder("utf-8").decode(buf).split("\n");
+                var geneList = [];
+                var doneSyms = {};
+                for (var line of lines) {
+                    var parts = line.split("\t");
+                    var key = parts[0];
+                    var sym = parts[1];
+                    if (line==="" || !key.startsWith(query) || sym in doneSyms)
+                        continue;
+                    doneSyms[sym] = true;
+                    if (key===sym.toLowerCase())
+                        geneList.push({"id":sym, "text":sym});
+                    else
+                        geneList.push({"id":sym, "text":sym+" ("+parts[2]+")"});
+                }
+
+                if (geneList.length===0 && (gs.flags & 1) && query.length >= 3)
+                    searchGeneTrigrams(gs, query, onDone);
+                else
+                    onDone(geneList);
+            }, undefined, undefined, start, end);
+        });
+    }
+
     this.searchGenes = function(prefix, onDone) {
     /* call onDone with an array of gene symbols that start with prefix (case-ins.)
      * returns an array of objects with .id and .text attributes  */
+        if (self.conf.geneSearch) {
+            searchGeneIndex(prefix, onDone);
+            return;
+        }
+
         var geneList = [];
-        for (var geneSym in self.geneOffsets) {
-            if (geneSym.toLowerCase().startsWith(prefix))
+        if (self.geneOffsets instanceof GeneIndex) {
+            for (let geneSym of self.geneOffsets.searchPrefix(prefix))
                 geneList.push({"id":geneSym, "text":geneSym});
+        } else {
+            for (var geneSym in self.geneOffsets) {
+                if (geneSym.toLowerCase().startsWith(prefix))
+                    geneList.push({"id":geneSym, "text":geneSym});
+            }
         }
         onDone(geneList);
     };
@@ -1004,6 +1659,8 @@ function CbDbFile(url) {
     this.getMatrixMin = function() {
         /* return the minimum valu in the matrix */
        var validGenes = self.getGenes();
+       if (validGenes instanceof GeneIndex)
+           return validGenes.matrixMin;
        var matrixMin = 0;
        if ("_range" in validGenes)
            matrixMin = validGenes["_range"][0];
@@ -1012,13 +1669,11 @@ function CbDbFile(url) {
 
     this.preloadGenes = function(geneSyms, onDone, onProgress) {
        /* start loading the gene expression vectors in the background. call onDone when done. */
-       var validGenes = self.getGenes();
-
        var loadCounter = 0;
        if (geneSyms) {
            for (var i=0; i<geneSyms.length; i++) {
                var sym = geneSyms[i][0];
-               if (! (sym in validGenes)) {
+               if (self.getGeneOffset(sym)===undefined) {
                   alert("Error: "+sym+" is in quick genes list but is not a valid gene");
                   continue;
                }
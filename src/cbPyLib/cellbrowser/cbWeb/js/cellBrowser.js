@@ -3761,7 +3761,7 @@ var cellbrowser = function() {
             if (((i % colsPerRow) === 0) && (i!==0)) {
                 htmls.push("</tr><tr>");
             }
-            if (geneId in db.geneOffsets)
+            if (db.getGeneOffset(geneId)!==undefined)
                 htmls.push('<td title="'+geneDesc+'" id="tpGeneBarCell_'+onlyAlphaNum(geneId)+'" class="tpGeneBarCell">'+geneId+'</td>');
             i++;
         }
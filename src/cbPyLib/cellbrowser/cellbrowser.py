@@ -14,7 +14,7 @@ import logging, sys, optparse, struct, json, os, string, shutil, gzip, re, unico
 import zlib, math, operator, doctest, copy, bisect, array, glob, io, time, subprocess
 import hashlib, timeit, datetime, keyword, itertools
 from distutils import spawn
-from collections import namedtuple, OrderedDict
+from collections import namedtuple, OrderedDict, Counter
 from os.path import join, basename, dirname, isfile, isdir, relpath, abspath, getsize, getmtime, expanduser
 from time import gmtime, strftime
 import csv
@@ -433,6 +433,12 @@ def cbBuild_parseArgs(showHelp=False):
     parser.add_option("", "--redo", dest="redo", action="store", default="meta",
             help="do not use cached old data. Can be: 'meta' or 'matrix' (matrix includes meta).")
 
+    parser.add_option("", "--workers", dest="workers", action="store", type="int",
+            help="number of processes to use for the slow steps, e.g. compressing the expression matrix or converting the meta data fields and coordinate layouts. 0 means: use all CPUs. Overrides the setting 'workers' in cellbrowser.conf. Default is 1.")
+
+    parser.add_option("", "--tmpDir", dest="tmpDir", action="store",
+            help="directory for big temporary files, e.g. when converting .mtx matrices. Overrides the setting 'tmpDir' in cellbrowser.conf. Default is the system's temporary directory, usually /tmp.")
+
     (options, args) = parser.parse_args()
 
     if showHelp:
@@ -696,6 +702,11 @@ def parseOneColumn(fname, colName):
         vals.append(row[colIdx])
     return vals
 
+def parseCellColumn(fname, colName):
+    " return a dict with the first column of a tsv as keys and the values of the column colName "
+    cellNames = parseOneColumn(fname, nextEl(textFileRows(fname))[0].split("|")[0])
+    return dict(zip(cellNames, parseOneColumn(fname, colName)))
+
 def parseIntoColumns(fname):
     " parse tab sep file vertically, return as a list of (headerName, list of values) "
     ifh = open(fname)
@@ -972,10 +983,11 @@ def typeForStrings(strings):
     return "int"
 
 emptyVals = ["", "null", "none", "None", "unknown", "nd", "n.d.", "Unknown", "NaN", "NA", "undefined", "Na"]
+emptyValSet = set(emptyVals)
 
 def likeEmptyString(val):
     " returns true if string is a well-known synonym of 'unknown' or 'NaN'. ported from cellbrowser.js "
-    return val.strip() in emptyVals
+    return val.strip() in emptyValSet
 
 #def floatToIntList(vals):
 #    " convert a list of floats to integers, take care of -inf values "
@@ -1003,6 +1015,35 @@ def itemsInOrder(valDict, keyOrder):
 
     return ret
 
+def parseNumColumn(valList, valCounts):
+    """ given a list of strings and a dict with the count of each of them, return ('int', numbers)
+    if all values that are not empty (see likeEmptyString) are integers, ('float', numbers) if they
+    are all numbers and ('string', None) otherwise. numbers is a list of floats, with FLOATNAN
+    for empty values. Every distinct value is parsed only once, with int() and float() like in
+    the Python code, so the result does not depend on the number of cells. """
+    valToNum = {}
+    isInt = True
+    for val in valCounts:
+        if val.strip() in emptyValSet:
+            valToNum[val] = FLOATNAN
+            continue
+        if isInt:
+            try:
+                valToNum[val] = float(int(val))
+                continue
+            except ValueError:
+                isInt = False
+        try:
+            valToNum[val] = float(val)
+        except ValueError:
+            return "string", None
+
+    if isInt:
+        numType = "int"
+    else:
+        numType = "float"
+    return numType, list(map(valToNum.__getitem__, valList))
+
 def guessFieldMeta(valList, fieldMeta, colors, forceType, enumOrder):
     """ given a list of strings, determine if they're all int, float or
     strings. Return fieldMeta, as dict, and a new valList, with the correct python type
@@ -1012,50 +1053,26 @@ def guessFieldMeta(valList, fieldMeta, colors, forceType, enumOrder):
     - if enum: 'values' is a list of all possible values
     - if colors is not None: 'colors' is a list of the default colors
     """
-    unknownCount = 0
-    intCount = 0
-    floatCount = 0
-    valCounts = defaultdict(int)
-    newVals = []
-    for val in valList:
-        fieldType = "string"
-        newVal = val
-
-        if likeEmptyString(val):
-            unknownCount += 1
-            newVal = FLOATNAN
-        else:
-            try:
-                newVal = int(val)
-                intCount += 1
-                floatCount += 1
-            except:
-                try:
-                    newVal = float(val)
-                    floatCount += 1
-                except:
-                    pass
-
-        newVals.append(newVal)
-        valCounts[val] += 1
+    valCounts = Counter(valList)
+    if forceType:
+        numType, newVals = "string", None
+    else:
+        numType, newVals = parseNumColumn(valList, valCounts)
 
     valToInt = None
-    assert(len(newVals)==len(valList))
 
     if len(valCounts)==1:
         logging.warn("Field %s contains only a single value" % fieldMeta["name"])
 
 
-    if intCount+unknownCount==len(valList) and not forceType:
+    if numType=="int":
         # JS supports only 32bit signed ints so we store integers as floats
-        newVals = [float(x) for x in newVals]
         fieldMeta["arrType"] = "float32"
         fieldMeta["_fmt"] = "<f"
         fieldMeta["type"] = "int"
 
-    elif floatCount+unknownCount==len(valList) and not forceType:
+    elif numType=="float":
         # field is a floating point number: convert to decile index
-        newVals = [float(x) for x in newVals]
         #newVals, fieldMeta = discretizeNumField(numVals, fieldMeta, "float")
         fieldMeta["arrType"] = "float32"
         fieldMeta["_fmt"] = "<f"
@@ -1064,7 +1081,7 @@ def guessFieldMeta(valList, fieldMeta, colors, forceType, enumOrder):
     elif (len(valCounts)==len(valList) and not forceType) or forceType=="unique":
         # field is a unique string
         fieldMeta["type"] = "uniqueString"
-        maxLen = max([len(x) for x in valList])
+        maxLen = max(map(len, valList))
         fieldMeta["maxSize"] = maxLen
         fieldMeta["_fmt"] = "%ds" % (maxLen+1)
         newVals = valList
@@ -1142,6 +1159,48 @@ def runGzip(fname, finalFname=None):
         os.remove(fname)
     return finalFname
 
+class GzipPipeWriter:
+    """ a file-like object that writes text to a .gz file. The text goes through a pipe
+    to a gzip process, so the compression runs in parallel to the python code.
+    The file is written to fname.tmp and renamed when closed. """
+    def __init__(self, fname):
+        self.fname = fname
+        self.tmpFname = fname+".tmp"
+        self.outFh = open(self.tmpFname, "wb")
+        if isPy3:
+            self.proc = subprocess.Popen(["gzip", "-c"], stdin=subprocess.PIPE, stdout=self.outFh,
+                    bufsize=1024*1024, encoding="utf8")
+        else:
+            self.proc = subprocess.Popen(["gzip", "-c"], stdin=subprocess.PIPE, stdout=self.outFh,
+                    bufsize=1024*1024)
+        self.ifh = self.proc.stdin
+
+    def write(self, text):
+        self.ifh.write(text)
+
+    def close(self):
+        " wait for gzip to finish and move the file to its final name "
+        self.ifh.close()
+        ret = self.proc.wait()
+        self.outFh.close()
+        if ret!=0:
+            errAbort("Could not compress %s, gzip returned error %d" % (self.fname, ret))
+        if isfile(self.fname):
+            os.remove(self.fname)
+        os.rename(self.tmpFname, self.fname)
+
+    def abort(self):
+        " stop gzip and remove the incomplete file "
+        self.proc.kill()
+        try:
+            self.ifh.close()
+        except (IOError, OSError):
+            pass # the pipe is broken, as gzip is gone
+        self.proc.wait()
+        self.outFh.close()
+        if isfile(self.tmpFname):
+            os.remove(self.tmpFname)
+
 def addLongLabels(acronyms, fieldMeta):
     """ add a 'longLabel' meta info entry, a list of longer strings for enum fields, if any shortLabels have a longLabel 
     in the acronyms dict of shortLabel = longLabel """
@@ -1177,14 +1236,140 @@ def addDesc(fieldDescs, fieldMeta):
         fieldMeta["desc"] = desc
     return fieldMeta
 
-def metaToBin(inConf, outConf, fname, colorFname, outDir, enumFields):
+def metaFieldData(fieldMeta, col, binVals):
+    """ return the content of the .bin file of a meta field as bytes: unique strings as-is, one
+    per line, everything else as binVals packed with fieldMeta['_fmt'], all in one go """
+    if fieldMeta["type"]=="uniqueString":
+        return "".join(["%s\n" % x for x in col]).encode("utf8")
+
+    packFmt = fieldMeta["_fmt"]
+    if numpyLoaded:
+        return np.asarray(binVals, dtype=np.dtype(packFmt)).tobytes()
+    else:
+        return struct.pack("%s%d%s" % (packFmt[0], len(binVals), packFmt[1:]), *binVals)
+
+def writeGzipMd5(data, fname):
+    """ gzip the bytes data in-process to fname and return the md5 of the compressed file, from the
+    same bytes that are written. The gzip header has no file name or time, so the same data always
+    gives the same file and md5. """
+    comprFh = io.BytesIO()
+    with gzip.GzipFile(filename="", mode="wb", fileobj=comprFh, compresslevel=6, mtime=0) as gzFh:
+        gzFh.write(data)
+    comprData = comprFh.getvalue()
+
+    tmpFname = fname+".tmp"
+    with open(tmpFname, "wb") as ofh:
+        ofh.write(comprData)
+    os.rename(tmpFname, fname)
+    return hashlib.md5(comprData).hexdigest()
+
+class LogCollector(logging.Handler):
+    " a logging handler that keeps the records in a list, so they can be emitted later "
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        # the message is formatted now, so the record can be pickled and sent to another process
+        record.msg = record.getMessage()
+        record.args = None
+        record.exc_info = None
+        self.records.append(record)
+
+def runWithLogCollector(args):
+    """ args is (func, funcArgs, logLevel). Run func(funcArgs), usually in a worker process, and
+    return (result, log records). result is None if func stopped with errAbort. The log messages
+    are collected and not written, so they can be written later in the order of the inputs. """
+    func, funcArgs, logLevel = args
+
+    rootLogger = logging.getLogger()
+    oldHandlers, oldLevel = rootLogger.handlers, rootLogger.level
+    collector = LogCollector()
+    rootLogger.handlers = [collector]
+    rootLogger.setLevel(logLevel)
+    try:
+        result = func(funcArgs)
+    except SystemExit:
+        # errAbort has logged the reason
+        result = None
+    finally:
+        rootLogger.handlers = oldHandlers
+        rootLogger.setLevel(oldLevel)
+
+    return result, collector.records
+
+def metaFieldToBin(args):
+    """ convert one column of the meta table to a .bin.gz file and return its fieldMeta.
+    Runs in a worker process, see runWithLogCollector. """
+    colIdx, fieldName, col, colors, acronyms, metaDescs, enumOrderFname, sanEnumFields, metaOpt, outDir = args
+
+    enumOrderList = None
+    if enumOrderFname is not None:
+        enumOrderList = open(enumOrderFname).read().splitlines()
+
+    logging.debug("Meta data field index %d: '%s'" % (colIdx, fieldName))
+
+    forceType = None
+    if (fieldName in sanEnumFields):
+        forceType = "enum"
+
+    # very dumb heuristic to recognize fields that should not be treated as numbers but as enums
+    # res.0.6 is the default field name for Seurat clustering. Field header sanitizing changes it to
+    # res_0_6 which is not optimal, but namedtuple doesn't allow dots in names
+    if "luster" in fieldName or "ouvain" in fieldName or (fieldName.startswith("res_") and "_" in fieldName):
+        forceType="enum"
+
+    if colIdx==0:
+        forceType = "unique"
+
+    cleanFieldName = sanitizeName(fieldName.split("|")[0])
+
+    fieldMeta = OrderedDict()
+    fieldMeta["name"] = cleanFieldName
+
+    nameParts = fieldName.split("|")
+    fieldMeta["label"] = nameParts[0]
+
+    if len(nameParts)>1:
+        fieldMeta["desc"] = fieldName
+
+    fieldMeta, binVals = guessFieldMeta(col, fieldMeta, colors, forceType, enumOrderList)
+
+    fieldType = fieldMeta["type"]
+
+    if fieldType=="enum":
+        fieldMeta = addLongLabels(acronyms, fieldMeta)
+
+    fieldMeta = addDesc(metaDescs, fieldMeta)
+
+    if metaOpt is not None:
+        fieldMeta["opt"] = metaOpt
+
+    zippedName = join(outDir, cleanFieldName+".bin.gz")
+    logging.debug("writing %s" % zippedName)
+    fieldMeta["md5"] = writeGzipMd5(metaFieldData(fieldMeta, col, binVals), zippedName)[:MD5LEN]
+
+    del fieldMeta["_fmt"]
+    if "type" in fieldMeta:
+        logging.info(("Field %(name)s: type %(type)s, %(diffValCount)d different values" % fieldMeta))
+    else:
+        logging.info(("Field %(name)s: type %(type)s, %(diffValCount)d different values, max size %(maxSize)d " % fieldMeta))
+
+    return fieldMeta
+
+def metaToBin(inConf, outConf, fname, colorFname, outDir, enumFields, metaCols=None):
     """ convert meta table to binary files. outputs fields.json and one binary file per field.
     adds names of metadata fields to outConf and returns outConf
+    The fields are converted in parallel if inConf has 'workers', see metaFieldToBin.
+    If metaCols is set, the table is not read from fname but taken from this MetaColumns object.
     """
     logging.info("Converting to numbers and compressing meta data fields")
     makeDir(outDir)
 
-    colData = parseIntoColumns(fname)
+    if metaCols is None:
+        colData = parseIntoColumns(fname)
+    else:
+        colData = metaCols.iterColumns()
 
     colors = parseColors(colorFname)
     acronyms = readAcronyms(inConf, outConf)
@@ -1197,82 +1382,31 @@ def metaToBin(inConf, outConf, fname, colorFname, outDir, enumFields):
     if enumFields is not None:
         sanEnumFields = [sanitizeName(n) for n in enumFields]
 
-    fieldInfo = []
     validFieldNames = set()
-    for colIdx, (fieldName, col) in enumerate(colData):
-        enumOrderList = None
-        if enumOrder and fieldName in enumOrder:
-            orderFname = join(inConf["inDir"], enumOrder[fieldName])
-            enumOrderList = open(orderFname).read().splitlines()
-
-        logging.debug("Meta data field index %d: '%s'" % (colIdx, fieldName))
-        validFieldNames.add(fieldName)
-
-        forceType = None
-        if (fieldName in sanEnumFields):
-            forceType = "enum"
-
-        # very dumb heuristic to recognize fields that should not be treated as numbers but as enums
-        # res.0.6 is the default field name for Seurat clustering. Field header sanitizing changes it to
-        # res_0_6 which is not optimal, but namedtuple doesn't allow dots in names
-        if "luster" in fieldName or "ouvain" in fieldName or (fieldName.startswith("res_") and "_" in fieldName):
-            forceType="enum"
-
-        if colIdx==0:
-            forceType = "unique"
-
-        cleanFieldName = sanitizeName(fieldName.split("|")[0])
-
-        fieldMeta = OrderedDict()
-        fieldMeta["name"] = cleanFieldName
-
-        nameParts = fieldName.split("|")
-        fieldMeta["label"] = nameParts[0]
+    logLevel = logging.getLogger().level
 
-        if len(nameParts)>1:
-            fieldMeta["desc"] = fieldName
+    def iterFieldArgs():
+        " yield the arguments for runWithLogCollector for every field "
+        for colIdx, (fieldName, col) in enumerate(colData):
+            enumOrderFname = None
+            if enumOrder and fieldName in enumOrder:
+                enumOrderFname = join(inConf["inDir"], enumOrder[fieldName])
 
-        fieldMeta, binVals = guessFieldMeta(col, fieldMeta, colors, forceType, enumOrderList)
-
-        fieldType = fieldMeta["type"]
-
-        if fieldType=="enum":
-            fieldMeta = addLongLabels(acronyms, fieldMeta)
-
-        fieldMeta = addDesc(metaDescs, fieldMeta)
-
-        if "metaOpt" in inConf and fieldName in inConf["metaOpt"]:
-            fieldMeta["opt"] = inConf["metaOpt"][fieldName]
-
-        packFmt = fieldMeta["_fmt"]
-
-        binName = join(outDir, cleanFieldName+".bin")
-        if fieldMeta["type"]=="uniqueString":
-            # unique strings are simply written as-is
-            logging.debug("writing as normal strings to %s" % binName)
-            textFh = openFile(binName, "w")
-            for x in col:
-                textFh.write("%s\n" % x)
-            textFh.close()
-        else:
-            # default case: write data as binary file
-            logging.debug("writing as binary data to %s" % binName)
-            binFh = open(binName, "wb")
-            for x in binVals:
-                binFh.write(struct.pack(packFmt, x))
-            binFh.close()
+            metaOpt = None
+            if "metaOpt" in inConf and fieldName in inConf["metaOpt"]:
+                metaOpt = inConf["metaOpt"][fieldName]
 
-        runGzip(binName)
-        zippedName = binName+".gz"
+            validFieldNames.add(fieldName)
+            yield metaFieldToBin, (colIdx, fieldName, col, colors, acronyms, metaDescs, enumOrderFname, sanEnumFields, metaOpt, outDir), logLevel
 
-        fieldMeta["md5"] = md5WithPython(zippedName)[:MD5LEN]
-
-        del fieldMeta["_fmt"]
+    # the fields come back in column order, their log messages are written together
+    fieldInfo = []
+    for fieldMeta, logRecords in iterPoolOrdered(runWithLogCollector, iterFieldArgs(), getWorkerCount(inConf)):
+        for record in logRecords:
+            logging.getLogger().handle(record)
+        if fieldMeta is None:
+            sys.exit(1)
         fieldInfo.append(fieldMeta)
-        if "type" in fieldMeta:
-            logging.info(("Field %(name)s: type %(type)s, %(diffValCount)d different values" % fieldMeta))
-        else:
-            logging.info(("Field %(name)s: type %(type)s, %(diffValCount)d different values, max size %(maxSize)d " % fieldMeta))
 
     return fieldInfo, validFieldNames
 
@@ -1311,12 +1445,167 @@ def findMtxFiles(fname):
     logging.debug("mtx filename: %s, %s and %s" % (mtxFname, genesFname, barcodeFname))
     return mtxFname, genesFname, barcodeFname
 
+def writeNpyHeader(ofh, dtype, shape):
+    """ write the header of a .npy file for a 2D C-order array. It is always 128 bytes long,
+    so it can be overwritten later, when the final shape is known """
+    header = "{'descr': '%s', 'fortran_order': False, 'shape': (%d, %d), }" % (np.dtype(dtype).str, shape[0], shape[1])
+    header = header.ljust(128-10-1)+"\n"
+    ofh.write(b"\x93NUMPY\x01\x00" + struct.pack("<H", len(header)) + header.encode("latin1"))
+
+def dirSize(dirName):
+    " return total size of all files in a directory "
+    return sum([getsize(join(dirName, fname)) for fname in os.listdir(dirName)])
+
+class MatrixCache:
+    """ a directory with expression matrices that have already been parsed, so they don't have to be
+    parsed again. Every entry is a subdirectory with info.json, and either a dense matrix.npy and
+    genes.json or the three arrays of a CSR matrix: indptr.npy, indices.npy and data.npy.
+    Entries are found by the version of the input file (see getFileVersion). If the cache gets
+    bigger than maxSize bytes, the least recently used entries are removed. """
+    def __init__(self, cacheDir, maxSize):
+        self.cacheDir = cacheDir
+        self.maxSize = maxSize
+        makeDir(cacheDir)
+
+    def iterEntries(self):
+        " yield (entryDir, info) for all complete entries "
+        for infoFname in glob.glob(join(self.cacheDir, "*", "info.json")):
+            entryDir = dirname(infoFname)
+            if basename(entryDir).startswith("tmp"):
+                continue
+            yield entryDir, readJson(infoFname)
+
+    def find(self, fname, kind, matType=None):
+        """ return (entryDir, info) for fname or (None, None) if not in the cache. kind is 'dense' or
+        'csr'. matType 'int', 'float', etc or None for any type. """
+        size = getsize(fname)
+        mtime = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(getmtime(fname)))
+
+        candidates = []
+        for entryDir, info in self.iterEntries():
+            fileVersion = info["fileVersion"]
+            if info["kind"]==kind and fileVersion["size"]==size and matType in [None, info["matType"]]:
+                candidates.append( (entryDir, info) )
+
+        if len(candidates)==0:
+            logging.info("%s is not in the matrix cache %s" % (fname, self.cacheDir))
+            return None, None
+
+        found = None
+        for entryDir, info in candidates:
+            fileVersion = info["fileVersion"]
+            if fileVersion["fname"]==abspath(fname) and fileVersion["mtime"]==mtime:
+                found = (entryDir, info)
+                break
+
+        if found is None:
+            # same size, but maybe a copy or the file was touched: compare the md5
+            md5 = getFileVersion(fname)["md5"]
+            for entryDir, info in candidates:
+                if info["fileVersion"]["md5"]==md5:
+                    found = (entryDir, info)
+                    break
+
+        if found is None:
+            logging.info("%s has changed since it was added to the matrix cache" % fname)
+            return None, None
+
+        entryDir, info = found
+        logging.info("Found %s in matrix cache: %s" % (fname, entryDir))
+        info["lastUsed"] = time.time()
+        writeJson(info, join(entryDir, "info.json"))
+        return entryDir, info
+
+    def newEntry(self):
+        " return the name of a new temporary directory for an entry "
+        import tempfile
+        return tempfile.mkdtemp(prefix="tmp", dir=self.cacheDir)
+
+    def addEntry(self, tmpDir, fname, kind, info):
+        " finish an entry in tmpDir for fname. info must contain at least 'matType'. Removes old entries. "
+        info["kind"] = kind
+        info["fileVersion"] = getFileVersion(abspath(fname))
+        info["lastUsed"] = time.time()
+        writeJson(info, join(tmpDir, "info.json"))
+
+        entryDir = join(self.cacheDir, "%s-%s-%s" % (info["fileVersion"]["md5"][:MD5LEN], kind, info["matType"]))
+        if isdir(entryDir):
+            shutil.rmtree(entryDir)
+        os.rename(tmpDir, entryDir)
+        logging.info("Added %s to matrix cache: %s" % (fname, entryDir))
+        self.removeOld(entryDir)
+
+    def removeOld(self, newEntry):
+        " remove the least recently used entries until the cache is smaller than maxSize "
+        entries = []
+        totalSize = 0
+        for entryDir, info in self.iterEntries():
+            size = dirSize(entryDir)
+            entries.append( (info["lastUsed"], entryDir, size) )
+            totalSize += size
+
+        entries.sort()
+        for lastUsed, entryDir, size in entries:
+            if totalSize <= self.maxSize:
+                break
+            if entryDir==newEntry:
+                logging.warn("%s is bigger than the matrix cache size of %d GB, not keeping it" % (entryDir, self.maxSize/(1024**3)))
+            else:
+                logging.info("Matrix cache is full, removing %s" % entryDir)
+            shutil.rmtree(entryDir)
+            totalSize -= size
+
+class MatrixCacheWriter:
+    " add the rows of a matrix to a new dense entry of a MatrixCache, as they are read "
+    def __init__(self, cache, fname, matType, sampleCount):
+        self.cache = cache
+        self.fname = fname
+        self.matType = matType
+        if matType=="float":
+            self.dtype = np.float32
+        else:
+            self.dtype = np.int32
+        self.sampleCount = sampleCount
+        self.genes = []
+        self.tmpDir = cache.newEntry()
+        self.ofh = open(join(self.tmpDir, "matrix.npy"), "wb")
+        writeNpyHeader(self.ofh, self.dtype, (0, sampleCount))
+
+    def addRow(self, gene, arr):
+        self.genes.append(gene)
+        self.ofh.write(np.asarray(arr, dtype=self.dtype).tobytes())
+
+    def finish(self):
+        " write the final header and add the entry to the cache "
+        self.ofh.seek(0)
+        writeNpyHeader(self.ofh, self.dtype, (len(self.genes), self.sampleCount))
+        self.ofh.close()
+        writeJson(self.genes, join(self.tmpDir, "genes.json"))
+        self.cache.addEntry(self.tmpDir, self.fname, "dense", {"matType" : self.matType})
+
+    def abort(self):
+        " remove the incomplete entry "
+        self.ofh.close()
+        shutil.rmtree(self.tmpDir)
+
+def getMatrixCache():
+    """ return the MatrixCache configured in ~/.cellbrowser.conf with matrixCacheDir and
+    matrixCacheSize (in GB, default 50) or None if there is none """
+    cacheDir = getConfig("matrixCacheDir")
+    if cacheDir is None or not numpyLoaded:
+        return None
+    return MatrixCache(expanduser(cacheDir), getConfig("matrixCacheSize", 50)*1024*1024*1024)
+
 class MatrixMtxReader:
     " open a .mtx file and yield rows via iterRows. gz and csv OK."
-    def __init__(self, geneToSym=None):
-        " can automatically translate to symbols, if dict geneId -> sym is provided "
+    def __init__(self, geneToSym=None, chunkSize=None, tmpDir=None):
+        """ can automatically translate to symbols, if dict geneId -> sym is provided.
+        chunkSize is the number of matrix entries that are read at a time and tmpDir is where
+        the temporary arrays are kept, see open10xMtxForRows """
         logging.debug(".mtx.gz reader initialized")
         self.geneToSym = geneToSym
+        self.chunkSize = chunkSize
+        self.tmpDir = tmpDir
 
     def open(self, fname, matType=None):
         import scipy.io
@@ -1324,7 +1613,7 @@ class MatrixMtxReader:
         logging.info("Loading %s" % fname)
         mtxFname, genesFname, barcodeFname = findMtxFiles(fname)
 
-        self.mat, self.genes, self.barcodes = open10xMtxForRows(mtxFname, genesFname, barcodeFname)
+        self.mat, self.genes, self.barcodes = open10xMtxForRows(mtxFname, genesFname, barcodeFname, chunkSize=self.chunkSize, tmpDir=self.tmpDir)
 
     def close(self):
         pass
@@ -1357,12 +1646,53 @@ class MatrixMtxReader:
             arr = mat.getrow(i).toarray().astype("float32")
             yield (geneId, geneSym, arr)
 
+    def iterRowsSparse(self, idxList=None):
+        """ yield (geneId, symbol, (cellIdx, values, cellCount)) tuples, directly from the arrays
+        of the CSR matrix, without making a dense array. Keep only the columns in idxList """
+        mat = self.mat
+        if idxList is not None:
+            mat = mat[:, idxList]
+        mat.sort_indices()
+        indptr, indices, data = mat.indptr, mat.indices, mat.data
+        cellCount = mat.shape[1]
+
+        if self.getMatType()=="float":
+            data = data.astype("float32")
+        else:
+            data = data.astype("int32")
+
+        genes = self.genes
+        for i in range(0, len(self.genes)):
+            geneId = genes[i]
+            geneSym = geneId
+            if "|" in geneId:
+                geneId, geneSym = geneId.split("|")[:2]
+            if self.geneToSym and geneSym is not None:
+                geneSym = self.geneToSym.get(geneId)
+
+            if i%1000==0:
+                logging.info("%d genes written..." % i)
+            start, end = indptr[i], indptr[i+1]
+            yield (geneId, geneSym, (indices[start:end], data[start:end], cellCount))
+
+def textToArray(text, npType, sep=None):
+    """ parse a string of numbers separated by sep (default: whitespace, including newlines) into
+    a 1D numpy array. Raises ValueError if a field is not a number of npType. """
+    if np.lib.NumpyVersion(np.__version__) >= "1.23.0":
+        # loadtxt has a fast C parser since numpy 1.23
+        return np.loadtxt(io.StringIO(text), dtype=npType, delimiter=sep, ndmin=1).ravel()
+    return np.array(text.split(sep), dtype=npType)
+
 class MatrixTsvReader:
     " open a .tsv or .csv file and yield rows via iterRows. gz and csv OK."
 
-    def __init__(self, geneToSym=None):
-        " can automatically translate to symbols, if dict geneId -> sym is provided "
+    def __init__(self, geneToSym=None, blockSize=32*1024*1024, useCache=True):
+        """ can automatically translate to symbols, if dict geneId -> sym is provided.
+        blockSize is the number of characters read at a time by the fast parser.
+        If useCache is set, the matrix cache in ~/.cellbrowser.conf is used, see getMatrixCache() """
         self.geneToSym = geneToSym
+        self.blockSize = blockSize
+        self.useCache = useCache
 
     def open(self, fname, matType=None, usePyGzip=False):
         " open file and guess field sep and format of numbers (float or int) "
@@ -1399,6 +1729,19 @@ class MatrixTsvReader:
         logging.debug("Read %d sampleNames, e.g. %s" % (len(self.sampleNames), self.sampleNames[0]))
 
         self.oldRows = []
+
+        self.cache = None
+        if self.useCache:
+            self.cache = getMatrixCache()
+        self.cacheMat = None
+        if self.cache is not None:
+            entryDir, info = self.cache.find(fname, "dense", matType)
+            if entryDir is not None:
+                self.cacheMat = np.load(join(entryDir, "matrix.npy"), mmap_mode="r")
+                self.cacheGenes = readJson(join(entryDir, "genes.json"))
+                self.matType = info["matType"]
+                return
+
         if matType is None:
             self.matType = self._autoDetectMatType(10)
             logging.info("Auto-detect: Numbers in matrix are of type '%s'", self.matType)
@@ -1424,8 +1767,8 @@ class MatrixTsvReader:
         self.matType = "float" # iterRows needs this attribute
 
         matType = "int"
-        for geneId, sym, a in self.iterRows():
-            self.oldRows.append( (geneId, sym, a) )
+        for rawGene, geneId, sym, a in self._iterRowsResolved(self._iterRowsLines()):
+            self.oldRows.append( (rawGene, geneId, sym, a) )
             geneCount+=1
             if numpyLoaded:
                 a_int = a.astype(int)
@@ -1449,89 +1792,196 @@ class MatrixTsvReader:
         logging.debug("Matrix type is: %s" % matType)
         return matType
 
-    def iterRows(self):
-        " yield (geneId, symbol, array) tuples from gene expression file. "
-        if self.matType == "float":
-            npType = "float32"
+    def iterRows(self, byLine=False):
+        """ yield (geneId, symbol, array) tuples from gene expression file.
+        With numpy, the file is read and parsed in large blocks, otherwise (or if byLine is set)
+        line by line. Both return the same rows. If there is a matrix cache, the rows are read from it,
+        or, if the matrix is not cached yet, they are added to it. """
+        if self.cacheMat is not None:
+            rawRows = self._iterRowsCache()
+        elif numpyLoaded and not byLine:
+            rawRows = self._iterRowsBlocks()
         else:
-            npType = "int32"
+            rawRows = self._iterRowsLines()
 
-        # during auto-detection, we've already read a few lines
-        logging.debug("spooling back %d saved rows" % len(self.oldRows))
-        for (geneId, sym, arr) in self.oldRows:
-            # for the integer case though we have to fix up the type now
-            if self.matType=="int" or self.matType=="forceInt":
-                if numpyLoaded:
-                    arr = arr.astype(int)
-                else:
-                    arr = [int(x) for x in arr]
-            yield (geneId, sym, arr)
+        cacheWriter = None
+        if self.cache is not None and self.cacheMat is None and not byLine:
+            cacheWriter = MatrixCacheWriter(self.cache, self.fname, self.matType, len(self.sampleNames))
 
-        skipIds = 0
+        try:
+            # during auto-detection, we've already read a few lines
+            logging.debug("spooling back %d saved rows" % len(self.oldRows))
+            for (rawGene, geneId, sym, arr) in self.oldRows:
+                # for the integer case though we have to fix up the type now
+                if self.matType=="int" or self.matType=="forceInt":
+                    if numpyLoaded:
+                        arr = arr.astype("int32") # same type as the other rows
+                    else:
+                        arr = [int(x) for x in arr]
+                if cacheWriter:
+                    cacheWriter.addRow(rawGene, arr)
+                yield (geneId, sym, arr)
+
+            self.skipIds = 0
+            for rawGene, geneId, sym, arr in self._iterRowsResolved(rawRows):
+                if cacheWriter:
+                    cacheWriter.addRow(rawGene, arr)
+                yield geneId, sym, arr
+
+            if self.skipIds!=0:
+                logging.warn("Kept %d genes as original IDs, due to duplication or unknown ID" % self.skipIds)
+
+            if cacheWriter:
+                cacheWriter.finish()
+                cacheWriter = None
+        finally:
+            # the caller did not read all rows: the cache entry is not complete
+            if cacheWriter:
+                cacheWriter.abort()
+
+    def _iterRowsResolved(self, rawRows):
+        " given (gene, arr) tuples, yield (gene, geneId, sym, arr) "
         doneGenes = set()
         lineNo = 0
-        sep = self.sep
-        sampleCount = len(self.sampleNames)
-        geneToSym = self.geneToSym
-        for line in self.ifh:
-            self.lineLen = len(line)
+        for gene, arr in rawRows:
+            geneId, symbol = self._getSymbol(gene, lineNo, doneGenes)
+            lineNo += 1
+            yield gene, geneId, symbol, arr
 
-            gene, rest = splitOnce(line.rstrip("\r\n"), sep)
-            gene = gene.strip('"')
+    def _iterRowsCache(self):
+        " yield (gene, arr) from the matrix cache "
+        logging.info("Reading matrix from cache")
+        for gene, arr in zip(self.cacheGenes, self.cacheMat):
+            yield gene, np.array(arr)
 
-            if numpyLoaded:
-                arr = np.fromstring(rest, dtype=npType, sep=sep, count=sampleCount)
+    def _parseLine(self, line, npType):
+        " split a line into the gene and its array of numbers "
+        sep = self.sep
+        gene, rest = splitOnce(line.rstrip("\r\n"), sep)
+        gene = gene.strip('"')
+
+        if numpyLoaded:
+            arr = textToArray(rest.rstrip(sep), npType, sep=sep)
+            if len(arr)!=len(self.sampleNames):
+                errAbort("Gene %s has %d values in the expression matrix, but the header line has %d sample names" % \
+                    (gene, len(arr), len(self.sampleNames)))
+        else:
+            if self.matType=="int":
+                #try:
+                    arr = [int(x) for x in rest.split(sep)]
+                #except ValueError as ex:
+                #logging.warn("Cannot parse expression matrix. This may be due to the numbers incorrectly auto-detected as integers even if they are floating point numbers. Set matrixType='float' in cellbrowser.conf to fix this and re-run cbBuild. The exact error message was: %s" % ex)
+                #arr = map(int, rest.split(sep)) # this doesn't work in python3, requires list(), so slower
+            elif self.matType=="forceInt":
+                #try:
+                    arr = [int(float(x)) for x in rest.split(sep)]
             else:
-                if self.matType=="int":
-                    #try:
-                        arr = [int(x) for x in rest.split(sep)]
-                    #except ValueError as ex:
-                    #logging.warn("Cannot parse expression matrix. This may be due to the numbers incorrectly auto-detected as integers even if they are floating point numbers. Set matrixType='float' in cellbrowser.conf to fix this and re-run cbBuild. The exact error message was: %s" % ex)
-                    #arr = map(int, rest.split(sep)) # this doesn't work in python3, requires list(), so slower
-                elif self.matType=="forceInt":
-                    #try:
-                        arr = [int(float(x)) for x in rest.split(sep)]
-                else:
-                    arr = [float(x) for x in rest.split(sep)]
-                    #arr = map(float, rest.split(sep))
+                arr = [float(x) for x in rest.split(sep)]
+                #arr = map(float, rest.split(sep))
+        return gene, arr
 
-            if "|" in gene:
-                gene, symbol = gene.split("|")
+    def _getSymbol(self, gene, lineNo, doneGenes):
+        " return (geneId, symbol) for a gene identifier from the matrix "
+        geneToSym = self.geneToSym
+        if "|" in gene:
+            gene, symbol = gene.split("|")
+        else:
+            if geneToSym is None:
+                symbol = gene
             else:
-                if geneToSym is None:
+                symbol = geneToSym.get(gene.split(".")[0])
+                logging.debug("%s -> %s" % (gene, symbol))
+                #if symbol is None:
+                    #symbol = geneToSym.get(gene)
+
+                if symbol is None:
+                    self.skipIds += 1
+                    logging.warn("line %d: could not find symbol for ID %s, looks like it is not a valid gene ID, check geneIdType setting in cellbrowser.conf or gene symbol mapping tables" % (lineNo, gene))
                     symbol = gene
-                else:
-                    symbol = geneToSym.get(gene.split(".")[0])
-                    logging.debug("%s -> %s" % (gene, symbol))
-                    #if symbol is None:
-                        #symbol = geneToSym.get(gene)
 
-                    if symbol is None:
-                        skipIds += 1
-                        logging.warn("line %d: could not find symbol for ID %s, looks like it is not a valid gene ID, check geneIdType setting in cellbrowser.conf or gene symbol mapping tables" % (lineNo, gene))
-                        symbol = gene
+                if symbol.isdigit():
+                    logging.warn("line %d in gene matrix: gene identifier %s is a number. If this is indeed a gene identifier, you can ignore this warning. Otherwise, your matrix may have no gene ID in the first column and you will have to fix the matrix. An other possibility is that your geneIds are entrez gene IDs, but this is rare." % (lineNo, symbol))
 
-                    if symbol.isdigit():
-                        logging.warn("line %d in gene matrix: gene identifier %s is a number. If this is indeed a gene identifier, you can ignore this warning. Otherwise, your matrix may have no gene ID in the first column and you will have to fix the matrix. An other possibility is that your geneIds are entrez gene IDs, but this is rare." % (lineNo, symbol))
+        if symbol in doneGenes:
+            logging.warn("line %d: Gene %s/%s is duplicated in matrix, using only first occurrence for symbol, kept second occurrence with original geneId" % (lineNo, gene, symbol))
+            symbol = gene
 
-            if symbol in doneGenes:
-                logging.warn("line %d: Gene %s/%s is duplicated in matrix, using only first occurrence for symbol, kept second occurrence with original geneId" % (lineNo, gene, symbol))
-                symbol = gene
+        doneGenes.add(gene)
+        return gene, symbol
 
-            doneGenes.add(gene)
+    def _iterRowsLines(self):
+        " the simple parser: yield (gene, arr), one line at a time "
+        if self.matType == "float":
+            npType = "float32"
+        else:
+            npType = "int32"
 
-            lineNo += 1
+        for line in self.ifh:
+            self.lineLen = len(line)
+            gene, arr = self._parseLine(line, npType)
+            logging.debug("Yielding gene %s, %d fields" % (gene, len(arr)))
+            yield gene, arr
 
-            logging.debug("Yielding gene %s, sym %s, %d fields" % (gene, symbol, len(arr)))
-            yield gene, symbol, arr
+    def _iterRowsBlocks(self):
+        """ the fast parser: read blocks of many lines, parse all their numbers at once into a 2D
+        array and yield (gene, arr) with arr being rows of this array. Requires numpy. """
+        if self.matType == "float":
+            npType = "float32"
+        else:
+            npType = "int32"
 
-        if skipIds!=0:
-            logging.warn("Kept %d genes as original IDs, due to duplication or unknown ID" % skipIds)
+        rest = ""
+        while True:
+            block = self.ifh.read(self.blockSize)
+            if len(block)==0:
+                if rest=="":
+                    break
+                block = "\n" # the last line had no newline
+            block = rest+block
+            lastNl = block.rfind("\n")
+            if lastNl==-1:
+                rest = block
+                continue
+            rest = block[lastNl+1:]
+            block = block[:lastNl+1]
+
+            genes, mat = self._parseBlock(block, npType)
+            logging.debug("Parsed block of %d genes" % len(genes))
+            for gene, arr in zip(genes, mat):
+                yield gene, arr
+
+    def _parseBlock(self, block, npType):
+        """ parse a string with complete lines into a list of geneIds and a 2D array, one row per line.
+        Rows that contain only single-digit numbers, the most common case in sparse count matrices,
+        are converted by reading every second byte. All other rows are parsed with _parseLine. """
+        lines = block.split("\n")[:-1]
+        sampleCount = len(self.sampleNames)
+        digitRowLen = 2*sampleCount - 1 # length of a row with only single-digit numbers
+        sepCode = ord(self.sep)
+
+        genes = []
+        mat = np.empty( (len(lines), sampleCount), dtype=npType)
+        for i, line in enumerate(lines):
+            sepPos = line.find(self.sep)
+            if len(line)-sepPos-1 == digitRowLen:
+                rowBytes = np.frombuffer(line[sepPos+1:].encode("utf8"), dtype=np.uint8)
+                if len(rowBytes)==digitRowLen:
+                    digits = rowBytes[0::2]-48
+                    if np.all(rowBytes[1::2]==sepCode) and np.all(digits <= 9):
+                        genes.append(line[:sepPos].strip('"'))
+                        mat[i] = digits
+                        continue
+
+            gene, arr = self._parseLine(line, npType)
+            genes.append(gene)
+            mat[i] = arr
+
+        return genes, mat
 
     def iterRowsWithOffsets(self):
         " like iterRows, but also return offset and line length "
         offset = self.ifh.tell()
-        for gene, sym, row in self.iterRows():
+        for gene, sym, row in self.iterRows(byLine=True):
             yield gene, sym, row, offset, self.lineLen
             offset = self.ifh.tell()
 
@@ -1683,6 +2133,13 @@ def binEncode(bins):
     assert(len(ret)==11*3*4)
     return ret
 
+def percentileLower(arr, percs, axis=None):
+    " np.percentile with the 'lower' method. numpy >= 1.22 renamed the interpolation argument to method "
+    try:
+        return np.percentile(arr, percs, axis=axis, method="lower")
+    except TypeError:
+        return np.percentile(arr, percs, axis=axis, interpolation="lower")
+
 def digitize_np(arr, matType):
     """ hopefully the same as digitize(), but using numpy
     #>>> digitize_np([1,2,3,4,5,6,4,1,1,1], "int")
@@ -1730,7 +2187,7 @@ def digitize_np(arr, matType):
         logging.debug("expression vector is all zeroes")
         return np.zeros(arr.size, dtype=np.int8), [(0.0, 0.0, arr.size)]
 
-    deciles = np.percentile( noZero, [0,10,20,30,40,50,60,70,80,90] , interpolation="lower")
+    deciles = percentileLower(noZero, [0,10,20,30,40,50,60,70,80,90])
     # make sure that we always have a bin for the zeros
     deciles = np.insert(deciles, 0, 0)
     logging.debug("deciles are: %s" % str(deciles))
@@ -1761,30 +2218,257 @@ def digitize_np(arr, matType):
     #print bins, len(digArr), digArr
     return digArr, bins
 
+def jsRound(arr):
+    " Math.round() of Javascript: round halves up, not to the even number like np.round "
+    arr = np.asarray(arr, dtype=np.float64)
+    rounded = np.floor(arr)
+    return (rounded + (arr-rounded >= 0.5)).astype(np.intp)
+
+def discretizeExprArray(arr, maxBinCount=10):
+    """ port of discretizeArray() in cbData.js with bin0Val=0, so discretMat.bin has exactly the bins of
+    the browser. arr has to have the values as the browser reads them, see exprEncodeBatch.
+    If there are less than maxBinCount different values, every value gets its own bin. Otherwise bin0 is
+    for the zeros and the limits of the other bins are the different non-zero values at
+    the positions 0, 10%, 20%, ... of their sorted list. Returns a uint8 array with the bin of every value
+    and the bins, a list of (min, max, count). """
+    arr = np.asarray(arr)
+    vals, valCounts = np.unique(arr, return_counts=True)
+
+    # just a few values: no binning, just count, see arrToEnum()
+    if len(vals) < maxBinCount:
+        digArr = np.searchsorted(vals, arr).astype(np.uint8)
+        return digArr, [(val, val, count) for val, count in zip(vals, valCounts)]
+
+    # the zeros have their own bin
+    if vals[0]==0:
+        vals = vals[1:]
+    countLen = len(vals)
+    breakIdx = list(jsRound((1.0/maxBinCount*np.arange(maxBinCount))*countLen)) + [countLen-1]
+    minVal = vals[breakIdx[0]]
+    breakValues = vals[breakIdx[1:]]
+
+    # bin = 1 + number of break values < value, see findBins()
+    digArr = (np.searchsorted(breakValues, arr, side="left")+1).astype(np.uint8)
+    digArr[arr==0] = 0
+    binCounts = np.bincount(digArr, minlength=len(breakValues)+1)
+
+    bins = [ (0.0, 0.0, binCounts[0]) ]
+    for i in range(len(breakValues)):
+        if i==0:
+            binMin = minVal
+        else:
+            binMin = breakValues[i-1]
+        bins.append( (binMin, breakValues[i], binCounts[i+1]) )
+    return digArr, bins
+
+def digitizeBlock(mat, cellCount=None, maxBinCount=10):
+    """ discretizeExprArray for a block of genes at once. mat is a 2D array (genes x cells) or a tuple
+    (indptr, indices, data) of a CSR matrix with cellCount columns. Returns a 2D uint8 array with
+    the bin indices and a list with the bins of every gene, the same as discretizeExprArray for every row.
+    The non-zero values of all rows are sorted together. The break values of discretizeExprArray are
+    at fixed positions in the list of different values of a row, so the bin of a value only depends on its
+    rank in this list. Rows with negative values are left to discretizeExprArray. """
+    if type(mat)==tuple:
+        indptr, indices, data = mat
+        geneCount = len(indptr)-1
+        rowIdx = np.repeat(np.arange(geneCount), np.diff(indptr))
+        indices, data = np.asarray(indices), np.asarray(data)
+    else:
+        mat = np.asarray(mat)
+        geneCount, cellCount = mat.shape
+        rowIdx, indices = np.nonzero(mat)
+        data = mat[rowIdx, indices]
+
+    # explicit zeros are like all other zeros
+    keep = (data!=0)
+    rowIdx, indices, data = rowIdx[keep], indices[keep], data[keep]
+
+    negRows = np.unique(rowIdx[data < 0])
+    if len(negRows)!=0:
+        isNeg = np.zeros(geneCount, dtype=bool)
+        isNeg[negRows] = True
+        negSel = isNeg[rowIdx]
+        negRowIdx, negIndices, negData = rowIdx[negSel], indices[negSel], data[negSel]
+        rowIdx, indices, data = rowIdx[~negSel], indices[~negSel], data[~negSel]
+
+    order = np.lexsort( (data, rowIdx) )
+    rowIdx, indices, data = rowIdx[order], indices[order], data[order]
+    nzCounts = np.bincount(rowIdx, minlength=geneCount)
+    rowStarts = np.concatenate( ([0], np.cumsum(nzCounts)) )
+
+    # rank of a value in the list of the different non-zero values of its row
+    isNew = np.ones(len(data), dtype=bool)
+    isNew[1:] = (data[1:]!=data[:-1]) | (rowIdx[1:]!=rowIdx[:-1])
+    newCounts = np.concatenate( ([0], np.cumsum(isNew)) )
+    ranks = newCounts[1:] - 1 - newCounts[rowStarts[rowIdx]]
+    diffCounts = newCounts[rowStarts[1:]] - newCounts[rowStarts[:-1]]
+
+    zeroCounts = cellCount - nzCounts
+    hasZero = (zeroCounts > 0).astype(np.intp)
+    isEnum = (diffCounts + hasZero < maxBinCount)
+
+    # positions of the break values in the list of the different non-zero values, without the first one at 0%, see discretizeExprArray
+    percs = 1.0/maxBinCount*np.arange(1, maxBinCount)
+    breakIdx = np.concatenate( (jsRound(percs[None, :]*diffCounts[:, None]), diffCounts[:, None]-1), axis=1)
+
+    # few values: bin = rank of the value, incl. the zero. Otherwise: 1 + number of break values < value
+    digits = np.where(isEnum[rowIdx], ranks+hasZero[rowIdx], 1)
+    rowBreaks = breakIdx[rowIdx]
+    for k in range(breakIdx.shape[1]):
+        digits += (~isEnum[rowIdx]) & (rowBreaks[:, k] < ranks)
+    digits = digits.astype(np.uint8)
+
+    digMat = np.zeros( (geneCount, cellCount), dtype=np.uint8)
+    digMat[rowIdx, indices] = digits
+    binCounts = np.bincount(rowIdx*(maxBinCount+1)+digits, minlength=geneCount*(maxBinCount+1)).reshape( (geneCount, -1) )
+
+    allBins = [None]*geneCount
+    negRowSet = set(negRows.tolist())
+    for i in range(geneCount):
+        if i in negRowSet:
+            continue
+        rowNew = isNew[rowStarts[i]:rowStarts[i+1]]
+        vals = data[rowStarts[i]:rowStarts[i+1]][rowNew]
+        if isEnum[i]:
+            valCounts = np.diff(np.append(np.flatnonzero(rowNew), nzCounts[i]))
+            bins = [(val, val, count) for val, count in zip(vals, valCounts)]
+            if hasZero[i]:
+                bins.insert(0, (0.0, 0.0, zeroCounts[i]))
+        else:
+            breakValues = vals[breakIdx[i]]
+            bins = [ (0.0, 0.0, zeroCounts[i]) ]
+            for k in range(len(breakValues)):
+                if k==0:
+                    binMin = vals[0]
+                else:
+                    binMin = breakValues[k-1]
+                bins.append( (binMin, breakValues[k], binCounts[i][k+1]) )
+        allBins[i] = bins
+
+    for i in negRows:
+        sel = (negRowIdx==i)
+        digMat[i], allBins[i] = discretizeExprArray(rowToDense(negIndices[sel], negData[sel], cellCount), maxBinCount)
+
+    return digMat, allBins
+
+def rowToDense(cellIdx, vals, cellCount):
+    " return an array with cellCount values, vals at the positions cellIdx and zeros otherwise "
+    arr = np.zeros(cellCount, dtype=vals.dtype)
+    arr[cellIdx] = vals
+    return arr
+
+def clusterAggregate(mat, cellIdxLists, withDeciles=True, withMedian=True):
+    """ given a 2D array (genes x cells) and a list of lists of cell indices, e.g. one per cluster,
+    return a dict with arrays, one row per gene and one column per cell list:
+    - mean: the mean of the values
+    - nonZero: the number of non-zero values
+    - median: the value at position n//2 of the n sorted values
+    - deciles: 11 values per cell list, at positions int((n-1)*q) for q = 0, 0.1, ..., 1.0
+    Empty cell lists get zeros. The cells are grouped by list only once and summed with
+    np.add.reduceat. Without deciles, the medians are found with np.partition, so no row is sorted. """
+    mat = np.asarray(mat)
+    geneCount = mat.shape[0]
+    listCount = len(cellIdxLists)
+    sizes = np.array([len(cellIdx) for cellIdx in cellIdxLists], dtype=np.intp)
+    starts = np.concatenate( ([0], np.cumsum(sizes)) )
+    order = np.concatenate([np.asarray(cellIdx, dtype=np.intp) for cellIdx in cellIdxLists]+[np.zeros(0, dtype=np.intp)])
+    grouped = mat[:, order]
+
+    sums = np.zeros( (geneCount, listCount) )
+    nonZero = np.zeros( (geneCount, listCount), dtype=np.int64)
+    isFilled = (sizes!=0)
+    if np.any(isFilled):
+        # without the empty lists, every start is followed by the start of the next list
+        filledStarts = starts[:-1][isFilled]
+        sums[:, isFilled] = np.add.reduceat(grouped, filledStarts, axis=1, dtype=np.float64)
+        nonZero[:, isFilled] = np.add.reduceat(grouped!=0, filledStarts, axis=1, dtype=np.int64)
+
+    res = {}
+    res["mean"] = sums / np.maximum(sizes, 1)
+    res["nonZero"] = nonZero
+
+    if withMedian or withDeciles:
+        medians = np.zeros( (geneCount, listCount), dtype=mat.dtype)
+        deciles = np.zeros( (geneCount, listCount, 11), dtype=mat.dtype)
+        for i in range(listCount):
+            n = sizes[i]
+            if n==0:
+                continue
+            sub = grouped[:, starts[i]:starts[i+1]]
+            if withDeciles:
+                sub = np.sort(sub, axis=1)
+                deciles[:, i, :] = sub[:, (np.arange(11)*(n-1))//10]
+                medians[:, i] = sub[:, n//2]
+            else:
+                medians[:, i] = np.partition(sub, n//2, axis=1)[:, n//2]
+        if withMedian:
+            res["median"] = medians
+        if withDeciles:
+            res["deciles"] = deciles
+    return res
+
+def clusterAggrStatNames(withMedian=False):
+    " return the names of the values of every cluster in clusterAggr.bin, see clusterAggrRecords "
+    names = ["mean", "nonZero"] + ["p%d" % (10*i) for i in range(11)]
+    if withMedian:
+        names.append("median")
+    return names
+
+def labelsToCellLists(labels):
+    """ given a list with the cluster name of every cell, return the sorted cluster names and a list
+    of arrays, for every cluster the indices of its cells """
+    clusterNames = sorted(set(labels))
+    clusterToIdx = dict([(name, i) for i, name in enumerate(clusterNames)])
+    cellIdxLists = [[] for name in clusterNames]
+    for cellIdx, label in enumerate(labels):
+        cellIdxLists[clusterToIdx[label]].append(cellIdx)
+    return clusterNames, [np.array(cellIdx, dtype=np.intp) for cellIdx in cellIdxLists]
+
+def writeClusterAggrIndex(fname, field, clusterNames, cellIdxLists, withMedian, genes):
+    """ write the index of clusterAggr.bin. This file has one record of float32 values per gene, in the
+    order of genes. Every record has, for every value in stats, one number per cluster. """
+    index = OrderedDict()
+    index["field"] = field
+    index["clusters"] = clusterNames
+    index["cellCounts"] = [len(cellIdx) for cellIdx in cellIdxLists]
+    index["stats"] = clusterAggrStatNames(withMedian)
+    index["genes"] = genes
+    writeJson(index, fname)
+
+def clusterAggrRecords(mat, cellIdxLists, withMedian=False):
+    """ return a float32 array with one row per gene of mat (genes x cells), the records of
+    clusterAggr.bin: for every value in clusterAggrStatNames, one number per cluster. nonZero is the
+    fraction of cells with a non-zero value. """
+    aggr = clusterAggregate(mat, cellIdxLists, withMedian=withMedian)
+    sizes = np.array([max(1, len(cellIdx)) for cellIdx in cellIdxLists])
+    stats = [aggr["mean"], aggr["nonZero"] / sizes]
+    for i in range(11):
+        stats.append(aggr["deciles"][:, :, i])
+    if withMedian:
+        stats.append(aggr["median"])
+    return np.stack(stats, axis=1).astype(np.float32).reshape( (mat.shape[0], -1) )
+
 def maxVal(a):
     if numpyLoaded:
         return np.amax(a)
     else:
         return max(a)
 
-#def discretExprRowEncode(geneDesc, binInfo, digArr):
-#    " encode geneDesc, deciles and array of decile indixes into a single string that can be read by the .js code "
-#    # The format of a record is:
-#    # - 2 bytes: length of descStr, e.g. gene identifier or else
-#    # - len(descStr) bytes: the descriptive string descStr
-#    # - 132 bytes: 11 deciles, encoded as 11 * 3 floats (=min, max, count)
-#    # - array of n bytes, n = number of cells
-#    decChrList = [chr(x) for x in digArr]
-#    decStr = "".join(decChrList)
-#    geneIdLen = struct.pack("<H", len(geneDesc))
-#
-#    binStr = binEncode(binInfo)
-#    geneStr = geneIdLen+geneDesc+binStr+decStr
-#
-#    geneCompr = zlib.compress(geneStr)
-#    logging.debug("compression factor of %s: %f, before %d, after %d"% (geneDesc, float(len(geneCompr)) / len(geneStr), len(geneStr), len(geneCompr)))
-#
-#    return geneCompr
+def discretRecord(geneDesc, digArr, bins, codec="zlib"):
+    """ encode geneDesc, the bins and the array of bin indices into a compressed record of discretMat.bin,
+    so the .js code does not have to calculate the deciles. The format of a record is:
+    - 2 bytes: length of descStr, e.g. gene identifier or else
+    - len(descStr) bytes: the descriptive string descStr
+    - 1 byte: number of bins b
+    - b * 3 4-byte floats: the min, max and count of each bin
+    - array of n bytes: the bin index of each cell, n = number of cells
+    The record is compressed with codec, see compressRecord.
+    """
+    geneDesc = str(geneDesc)
+    binStrs = [struct.pack("<fff", float(minVal), float(maxVal), float(count)) for minVal, maxVal, count in bins]
+    geneStr = struct.pack("<H", len(geneDesc)) + geneDesc.encode("ascii") + struct.pack("<B", len(bins)) \
+            + b"".join(binStrs) + digArr.astype(np.uint8).tobytes()
+    return compressRecord(geneStr, codec)
 
 def isMtx(path):
     " return true if path looks like it could indicate an .mtx-style matrix "
@@ -1798,20 +2482,275 @@ def isMtx(path):
         logging.debug("%s is not an MTX file" % path)
         return False
 
-def exprEncode(geneDesc, exprArr, matType):
+# codecs for the records in exprMatrix.bin. The name is written to dataset.json as matrixCodec,
+# cbData.js decompresses the records according to it. zlib can have a level, e.g. zlib:1
+exprCodecNames = ["zlib", "zlib:1", "zlib:9", "raw", "lz4"]
+
+def checkExprCodec(codec):
+    """ make sure that codec can be used for exprMatrix.bin and return it. Falls back to zlib
+    if the python module for the codec is not installed """
+    if codec is None:
+        return "zlib"
+    if codec in ["zlib", "raw"]:
+        return codec
+    if codec.startswith("zlib:"):
+        level = codec.split(":")[1]
+        if not level.isdigit() or not 0 <= int(level) <= 9:
+            errAbort("matrixCodec %s: the zlib level must be a number between 0 and 9" % codec)
+        return codec
+    if codec=="lz4":
+        try:
+            import lz4.block
+        except ImportError:
+            logging.warn("matrixCodec is lz4, but the python module lz4 is not installed. Falling back to zlib. Install it with 'pip install lz4'.")
+            return "zlib"
+        return codec
+    errAbort("matrixCodec %s is not valid. Possible values are: zlib, zlib:<level>, raw and lz4" % codec)
+
+def compressRecord(data, codec="zlib"):
+    " compress an exprMatrix.bin record with codec, see checkExprCodec "
+    if codec=="zlib":
+        return zlib.compress(data)
+    elif codec.startswith("zlib:"):
+        return zlib.compress(data, int(codec.split(":")[1]))
+    elif codec=="raw":
+        return data
+    elif codec=="lz4":
+        import lz4.block
+        return lz4.block.compress(data, store_size=True) # first 4 bytes are the uncompressed size
+    else:
+        assert(False) # internal error
+
+def decompressRecord(data, codec="zlib"):
+    " reverse of compressRecord "
+    if codec.startswith("zlib"):
+        return zlib.decompress(data)
+    elif codec=="raw":
+        return data
+    elif codec=="lz4":
+        import lz4.block
+        return lz4.block.decompress(data)
+    else:
+        assert(False) # internal error
+
+# filters that rearrange the numbers of a record before compression, written to dataset.json
+# as matrixFilter. shuffle: first bytes of all numbers, then all second bytes, etc.
+# deltaShuffle: for integer matrices, store the differences between neighboring values, then shuffle.
+exprFilterNames = ["none", "shuffle", "deltaShuffle"]
+
+def checkExprFilter(exprFilter):
+    " make sure that exprFilter is a valid filter for exprMatrix.bin and return it "
+    if exprFilter is None:
+        return "none"
+    if exprFilter not in exprFilterNames:
+        errAbort("matrixFilter %s is not valid. Possible values are: %s" % (exprFilter, ", ".join(exprFilterNames)))
+    if exprFilter!="none" and not numpyLoaded:
+        logging.warn("matrixFilter %s requires numpy, which is not installed. Not using any filter." % exprFilter)
+        return "none"
+    return exprFilter
+
+def filterArr(arr, exprFilter, isValues=True):
+    """ return the bytes of a numpy array of 4-byte numbers, rearranged by exprFilter.
+    Deltas are only used for integer values, not for the indices of sparse vectors, which
+    are already distances. """
+    if exprFilter=="none":
+        return arr.tobytes()
+
+    if exprFilter=="deltaShuffle" and isValues and arr.dtype.kind in "iu":
+        arr = arr.astype("int32")
+        arr[1:] = np.diff(arr) # negative differences wrap around, the client adds them with overflow, too
+
+    return np.ascontiguousarray(arr).view(np.uint8).reshape(-1, 4).T.tobytes()
+
+# lossy storage of the values as 1 or 2 byte codes, written to dataset.json as matrixQuant
+exprQuantNames = ["none", "uint8", "uint16"]
+
+def checkExprQuant(exprQuant):
+    " make sure that exprQuant is a valid value for matrixQuant and return it "
+    if exprQuant is None:
+        return "none"
+    if exprQuant not in exprQuantNames:
+        errAbort("matrixQuant %s is not valid. Possible values are: %s" % (exprQuant, ", ".join(exprQuantNames)))
+    if exprQuant!="none" and not numpyLoaded:
+        logging.warn("matrixQuant %s requires numpy, which is not installed. Values are not quantized." % exprQuant)
+        return "none"
+    return exprQuant
+
+def checkSparseCutoff(sparseCutoff):
+    " make sure that sparseCutoff is a number between 0 and 1 and return it "
+    try:
+        cutoff = float(sparseCutoff)
+    except (TypeError, ValueError):
+        cutoff = None
+    if cutoff is None or not 0 <= cutoff <= 1:
+        errAbort("sparseCutoff %s is not valid. It must be a number between 0 and 1." % sparseCutoff)
+    return cutoff
+
+def quantizeArr(vals, matType, exprQuant):
+    """ return the bytes of a float32 offset, a float32 scale and one uint8 or uint16 code per value,
+    such that value ~= offset + code*scale. The minimum is the offset, so zeros stay zeros, if there are
+    no negative values, and other values do not become zeros. Integers are not changed if their range is smaller than the number of codes. """
+    if exprQuant=="uint8":
+        codeType, maxCode = np.uint8, 255
+    else:
+        codeType, maxCode = np.uint16, 65535
+
+    if len(vals)==0:
+        minVal, maxVal = 0.0, 0.0
+    else:
+        minVal, maxVal = float(np.amin(vals)), float(np.amax(vals))
+
+    if matType!="float" and maxVal-minVal <= maxCode:
+        scale = 1.0
+    else:
+        scale = (maxVal-minVal) / maxCode
+        if scale==0:
+            scale = 1.0
+    codes = np.rint((vals-minVal)/scale).astype(codeType)
+    if minVal==0:
+        # very small values must not become 0, cells with and without expression look different
+        codes[(codes==0) & (vals!=0)] = 1
+    return struct.pack("<ff", minVal, scale) + codes.tobytes()
+
+def packValues(vals, matType, exprFilter="none", exprQuant="none"):
+    " return the bytes of a numpy array with the values of a gene, see filterArr and quantizeArr "
+    if exprQuant=="none":
+        return filterArr(vals, exprFilter)
+    else:
+        return quantizeArr(vals, matType, exprQuant)
+
+def unfilterArr(buf, start, count, exprFilter, isInt, isValues=True):
+    " reverse of filterArr: return the count 4-byte numbers at start in buf as a uint8 array, like unfilterArr() in cbData.js "
+    arr = np.frombuffer(buf, dtype=np.uint8, count=4*count, offset=start)
+    if exprFilter=="none":
+        return arr
+    arr = np.ascontiguousarray(arr.reshape( (4, count) ).T).ravel()
+    if exprFilter=="deltaShuffle" and isValues and isInt:
+        ints = arr.view(np.int32)
+        np.cumsum(ints, dtype=np.int32, out=ints) # wraps around, like the Int32Array of the client
+    return arr
+
+def readValues(buf, start, count, matType, exprFilter, exprQuant):
+    """ return count values at start in buf, as the client reads them, see readValues() in cbData.js.
+    Quantized values are offset + code*scale, rounded for integer matrices. """
+    isInt = (matType!="float")
+    if exprQuant=="none":
+        arr = unfilterArr(buf, start, count, exprFilter, isInt)
+        if isInt:
+            return arr.view(np.int32)
+        return arr.view(np.float32)
+
+    offset, scale = struct.unpack_from("<ff", buf, start)
+    if exprQuant=="uint8":
+        codes = np.frombuffer(buf, dtype=np.uint8, count=count, offset=start+8)
+    else:
+        codes = np.frombuffer(buf, dtype="<u2", count=count, offset=start+8)
+    vals = offset + codes*scale
+    if isInt:
+        return jsRound(vals).astype(np.int32)
+    return vals.astype(np.float32)
+
+def exprDecode(rec, cellCount, matType, codec="zlib", exprFilter="none", exprQuant="none"):
+    " reverse of exprEncode: return the gene description and the values of a record of exprMatrix.bin, like decodeExprRecord() in cbData.js "
+    buf = decompressRecord(rec, codec)
+    descLen = struct.unpack_from("<H", buf, 0)[0]
+    isSparse = ((descLen & 0x8000) != 0)
+    descLen = descLen & 0x7fff
+    geneDesc = buf[2:2+descLen].decode("ascii")
+
+    start = 2+descLen
+    if not isSparse:
+        return geneDesc, readValues(buf, start, cellCount, matType, exprFilter, exprQuant)
+
+    nzCount = struct.unpack_from("<I", buf, start)[0]
+    start += 4
+    cellIdx = np.cumsum(unfilterArr(buf, start, nzCount, exprFilter, True, False).view(np.uint32))
+    start += 4*nzCount
+    vals = readValues(buf, start, nzCount, matType, exprFilter, exprQuant)
+    return geneDesc, rowToDense(cellIdx, vals, cellCount)
+
+def checkDiscretMatrix(discretize):
+    " return True if discretMat.bin can be written "
+    if discretize and not numpyLoaded:
+        logging.warn("discretMatrix requires numpy, which is not installed. Not writing discretMat.bin.")
+        return False
+    return bool(discretize)
+
+def checkCellMatrix(cellMatrix):
+    " return True if cellMatrix.bin can be written "
+    if cellMatrix and not numpyLoaded:
+        logging.warn("cellMatrix requires numpy, which is not installed. Not writing cellMatrix.bin.")
+        return False
+    return bool(cellMatrix)
+
+def checkClusterAggr(inConf):
+    " return the meta field for clusterAggr.bin or None if it is not written "
+    if not inConf.get("clusterAggr", False):
+        return None
+    field = inConf.get("clusterField", inConf.get("labelField"))
+    if field is None:
+        logging.warn("clusterAggr is set, but there is no clusterField or labelField. Not writing clusterAggr.bin.")
+        return None
+    if not numpyLoaded:
+        logging.warn("clusterAggr requires numpy, which is not installed. Not writing clusterAggr.bin.")
+        return None
+    return field
+
+def exprRecord(geneDesc, exprStr, isSparse=False, codec="zlib"):
+    " build and compress an exprMatrix.bin record from the gene description and the packed values "
+    geneDesc = str(geneDesc) # make sure no unicode
+    descLen = len(geneDesc)
+    if isSparse:
+        descLen = descLen | 0x8000
+    geneIdLen = struct.pack("<H", descLen)
+
+    if isPy3:
+        geneStr = geneIdLen+bytes(geneDesc, encoding="ascii")+exprStr
+    else:
+        geneStr = geneIdLen+geneDesc+exprStr
+
+    geneCompr = compressRecord(geneStr, codec)
+
+    fact = float(len(geneCompr)) / len(geneStr)
+    logging.debug("raw - compression factor of %s: %f, before %d, after %d"% (geneDesc, fact, len(geneStr), len(geneCompr)))
+    return geneCompr
+
+def sparseExprStr(cellIdx, vals, matType, exprFilter="none", exprQuant="none"):
+    """ pack the non-zero values of a gene: their count, the distances between the sorted cell
+    indices (compress better than the indices) and the values. See packValues for exprFilter and exprQuant. """
+    if matType=="float":
+        vals = vals.astype("float32")
+    else:
+        vals = vals.astype("int32")
+    cellDiffs = cellIdx.astype("uint32")
+    cellDiffs[1:] = cellIdx[1:] - cellIdx[:-1]
+    return struct.pack("<I", len(cellIdx)) + filterArr(cellDiffs, exprFilter, False) + packValues(vals, matType, exprFilter, exprQuant)
+
+def exprEncode(geneDesc, exprArr, matType, sparseCutoff=0, codec="zlib", exprFilter="none", exprQuant="none"):
     """ convert an array of numbers of type matType (int or float) to a compressed string of
     floats
     The format of a record is:
     - 2 bytes: length of descStr, e.g. gene identifier or else
     - len(descStr) bytes: the descriptive string descStr
     - array of n 4-byte floats (n = number of cells)
+    If the share of non-zero values is below sparseCutoff, the highest bit of the length is set
+    and instead of the array, there is a sparse vector:
+    - 4 bytes: number k of non-zero values
+    - array of k 4-byte distances to the previous non-zero cell index (the first is the index)
+    - array of k 4-byte values
+    If exprQuant is uint8 or uint16, the arrays of values are replaced by 4-byte float offset,
+    4-byte float scale and an array of 1 or 2-byte codes, see quantizeArr.
+    The 4-byte arrays are rearranged with exprFilter (see filterArr) and the record is compressed
+    with codec, see compressRecord.
     """
-    geneDesc = str(geneDesc) # make sure no unicode
-    geneIdLen = struct.pack("<H", len(geneDesc))
-
     # on cortex-dev, numpy was around 30% faster. Not a huge difference.
     if numpyLoaded:
-        exprStr = exprArr.tobytes()
+        if sparseCutoff > 0:
+            cellIdx = np.flatnonzero(exprArr)
+            if len(cellIdx) < sparseCutoff*len(exprArr):
+                return exprEncodeSparse(geneDesc, cellIdx, exprArr[cellIdx], len(exprArr), matType, codec=codec, exprFilter=exprFilter, exprQuant=exprQuant)
+
+        exprStr = packValues(exprArr, matType, exprFilter, exprQuant)
         minVal = np.amin(exprArr)
     else:
         if matType=="float":
@@ -1824,100 +2763,333 @@ def exprEncode(geneDesc, exprArr, matType):
         exprStr = array.array(arrType, exprArr).tostring()
         minVal = min(exprArr)
 
-    if isPy3:
-        geneStr = geneIdLen+bytes(geneDesc, encoding="ascii")+exprStr
-    else:
-        geneStr = geneIdLen+geneDesc+exprStr
+    return exprRecord(geneDesc, exprStr, codec=codec), minVal
 
-    geneCompr = zlib.compress(geneStr)
-
-    fact = float(len(geneCompr)) / len(geneStr)
-    logging.debug("raw - compression factor of %s: %f, before %d, after %d"% (geneDesc, fact, len(geneStr), len(geneCompr)))
-    return geneCompr, minVal
+def exprEncodeSparse(geneDesc, cellIdx, vals, cellCount, matType, sparseCutoff=1.0, codec="zlib", exprFilter="none", exprQuant="none"):
+    """ like exprEncode, but for a gene given as numpy arrays with the indices and values of its
+    non-zero cells, e.g. a row of a CSR matrix. This avoids creating a dense array, unless more than
+    sparseCutoff of the cells are not zero. """
+    if len(vals) >= sparseCutoff*cellCount:
+        if matType=="float":
+            exprArr = np.zeros(cellCount, dtype="float32")
+        else:
+            exprArr = np.zeros(cellCount, dtype="int32")
+        exprArr[cellIdx] = vals
+        return exprEncode(geneDesc, exprArr, matType, codec=codec, exprFilter=exprFilter, exprQuant=exprQuant)
+
+    if len(vals)==0:
+        minVal = 0
+    elif len(vals) < cellCount:
+        minVal = min(0, np.amin(vals))
+    else:
+        minVal = np.amin(vals)
+
+    exprStr = sparseExprStr(cellIdx, vals, matType, exprFilter, exprQuant)
+    return exprRecord(geneDesc, exprStr, isSparse=True, codec=codec), minVal
+
+def exprEncodeBatch(args):
+    """ encode a list of (geneId, sym, exprArr) rows with exprEncode. Runs in a worker process.
+    args is a tuple (rows, opts), opts is a dict with the matrix settings of matrixToBin and 'matType',
+    missing settings have their defaults from matrixOptDefaults.
+    exprArr can also be a tuple (cellIdx, values, cellCount) for sparse rows.
+    Returns a list of (sym, compressed record, minVal, discretized record, cluster aggregates) in
+    the same order. The discretized record is None if discretMatrix is not set. The cluster aggregates
+    are None if opts has no 'aggr', otherwise it is a tuple (list of cell index lists, withMedian), see
+    clusterAggrRecords. """
+    rows, opts = args
+    opts = dict(matrixOptDefaults, **opts)
+    matType = opts["matType"]
+    sparseCutoff = opts["sparseCutoff"]
+    codec, exprFilter, exprQuant = opts["matrixCodec"], opts["matrixFilter"], opts["matrixQuant"]
+    discretize = opts["discretMatrix"]
+    aggr = opts.get("aggr")
+    res = []
+    for geneId, sym, exprArr in rows:
+        if type(exprArr)==tuple:
+            cellIdx, vals, cellCount = exprArr
+            exprStr, minVal = exprEncodeSparse(geneId, cellIdx, vals, cellCount, matType, sparseCutoff, codec, exprFilter, exprQuant)
+        else:
+            exprStr, minVal = exprEncode(geneId, exprArr, matType, sparseCutoff, codec, exprFilter, exprQuant)
+
+        res.append( [sym, exprStr, minVal, None, None] )
+
+    allSparse = all([type(exprArr)==tuple for geneId, sym, exprArr in rows])
+    denseMat = None
+    if len(rows)!=0 and (aggr is not None or (discretize and not allSparse)):
+        denseMat = np.array([rowToDense(*exprArr) if type(exprArr)==tuple else exprArr for geneId, sym, exprArr in rows])
+
+    if discretize and len(rows)!=0:
+        # the bins have to be exactly the ones of the client, so bin the values as the client reads them:
+        # 4-byte numbers or, if they are quantized, the decoded values
+        valType = np.float32 if matType=="float" else np.int32
+        if exprQuant!="none":
+            exprArr = rows[0][2]
+            cellCount = exprArr[2] if type(exprArr)==tuple else len(exprArr)
+            digMat, allBins = digitizeBlock(np.array([exprDecode(r[1], cellCount, matType, codec, exprFilter, exprQuant)[1] for r in res]))
+        elif allSparse:
+            # bin all genes of the batch at once: sparse rows as a CSR matrix, otherwise as a 2D array
+            indptr = [0]
+            for geneId, sym, (cellIdx, vals, cellCount) in rows:
+                indptr.append(indptr[-1]+len(cellIdx))
+            indices = np.concatenate([exprArr[0] for geneId, sym, exprArr in rows])
+            data = np.concatenate([exprArr[1] for geneId, sym, exprArr in rows]).astype(valType)
+            digMat, allBins = digitizeBlock( (indptr, indices, data), cellCount)
+        else:
+            digMat, allBins = digitizeBlock(denseMat.astype(valType))
+
+        for i, (geneId, sym, exprArr) in enumerate(rows):
+            res[i][3] = discretRecord(geneId, digMat[i], allBins[i], codec)
+
+    if aggr is not None and len(rows)!=0:
+        cellIdxLists, withMedian = aggr
+        aggrMat = clusterAggrRecords(denseMat, cellIdxLists, withMedian)
+        for i in range(len(rows)):
+            res[i][4] = aggrMat[i].tobytes()
+
+    return [tuple(r) for r in res]
+
+def iterPoolOrdered(func, argIter, workers):
+    """ run func on all elements of argIter and yield the results in input order. If workers > 1,
+    use a pool of worker processes, with at most 2*workers jobs in flight, so the input iterator is
+    not read much faster than the results are consumed """
+    if workers is None or workers <= 1:
+        for args in argIter:
+            yield func(args)
+        return
 
-def matrixToBin(fname, geneToSym, binFname, jsonFname, discretBinFname, discretJsonFname, metaSampleNames, matType=None):
-    """ convert gene expression vectors to vectors of deciles
-        and make json gene symbol -> (file offset, line length)
+    import multiprocessing
+    pool = multiprocessing.Pool(workers)
+    pending = []
+    try:
+        for args in argIter:
+            pending.append(pool.apply_async(func, (args,)))
+            if len(pending) >= 2*workers:
+                yield pending.pop(0).get()
+        while len(pending)!=0:
+            yield pending.pop(0).get()
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+def getWorkerCount(inConf):
+    " return number of worker processes to use, from the cellbrowser.conf setting 'workers' or the --workers option "
+    workers = inConf.get("workers", 1)
+    if workers in [0, "auto"]:
+        import multiprocessing
+        workers = multiprocessing.cpu_count()
+    return int(workers)
+
+def matrixToBin(fname, geneToSym, outDir, metaSampleNames, opts, matType=None, trimFname=None, useCache=True):
+    """ convert gene expression vectors to exprMatrix.bin/.json, discretMat.bin/.json and
+        geneSearch.bin in outDir. opts is a dict with the settings in matrixOptDefaults, see
+        getMatrixOpts, and optionally these ones:
+        If 'workers' > 1, the rows are compressed in parallel, the output files are identical.
+        'mtxChunkSize' is the number of entries read at a time from .mtx files, their temporary
+        arrays go into 'tmpDir' (default: the system's temp directory).
+        useCache=False does not use the matrix cache for tsv files.
+        If trimFname is set, the rows are also written to it as a .tsv.gz, with only the samples
+        in metaSampleNames, so the matrix is parsed only once, see copyMatrixTrim.
+        Genes with less than sparseCutoff non-zero values are stored as sparse vectors.
+        The records are compressed with matrixCodec, see compressRecord, after matrixFilter, see filterArr.
+        matrixQuant stores the values in less bytes, see quantizeArr.
+        If discretMatrix is set, the deciles are written to discretMat.bin, see discretRecord.
+        If cellMatrix is set, the matrix is also written in cell-major order, see CellMatrixWriter.
+        If clusterAggr is set, it is a field of outDir/meta.tsv and the mean, fraction of non-zero
+        cells and deciles of every gene and cluster are written to clusterAggr.bin, see writeClusterAggrIndex.
     """
+    opts = dict(matrixOptDefaults, **opts)
+    workers = opts.get("workers", 1)
+    codec = opts["matrixCodec"]
+    aggrField = opts["clusterAggr"]
+    aggrMedian = opts["clusterAggrMedian"]
+
+    binFname = join(outDir, "exprMatrix.bin")
+    jsonFname = join(outDir, "exprMatrix.json")
+    discretBinFname = join(outDir, "discretMat.bin")
+    discretJsonFname = join(outDir, "discretMat.json")
+    searchFname = join(outDir, "geneSearch.bin")
+    aggrBinFname = join(outDir, "clusterAggr.bin")
+
     logging.info("converting %s to %s and writing index to %s, type %s" % (fname, binFname, jsonFname, matType))
     #logging.info("Shall expression values be log-transformed when transforming to deciles? -> %s" % (not skipLog))
     logging.info("Compressing gene expression vectors...")
 
     tmpFname = binFname + ".tmp"
-    ofh = open(tmpFname, "wb")
-
     discretTmp = discretBinFname + ".tmp"
-    discretOfh = open(discretTmp, "w")
-
-    discretIndex = {}
-    exprIndex = {}
+    ofh, discretOfh, matReader, trimOfh, aggrOfh, cellWriter, encIter = None, None, None, None, None, None, None
+    try:
+        ofh = open(tmpFname, "wb")
+        discretOfh = open(discretTmp, "wb")
 
-    skipIds = 0
-    highCount = 0
+        discretIndex = {}
+        exprIndex = {}
+        searchGenes = [] # (sym, geneId) in the order of exprMatrix.bin
 
-    if isMtx(fname):
-        matReader = MatrixMtxReader(geneToSym)
-    else:
-        matReader = MatrixTsvReader(geneToSym)
+        skipIds = 0
+        highCount = 0
 
-    matReader.open(fname, matType=matType)
+        if isMtx(fname):
+            matReader = MatrixMtxReader(geneToSym, chunkSize=opts.get("mtxChunkSize"), tmpDir=opts.get("tmpDir"))
+        else:
+            matReader = MatrixTsvReader(geneToSym, useCache=useCache)
 
+        matReader.open(fname, matType=matType)
 
-    if matType is None:
-        matType = matReader.getMatType()
 
-    sampleNames = matReader.getSampleNames()
+        if matType is None:
+            matType = matReader.getMatType()
+
+        sampleNames = matReader.getSampleNames()
+
+        # filter matrix: find the indices of sample names that are in the matrix
+        metaSet = set(metaSampleNames)
+        matrixSet = set(sampleNames)
+        idxList = None
+        if len(matrixSet - metaSet)!=0:
+            idxList = []
+            for i in range(len(sampleNames)):
+                sampleName = sampleNames[i]
+                if sampleName in metaSet:
+                    idxList.append(i)
+            if numpyLoaded:
+                idxList = np.array(idxList)
+            logging.debug("Filtering %d matrix samples down to %d" % (len(matrixSet), len(idxList)))
+        assert(len(metaSet-matrixSet)==0) # at this stage, samples with meta but not in matrix cannot happen
 
-    # filter matrix: find the indices of sample names that are in the matrix
-    metaSet = set(metaSampleNames)
-    matrixSet = set(sampleNames)
-    idxList = None
-    if len(matrixSet - metaSet)!=0:
-        idxList = []
-        for i in range(len(sampleNames)):
-            sampleName = sampleNames[i]
-            if sampleName in metaSet:
-                idxList.append(i)
-        if numpyLoaded:
-            idxList = np.array(idxList)
-        logging.debug("Filtering %d matrix samples down to %d" % (len(matrixSet), len(idxList)))
-    assert(len(metaSet-matrixSet)==0) # at this stage, samples with meta but not in matrix cannot happen
-
-    symCounts = defaultdict(int)
-    geneCount = 0
-    allMin = 99999999
-    for geneId, sym, exprArr in matReader.iterRows():
-        geneCount += 1
-
-        symCounts[sym]+=1
-        if symCounts[sym] > 1000:
-            errAbort("The gene symbol %s appears more than 1000 times in the expression matrix. "
-                    "Are you sure that the matrix is in the right format? Each gene should be on a row. "
-                    "The gene ID must be in the first column and "
-                    "can optionally include the gene symbol, e.g. 'ENSG00000142168|SOD1'. " % sym)
-
-        #if maxVal(exprArr) > 200:
-            #highCount += 1
-
-        logging.debug("Processing %s, symbol %s" % (geneId, sym))
-        # filter the row down to the meta-samples
+        # rows are sent to the workers in batches of around 10 million values
         if idxList is not None:
-            if numpyLoaded:
-                exprArr = exprArr[idxList]
+            cellCount = len(idxList)
+        else:
+            cellCount = len(sampleNames)
+        batchSize = max(1, min(1000, 10000000 // max(1, cellCount)))
+        if workers > 1:
+            logging.info("Compressing with %d worker processes, %d genes per batch" % (workers, batchSize))
+
+        symCounts = defaultdict(int)
+
+        if trimFname is not None:
+            assert(not isMtx(fname))
+            logging.info("Writing trimmed copy of the matrix to %s, keeping %d columns with sample ID in meta" % (trimFname, cellCount))
+            trimOfh = GzipPipeWriter(trimFname)
+            if idxList is None:
+                trimSampleNames = sampleNames
             else:
-                exprArr = [exprArr[i] for i in idxList]
+                trimSampleNames = [sampleNames[i] for i in idxList]
+            trimOfh.write("gene\t")
+            trimOfh.write("\t".join(trimSampleNames))
+            trimOfh.write("\n")
+
+        aggr = None
+        if aggrField is not None:
+            if idxList is None:
+                outSampleNames = sampleNames
+            else:
+                outSampleNames = [sampleNames[i] for i in idxList]
+            aggrLabels = parseCellColumn(join(outDir, "meta.tsv"), aggrField)
+            clusterNames, cellIdxLists = labelsToCellLists([aggrLabels[name] for name in outSampleNames])
+            aggr = (cellIdxLists, aggrMedian)
+            aggrOfh = open(aggrBinFname+".tmp", "wb")
+            aggrGenes = []
+
+        if opts["cellMatrix"]:
+            cellWriter = CellMatrixWriter(join(outDir, "cellMatrix.bin"), join(outDir, "cellMatrix.json"), cellCount, matType, codec=codec)
+
+        # the settings for the workers, see exprEncodeBatch
+        encOpts = dict(opts)
+        encOpts["matType"] = matType
+        encOpts["aggr"] = aggr
+
+        if isMtx(fname) and numpyLoaded:
+            # the rows come straight from the sparse matrix, already filtered
+            rowIter = matReader.iterRowsSparse(idxList)
+            idxList = None
+        else:
+            rowIter = matReader.iterRows()
+
+        def writeTrimRows(batch):
+            " write a batch of rows to the trimmed copy and the cell-major matrix "
+            if trimOfh is not None:
+                writeMatrixRows(trimOfh, [geneId+"|"+sym for geneId, sym, exprArr in batch], [exprArr for geneId, sym, exprArr in batch])
+            if cellWriter is not None:
+                cellWriter.addRows(batch)
+
+        def iterBatches():
+            " read the matrix and yield filtered rows in batches "
+            batch = []
+            for geneId, sym, exprArr in rowIter:
+                symCounts[sym]+=1
+                if symCounts[sym] > 1000:
+                    errAbort("The gene symbol %s appears more than 1000 times in the expression matrix. "
+                            "Are you sure that the matrix is in the right format? Each gene should be on a row. "
+                            "The gene ID must be in the first column and "
+                            "can optionally include the gene symbol, e.g. 'ENSG00000142168|SOD1'. " % sym)
+
+                #if maxVal(exprArr) > 200:
+                    #highCount += 1
+
+                logging.debug("Processing %s, symbol %s" % (geneId, sym))
+                # filter the row down to the meta-samples
+                if idxList is not None:
+                    if numpyLoaded:
+                        exprArr = exprArr[idxList]
+                    else:
+                        exprArr = [exprArr[i] for i in idxList]
+
+                batch.append( (geneId, sym, exprArr) )
+                searchGenes.append( (sym, geneId) )
+                if len(batch)==batchSize:
+                    writeTrimRows(batch)
+                    yield batch, encOpts
+                    batch = []
+            if len(batch)!=0:
+                writeTrimRows(batch)
+                yield batch, encOpts
+
+        # the batches come back in input order, so the output does not depend on the number of workers
+        geneCount = 0
+        allMin = 99999999
+        encIter = iterPoolOrdered(exprEncodeBatch, iterBatches(), workers)
+        for encRows in encIter:
+            for sym, exprStr, minVal, discretStr, aggrStr in encRows:
+                geneCount += 1
+                exprIndex[sym] = (ofh.tell(), len(exprStr))
+                ofh.write(exprStr)
 
-        exprStr, minVal = exprEncode(geneId, exprArr, matType)
-        exprIndex[sym] = (ofh.tell(), len(exprStr))
-        ofh.write(exprStr)
+                if discretStr is not None:
+                    discretIndex[sym] = (discretOfh.tell(), len(discretStr))
+                    discretOfh.write(discretStr)
 
-        if geneCount % 1000 == 0:
-            logging.info("Wrote compressed expression values for %d genes" % geneCount)
+                if aggrStr is not None:
+                    aggrOfh.write(aggrStr)
+                    aggrGenes.append(sym)
 
-        allMin = min(allMin, minVal)
+                if geneCount % 1000 == 0:
+                    logging.info("Wrote compressed expression values for %d genes" % geneCount)
 
-    discretOfh.close()
-    ofh.close()
+                allMin = min(allMin, minVal)
+
+        discretOfh.close()
+        ofh.close()
+        matReader.close()
+        if trimOfh is not None:
+            trimOfh.close()
+    except:
+        # close and remove everything, e.g. convertExprMatrix tries again if the matrix type was wrong
+        if encIter is not None:
+            encIter.close() # stops the worker processes
+        if matReader is not None:
+            matReader.close()
+        if trimOfh is not None:
+            trimOfh.abort()
+        if cellWriter is not None:
+            cellWriter.abort()
+        for fh, fname in [(ofh, tmpFname), (discretOfh, discretTmp), (aggrOfh, aggrBinFname+".tmp")]:
+            if fh is not None:
+                fh.close()
+                if isfile(fname):
+                    os.remove(fname)
+        raise
 
     #if highCount==0:
         #logging.warn("No single value in the matrix is > 200. It looks like this matrix has been log'ed before. Our recommendation for visual inspection is to not transform matrices, but that is of course up to you.")
@@ -1933,19 +3105,432 @@ def matrixToBin(fname, geneToSym, binFname, jsonFname, discretBinFname, discretJ
     exprIndex["_range"] = (int(allMin),0)
     logging.info("Global minimum in matrix is: %f" % allMin)
 
-    jsonOfh = open(jsonFname, "w")
-    json.dump(exprIndex, jsonOfh)
-    jsonOfh.close()
-
-    jsonOfh = open(discretJsonFname, "w")
-    json.dump(discretIndex, jsonOfh)
-    jsonOfh.close()
+    writeExprIndex(exprIndex, jsonFname)
+    writeExprIndex(discretIndex, discretJsonFname)
+    writeGeneSearch(searchGenes, searchFname, trigrams=opts["geneSearchTrigrams"])
+    if cellWriter is not None:
+        cellWriter.finish()
+    if aggr is not None:
+        aggrOfh.close()
+        writeClusterAggrIndex(join(outDir, "clusterAggr.json"), aggrField, clusterNames, cellIdxLists, aggrMedian, aggrGenes)
+        os.rename(aggrBinFname+".tmp", aggrBinFname)
 
     os.rename(tmpFname, binFname)
     os.rename(discretTmp, discretBinFname)
 
     return matType
 
+# matrices with more genes get a binary gene index, see writeGeneIndex
+geneIndexJsonMax = 50000
+
+def geneIndexFname(jsonFname):
+    " return the name of the binary gene index that replaces the gene index jsonFname "
+    assert(jsonFname.endswith(".json"))
+    return jsonFname[:-len(".json")]+".idx"
+
+def writeExprIndex(exprIndex, jsonFname):
+    """ write the dict gene -> (offset, length) to jsonFname or, for big matrices, to the binary
+    index geneIndexFname(jsonFname). The other file is removed, so there is only ever one of them. """
+    binFname = geneIndexFname(jsonFname)
+    if len(exprIndex) > geneIndexJsonMax:
+        logging.info("%d genes in matrix, writing binary gene index %s" % (len(exprIndex), binFname))
+        writeGeneIndex(exprIndex, binFname)
+        oldFname = jsonFname
+    else:
+        jsonOfh = open(jsonFname, "w")
+        json.dump(exprIndex, jsonOfh)
+        jsonOfh.close()
+        oldFname = binFname
+
+    if isfile(oldFname):
+        os.remove(oldFname)
+
+def readExprIndex(jsonFname):
+    " read the gene index written by writeExprIndex. Returns a dict gene -> (offset, length) "
+    binFname = geneIndexFname(jsonFname)
+    if isfile(binFname):
+        return readGeneIndex(binFname)
+    return readJson(jsonFname)
+
+def writeGeneIndex(exprIndex, fname, withPrefix=True):
+    """ write the dict gene -> (offset, length) from matrixToBin as a binary file, so the browser
+    does not have to parse a huge JSON file. exprIndex["_range"] is the minimum of the matrix.
+    All numbers are little-endian, the sections start at multiples of 4 bytes:
+    - header: "CBGI", uint16 version, uint16 flags (1 = has prefix section), uint32 geneCount n,
+      int32 minimum of the matrix, uint32 size of string table, uint32 reserved, total 24 bytes
+    - n uint64: offsets of the records in exprMatrix.bin
+    - n uint32: lengths of the records
+    - n+1 uint32: start of every gene name in the string table, the last one is its end
+    - with a prefix section: n uint32, the gene indices, sorted by lowercase name
+    - string table: all gene names, utf8, without separators
+    The genes are sorted by their utf8 bytes, so a name can be found with a binary search.
+    """
+    exprIndex = dict(exprIndex)
+    matrixMin = exprIndex.pop("_range", (0,0))[0]
+
+    names = sorted(exprIndex, key=lambda x: x.encode("utf8"))
+    nameStrs = [x.encode("utf8") for x in names]
+    strStarts = [0]
+    for nameStr in nameStrs:
+        strStarts.append(strStarts[-1]+len(nameStr))
+
+    n = len(names)
+    flags = 0
+    if withPrefix:
+        flags = 1
+
+    ofh = open(fname+".tmp", "wb")
+    ofh.write(struct.pack("<4sHHIiII", b"CBGI", 1, flags, n, int(matrixMin), strStarts[-1], 0))
+    ofh.write(struct.pack("<%dQ" % n, *[exprIndex[x][0] for x in names]))
+    ofh.write(struct.pack("<%dI" % n, *[exprIndex[x][1] for x in names]))
+    ofh.write(struct.pack("<%dI" % (n+1), *strStarts))
+    if withPrefix:
+        lowerOrder = sorted(range(n), key=lambda i: names[i].lower().encode("utf8"))
+        ofh.write(struct.pack("<%dI" % n, *lowerOrder))
+    ofh.write(b"".join(nameStrs))
+    ofh.close()
+    os.rename(fname+".tmp", fname)
+
+def readGeneIndex(fname):
+    """ read a binary gene index written by writeGeneIndex. Returns the same dict as the JSON file,
+    gene -> (offset, length) and "_range" -> (minimum, 0) """
+    data = open(fname, "rb").read()
+    magic, version, flags, n, matrixMin, strSize, reserved = struct.unpack_from("<4sHHIiII", data, 0)
+    if magic!=b"CBGI":
+        errAbort("%s is not a binary gene index" % fname)
+
+    pos = 24
+    offsets = struct.unpack_from("<%dQ" % n, data, pos)
+    pos += 8*n
+    lengths = struct.unpack_from("<%dI" % n, data, pos)
+    pos += 4*n
+    strStarts = struct.unpack_from("<%dI" % (n+1), data, pos)
+    pos += 4*(n+1)
+    if flags & 1:
+        pos += 4*n
+    strData = data[pos:pos+strSize]
+
+    exprIndex = {}
+    for i in range(n):
+        name = strData[strStarts[i]:strStarts[i+1]].decode("utf8")
+        exprIndex[name] = (offsets[i], lengths[i])
+    exprIndex["_range"] = (matrixMin, 0)
+    return exprIndex
+
+def geneSearchKeys(sym, geneId):
+    " return the lowercase strings that can be searched for a gene: its symbol and its ID "
+    keys = [sym.lower()]
+    if geneId.lower() not in keys:
+        keys.append(geneId.lower())
+    return keys
+
+def geneTrigrams(key):
+    " return the set of all three-letter substrings of key "
+    return set([key[i:i+3] for i in range(len(key)-2)])
+
+def writeGeneSearch(genes, fname, trigrams=False, pageSize=4096):
+    """ write a search index for the gene box of the browser. genes is a list of (symbol, geneId), the
+    record number of a gene is its position in the list. All numbers are uint32, little-endian.
+    - header: "CBGS", uint16 version, uint16 flags (1 = has trigrams), record count, key count,
+      page count, size of page directory, size of pages, size of trigram section, total 32 bytes
+    - page directory: page count+1 start offsets of the pages, relative to the first page, then
+      the first key of every page, utf8, separated by newlines
+    - pages: lines "key<tab>symbol<tab>geneId<tab>recordNumber", sorted by the utf8 bytes of the key.
+      The keys are the lowercase symbol and the lowercase geneId. A page is about pageSize bytes
+      and ends with a full line, so a prefix can be found with a single range request.
+    - trigram section (optional): trigram count t, posting count p, size of the trigram names,
+      size of the record names, t+1 starts of the postings of every trigram, p record numbers,
+      the sorted trigrams separated by newlines, then "symbol<tab>geneId" for every record,
+      separated by newlines.
+    """
+    entries = []
+    for recIdx, (sym, geneId) in enumerate(genes):
+        for key in geneSearchKeys(sym, geneId):
+            entries.append( (key.encode("utf8"), sym, geneId, recIdx) )
+    entries.sort(key=lambda x: (x[0], x[3]))
+
+    # cut the lines into pages
+    pageStarts = [0]
+    firstKeys = []
+    pages = []
+    pageLen = 0
+    for key, sym, geneId, recIdx in entries:
+        line = key + ("\t%s\t%s\t%d\n" % (sym, geneId, recIdx)).encode("utf8")
+        if pageLen==0:
+            firstKeys.append(key)
+        pages.append(line)
+        pageLen += len(line)
+        if pageLen >= pageSize:
+            pageStarts.append(pageStarts[-1]+pageLen)
+            pageLen = 0
+    if pageLen!=0:
+        pageStarts.append(pageStarts[-1]+pageLen)
+    pageData = b"".join(pages)
+
+    pageDir = struct.pack("<%dI" % len(pageStarts), *pageStarts) + b"\n".join(firstKeys)
+    # the sections start at multiples of 4 bytes
+    pageDir += b"\n" * (-len(pageDir) % 4)
+    pageData += b"\n" * (-len(pageData) % 4)
+
+    triData = b""
+    flags = 0
+    if trigrams:
+        flags = 1
+        postings = defaultdict(set)
+        for recIdx, (sym, geneId) in enumerate(genes):
+            for key in geneSearchKeys(sym, geneId):
+                for tri in geneTrigrams(key):
+                    postings[tri].add(recIdx)
+        triNames = sorted(postings, key=lambda x: x.encode("utf8"))
+        triStarts = [0]
+        allRecs = []
+        for tri in triNames:
+            allRecs.extend(sorted(postings[tri]))
+            triStarts.append(len(allRecs))
+        triText = "\n".join(triNames).encode("utf8")
+        recText = "\n".join(["%s\t%s" % (sym, geneId) for sym, geneId in genes]).encode("utf8")
+        triData = struct.pack("<4I", len(triNames), len(allRecs), len(triText), len(recText)) \
+                + struct.pack("<%dI" % len(triStarts), *triStarts) \
+                + struct.pack("<%dI" % len(allRecs), *allRecs) + triText + recText
+
+    ofh = open(fname+".tmp", "wb")
+    ofh.write(struct.pack("<4sHHIIIIII", b"CBGS", 1, flags, len(genes), len(entries), len(firstKeys), \
+        len(pageDir), len(pageData), len(triData)))
+    ofh.write(pageDir)
+    ofh.write(pageData)
+    ofh.write(triData)
+    ofh.close()
+    os.rename(fname+".tmp", fname)
+    logging.info("Wrote gene search index %s, %d keys in %d pages" % (fname, len(entries), len(firstKeys)))
+
+def geneSearchDirSize(fname):
+    " return the size of the header and the page directory of a gene search index, the browser loads these first "
+    magic, version, flags, recCount, keyCount, pageCount, dirSize, pagesSize, triSize = \
+        struct.unpack("<4sHHIIIIII", open(fname, "rb").read(32))
+    return 32+dirSize
+
+def searchGeneSearch(fname, query, maxCount=100):
+    """ search the gene search index written by writeGeneSearch for a lowercase query. Returns a list of
+    (symbol, geneId) of the genes whose symbol or ID start with query. If there are none and the
+    index has trigrams, the genes that contain query. The browser does the same, see cbData.js. """
+    data = open(fname, "rb").read()
+    magic, version, flags, recCount, keyCount, pageCount, dirSize, pagesSize, triSize = \
+        struct.unpack_from("<4sHHIIIIII", data, 0)
+    if magic!=b"CBGS":
+        errAbort("%s is not a gene search index" % fname)
+
+    pageStarts = struct.unpack_from("<%dI" % (pageCount+1), data, 32)
+    firstKeys = data[32+4*(pageCount+1):32+dirSize].rstrip(b"\n").split(b"\n")
+    pageOffset = 32+dirSize
+
+    # the prefix can only be on the last page that starts with a smaller key and the following ones
+    queryKey = query.encode("utf8")
+    startPage = max(0, bisect.bisect_left(firstKeys, queryKey)-1)
+    endPage = startPage+1
+    while endPage < pageCount and firstKeys[endPage].startswith(queryKey):
+        endPage += 1
+
+    res = []
+    doneRecs = set()
+    pageText = data[pageOffset+pageStarts[startPage]:pageOffset+pageStarts[endPage]].decode("utf8")
+    for line in pageText.splitlines():
+        if line=="":
+            continue
+        key, sym, geneId, recIdx = line.split("\t")
+        if key.startswith(query) and recIdx not in doneRecs:
+            doneRecs.add(recIdx)
+            res.append( (sym, geneId) )
+    if len(res)!=0 or not (flags & 1) or len(query) < 3:
+        return res[:maxCount]
+
+    pos = pageOffset+pagesSize
+    triCount, postCount, triTextSize, recTextSize = struct.unpack_from("<4I", data, pos)
+    pos += 16
+    triStarts = struct.unpack_from("<%dI" % (triCount+1), data, pos)
+    pos += 4*(triCount+1)
+    postings = struct.unpack_from("<%dI" % postCount, data, pos)
+    pos += 4*postCount
+    triNames = data[pos:pos+triTextSize].decode("utf8").split("\n")
+    pos += triTextSize
+    recNames = data[pos:pos+recTextSize].decode("utf8").split("\n")
+
+    triIdx = dict([(tri, i) for i, tri in enumerate(triNames)])
+    recs = None
+    for tri in geneTrigrams(query):
+        if tri not in triIdx:
+            return []
+        i = triIdx[tri]
+        triRecs = set(postings[triStarts[i]:triStarts[i+1]])
+        if recs is None:
+            recs = triRecs
+        else:
+            recs = recs & triRecs
+
+    for recIdx in sorted(recs):
+        sym, geneId = recNames[recIdx].split("\t")
+        if any([query in key for key in geneSearchKeys(sym, geneId)]):
+            res.append( (sym, geneId) )
+    return res[:maxCount]
+
+class CellMatrixWriter:
+    """ write the expression matrix in cell-major order to cellMatrix.bin, so the values of a single
+    cell can be read with one range request. The rows are added gene by gene. They are collected
+    until there are spillSize non-zero values, sorted by cell and written to a temporary file, one
+    chunk per block of cells. finish() then puts the chunks of every block together, so memory
+    stays bounded. Requires numpy. The format of a block, before compression with codec:
+    - uint32: number of cells c in the block, uint32: number of values n
+    - c+1 uint32: start of the values of every cell
+    - n uint32: the gene numbers, in the order of exprMatrix.bin
+    - n uint32 or float32: the values
+    The json file has the offset and length of every block and the gene symbols. """
+    def __init__(self, binFname, jsonFname, cellCount, matType, codec="zlib", blockSize=1024, spillSize=10000000):
+        self.binFname = binFname
+        self.jsonFname = jsonFname
+        self.cellCount = cellCount
+        self.codec = codec
+        self.blockSize = blockSize
+        self.spillSize = spillSize
+        if matType=="float":
+            self.dtype = np.float32
+            self.arrType = "Float32"
+        else:
+            self.dtype = np.uint32
+            self.arrType = "Uint32"
+
+        self.blockCount = (cellCount+blockSize-1) // blockSize
+        self.blockChunks = [[] for i in range(self.blockCount)] # (offset, value count) in the spill file
+        self.genes = []
+        self.rows = [] # (cellIdx, geneIdx, vals) not spilled yet
+        self.rowValCount = 0
+        self.spillFname = binFname+".spill.tmp"
+        self.spillFh = open(self.spillFname, "w+b")
+
+    def addRows(self, rows):
+        " add a list of (geneId, sym, exprArr) rows, exprArr can also be a tuple (cellIdx, vals, cellCount) "
+        for geneId, sym, exprArr in rows:
+            if type(exprArr)==tuple:
+                cellIdx, vals, cellCount = exprArr
+                cellIdx = np.asarray(cellIdx)
+                vals = np.asarray(vals)
+                isNonZero = (vals!=0)
+                cellIdx = cellIdx[isNonZero]
+                vals = vals[isNonZero]
+            else:
+                exprArr = np.asarray(exprArr)
+                cellIdx = np.flatnonzero(exprArr)
+                vals = exprArr[cellIdx]
+
+            geneIdx = np.full(len(cellIdx), len(self.genes), dtype=np.uint32)
+            self.rows.append( (cellIdx.astype(np.uint32), geneIdx, vals.astype(self.dtype)) )
+            self.rowValCount += len(cellIdx)
+            self.genes.append(sym)
+
+        if self.rowValCount >= self.spillSize:
+            self._spill()
+
+    def _spill(self):
+        " sort the collected values by cell and append them to the spill file, one chunk per block "
+        if len(self.rows)==0:
+            return
+        cellIdx = np.concatenate([r[0] for r in self.rows])
+        geneIdx = np.concatenate([r[1] for r in self.rows])
+        vals = np.concatenate([r[2] for r in self.rows])
+        self.rows = []
+        self.rowValCount = 0
+
+        # a stable sort keeps the genes of a cell in input order
+        order = np.argsort(cellIdx, kind="stable")
+        cellIdx = cellIdx[order]
+        geneIdx = geneIdx[order]
+        vals = vals[order]
+
+        blockStarts = np.searchsorted(cellIdx, np.arange(self.blockCount+1)*self.blockSize)
+        for blockIdx in range(self.blockCount):
+            start, end = blockStarts[blockIdx], blockStarts[blockIdx+1]
+            if start==end:
+                continue
+            self.blockChunks[blockIdx].append( (self.spillFh.tell(), end-start) )
+            self.spillFh.write(cellIdx[start:end].tobytes())
+            self.spillFh.write(geneIdx[start:end].tobytes())
+            self.spillFh.write(vals[start:end].tobytes())
+
+    def _readBlock(self, blockIdx):
+        " return the arrays cellIdx, geneIdx, vals of a block, sorted by cell and then by gene "
+        cellParts, geneParts, valParts = [], [], []
+        for offset, count in self.blockChunks[blockIdx]:
+            self.spillFh.seek(offset)
+            data = self.spillFh.read(12*count)
+            cellParts.append(np.frombuffer(data, dtype=np.uint32, count=count))
+            geneParts.append(np.frombuffer(data, dtype=np.uint32, count=count, offset=4*count))
+            valParts.append(np.frombuffer(data, dtype=self.dtype, count=count, offset=8*count))
+
+        if len(cellParts)==0:
+            return np.zeros(0, dtype=np.uint32), np.zeros(0, dtype=np.uint32), np.zeros(0, dtype=self.dtype)
+
+        # the chunks are in gene order, so the stable sort keeps the genes of a cell sorted
+        cellIdx = np.concatenate(cellParts)
+        order = np.argsort(cellIdx, kind="stable")
+        return cellIdx[order], np.concatenate(geneParts)[order], np.concatenate(valParts)[order]
+
+    def finish(self):
+        " write the blocks and the json index "
+        self._spill()
+        tmpFname = self.binFname+".tmp"
+        ofh = open(tmpFname, "wb")
+        blocks = []
+        for blockIdx in range(self.blockCount):
+            cellStart = blockIdx*self.blockSize
+            blockCellCount = min(self.blockSize, self.cellCount-cellStart)
+            cellIdx, geneIdx, vals = self._readBlock(blockIdx)
+            cellStarts = np.searchsorted(cellIdx, np.arange(cellStart, cellStart+blockCellCount+1)).astype(np.uint32)
+            blockStr = struct.pack("<II", blockCellCount, len(cellIdx)) + cellStarts.tobytes() \
+                    + geneIdx.tobytes() + vals.tobytes()
+            blockStr = compressRecord(blockStr, self.codec)
+            blocks.append( (ofh.tell(), len(blockStr)) )
+            ofh.write(blockStr)
+        ofh.close()
+        self.spillFh.close()
+        os.remove(self.spillFname)
+
+        index = OrderedDict()
+        index["cellCount"] = self.cellCount
+        index["blockSize"] = self.blockSize
+        index["arrType"] = self.arrType
+        index["blocks"] = blocks
+        index["genes"] = self.genes
+        writeJson(index, self.jsonFname)
+        os.rename(tmpFname, self.binFname)
+        logging.info("Wrote cell-major matrix %s, %d blocks of %d cells" % (self.binFname, self.blockCount, self.blockSize))
+
+    def abort(self):
+        " remove the temporary file "
+        self.spillFh.close()
+        os.remove(self.spillFname)
+
+def readCellExpr(binFname, jsonFname, cellIdx, codec="zlib"):
+    """ return the non-zero values of the cell with index cellIdx as a list of (symbol, value), from
+    the files written by CellMatrixWriter. The browser does the same, see cbData.js. """
+    index = readJson(jsonFname)
+    blockSize = index["blockSize"]
+    offset, length = index["blocks"][cellIdx // blockSize]
+    with open(binFname, "rb") as ifh:
+        ifh.seek(offset)
+        data = decompressRecord(ifh.read(length), codec)
+
+    cellCount, valCount = struct.unpack_from("<II", data, 0)
+    localIdx = cellIdx % blockSize
+    start, end = struct.unpack_from("<II", data, 8+4*localIdx)
+    geneStart = 8+4*(cellCount+1)
+    valStart = geneStart+4*valCount
+    geneIdx = struct.unpack_from("<%dI" % (end-start), data, geneStart+4*start)
+    if index["arrType"]=="Float32":
+        valFmt = "<%df"
+    else:
+        valFmt = "<%dI"
+    vals = struct.unpack_from(valFmt % (end-start), data, valStart+4*start)
+    genes = index["genes"]
+    return [(genes[g], v) for g, v in zip(geneIdx, vals)]
+
 def sepForFile(fname):
     if fname.endswith(".csv") or fname.endswith(".csv.gz") or fname.endswith(".csv.Z"):
         sep = ","
@@ -2113,6 +3698,114 @@ def parseCoordsAsDict(fname, useTwoBytes, flipY):
     logging.debug("Coords parsed, limits are: %s" % repr(limits))
     return coords, limits
 
+def parseCoordArrays(fname, useTwoBytes, flipY):
+    """ parse tsv file in format cellId, x, y, like parseCoordsAsDict, but return the cellIds as a list
+    and the coordinates as two numpy float64 arrays: ((cellIds, xArr, yArr), limits). Requires numpy.
+    """
+    logging.debug("Parsing coordinates from %s into arrays. FlipY=%s, useTwoBytes=%s" % (fname, flipY, useTwoBytes))
+    cellIds = []
+    xStrs = []
+    yStrs = []
+    fieldCount = None
+    for row in textFileRows(fname):
+        if row[0].startswith("#"):
+            continue
+        if fieldCount is None:
+            fieldCount = len(row)
+            if fieldCount<3:
+                errAbort("file %s needs to have at least three columns" % fname)
+            if fieldCount>3: # coord file has to have three rows (cellId, x, y), we just ignore the headers
+                logging.warn("file %s has more than three columns. Everything beyond column 3 will be ignored" % fname)
+        elif len(row)!=fieldCount:
+            errAbort("file %s: line %s has %d fields, but the first line has %d" % (fname, row, len(row), fieldCount))
+        cellIds.append(row[0])
+        xStrs.append(row[1])
+        yStrs.append(row[2])
+
+    # the first line can be a header line
+    if len(cellIds)!=0:
+        try:
+            float(xStrs[0])
+            float(yStrs[0])
+        except ValueError:
+            del cellIds[0], xStrs[0], yStrs[0]
+
+    try:
+        xArr = np.fromiter(map(float, xStrs), dtype=np.float64, count=len(xStrs))
+        yArr = np.fromiter(map(float, yStrs), dtype=np.float64, count=len(yStrs))
+    except ValueError:
+        # rare: skip the lines that are not numbers, one by one
+        goodIdx = []
+        for i, (x, y) in enumerate(zip(xStrs, yStrs)):
+            try:
+                float(x)
+                float(y)
+            except ValueError:
+                logging.warn("file %s: cannot parse x,y coords, skipping line %s" % (fname, [cellIds[i], x, y]))
+                continue
+            goodIdx.append(i)
+        cellIds = [cellIds[i] for i in goodIdx]
+        xArr = np.array([float(xStrs[i]) for i in goodIdx], dtype=np.float64)
+        yArr = np.array([float(yStrs[i]) for i in goodIdx], dtype=np.float64)
+
+    minX = 2^32
+    minY = 2^32
+    maxX = -2^32
+    maxY = -2^32
+    # special values (12345,12345) mean "unknown cellId"
+    isShown = (xArr!=HIDDENCOORD) & (yArr!=HIDDENCOORD)
+    if isShown.any():
+        minX = min(minX, xArr[isShown].min().item())
+        minY = min(minY, yArr[isShown].min().item())
+        maxX = max(maxX, xArr[isShown].max().item())
+        maxY = max(maxY, yArr[isShown].max().item())
+
+    if useTwoBytes is None:
+        if len(cellIds)>100000:
+            useTwoBytes = True
+            logging.info("More than 100k cells, so automatically enabling two-byte encoding for coordinates")
+        else:
+            useTwoBytes = False
+
+    scaleX, scaleY = calcScaleFact(minX, maxX, minY, maxY, useTwoBytes)
+    limits = (minX, maxX, minY, maxY, scaleX, scaleY, useTwoBytes, flipY)
+
+    logging.debug("Coords parsed, limits are: %s" % repr(limits))
+    return (cellIds, xArr, yArr), limits
+
+def scaleCoordArrays(coordArrs, limits, sampleNames):
+    """ scale the coordinates from parseCoordArrays like scaleCoords, clip them to 0-65535 if
+    useTwoBytes is set and put them into the order of sampleNames. Cells without coordinates are set to
+    HIDDENCOORD, also the ones that are HIDDENCOORD in the input. Returns (xArr, yArr, isMissing), isMissing
+    is True for the samples that are not in the coordinates. """
+    cellIds, xArr, yArr = coordArrs
+    minX, maxX, minY, maxY, scaleX, scaleY, useTwoBytes, flipY = limits
+
+    isHidden = (xArr==HIDDENCOORD) & (yArr==HIDDENCOORD)
+    if useTwoBytes:
+        xArr = (scaleX * (xArr - minX)).astype(np.int64)
+        yArr = (scaleY * (yArr - minY)).astype(np.int64)
+        if flipY:
+            yArr = 65535 - yArr
+        xArr = np.clip(xArr, 0, 65535).astype(np.uint16)
+        yArr = np.clip(yArr, 0, 65535).astype(np.uint16)
+    else:
+        if flipY:
+            yArr = maxY - yArr
+    xArr[isHidden] = HIDDENCOORD
+    yArr[isHidden] = HIDDENCOORD
+
+    # the index of every sample in the coordinate arrays, -1 if not there. Later lines win, like in a dict.
+    cellToIdx = dict(zip(cellIds, range(len(cellIds))))
+    sampleIdx = np.fromiter((cellToIdx.get(name, -1) for name in sampleNames), dtype=np.int64, count=len(sampleNames))
+    isMissing = (sampleIdx==-1)
+
+    xArr = xArr[sampleIdx]
+    yArr = yArr[sampleIdx]
+    xArr[isMissing] = HIDDENCOORD
+    yArr[isMissing] = HIDDENCOORD
+    return xArr, yArr, isMissing
+
 def sliceRow(row, skipFields):
     " yield all fields, except the ones with an index in skipFields "
     for i, val in enumerate(row):
@@ -2134,9 +3827,110 @@ def readMatrixSampleNames(fname):
     else:
         return readHeaders(fname)[1:]
 
+class MetaColumns:
+    """ the meta data table, column by column: for every column a list of its different values and
+    an array with the index of every cell's value in this list. This is much smaller than a list
+    of rows, most columns have only a few different values. The file is read only once, in blocks
+    of rows. All rows must have as many fields as the header line. """
+    def __init__(self, fname, blockSize=10000):
+        logging.debug("Reading %s into columns" % fname)
+        rowIter = textFileRows(fname)
+        self.headers = nextEl(rowIter)
+        colCount = len(self.headers)
+        self.pools = [[] for i in range(colCount)]
+        self.codes = [array.array("I") for i in range(colCount)]
+        valToCodes = [{} for i in range(colCount)]
+
+        lineNo = 1
+        while True:
+            block = list(itertools.islice(rowIter, blockSize))
+            if len(block)==0:
+                break
+            for row in block:
+                lineNo += 1
+                if len(row)!=colCount:
+                    errAbort("line %d of %s has %d fields, but the header line has %d. All lines must have the same number of fields." % (lineNo, fname, len(row), colCount))
+
+            for colIdx, colVals in enumerate(zip(*block)):
+                valToCode = valToCodes[colIdx]
+                pool = self.pools[colIdx]
+                for val in set(colVals).difference(valToCode):
+                    valToCode[val] = len(pool)
+                    pool.append(val)
+                self.codes[colIdx].extend(map(valToCode.__getitem__, colVals))
+
+        if numpyLoaded:
+            self.codes = [np.frombuffer(codes, dtype=np.uint32) for codes in self.codes]
+
+    def rowCount(self):
+        return len(self.codes[0])
+
+    def rowNames(self):
+        " return the values of the first column "
+        return self.colValues(0)
+
+    def colValues(self, colIdx):
+        " return the values of a column as a list of strings "
+        codes = self.codes[colIdx]
+        if numpyLoaded:
+            codes = codes.tolist()
+        return list(map(self.pools[colIdx].__getitem__, codes))
+
+    def singleValueCols(self):
+        " return the indices of the columns that contain only a single value "
+        return [colIdx for colIdx, pool in enumerate(self.pools) if len(pool)==1]
+
+    def removeCols(self, colIndices):
+        " remove the columns with the given indices "
+        colIndices = set(colIndices)
+        keepCols = [i for i in range(len(self.headers)) if i not in colIndices]
+        self.headers = [self.headers[i] for i in keepCols]
+        self.pools = [self.pools[i] for i in keepCols]
+        self.codes = [self.codes[i] for i in keepCols]
+
+    def reorderRows(self, rowIndices):
+        " keep only the rows with the given indices, in this order "
+        if numpyLoaded:
+            rowIndices = np.asarray(rowIndices, dtype=np.intp)
+            self.codes = [codes[rowIndices] for codes in self.codes]
+        else:
+            self.codes = [array.array("I", map(codes.__getitem__, rowIndices)) for codes in self.codes]
+
+    def iterColumns(self):
+        """ yield (fieldName, list of values), one column at a time, with the same field names as
+        parseIntoColumns """
+        headers = list(self.headers)
+        if headers[0]=="":
+            headers[0]="cell_id" # some tolerance, for R
+        headers = [h.split("|")[0] for h in headers]
+        for i, h in enumerate(headers):
+            if h=="":
+                errAbort("Header '%s' of column %d is empty. Please fix the meta data file and give every column a name" %
+                        (h, i))
+        for colIdx, fieldName in enumerate(headers):
+            yield fieldName, self.colValues(colIdx)
+
+    def writeTsv(self, fname, blockSize=10000):
+        " write the table to a tab-separated file "
+        ofh = open(fname, "w")
+        ofh.write("\t".join(self.headers))
+        ofh.write("\n")
+        for start in range(0, self.rowCount(), blockSize):
+            blockCols = []
+            for pool, codes in zip(self.pools, self.codes):
+                codes = codes[start:start+blockSize]
+                if numpyLoaded:
+                    codes = codes.tolist()
+                blockCols.append(map(pool.__getitem__, codes))
+            for row in zip(*blockCols):
+                ofh.write("\t".join(row))
+                ofh.write("\n")
+        ofh.close()
+
 def metaReorder(matrixFname, metaFname, fixedMetaFname):
     """ check and reorder the meta data, has to be in the same order as the
-    expression matrix, write to fixedMetaFname. Remove single-value fields. """
+    expression matrix, write to fixedMetaFname. Remove single-value fields.
+    Returns the sample names, whether the matrix has to be filtered and the new table as MetaColumns. """
 
     logging.info("Checking and reordering meta data to %s" % fixedMetaFname)
     metaSampleNames = readSampleNames(metaFname)
@@ -2175,43 +3969,23 @@ def metaReorder(matrixFname, metaFname, fixedMetaFname):
     # filter the meta data file
     logging.info("Data contains %d samples/cells" % len(matrixSampleNames))
 
-    # slurp in the whole meta data, keep track of which fields contain only a single value
-    tmpFname = fixedMetaFname+".tmp"
-    ofh = open(tmpFname, "w")
-    metaToRow = {}
-    fieldValues = defaultdict(set)
-    headers = None
-    for row in textFileRows(metaFname):
-        if headers is None:
-            headers = row
-            continue
-        metaToRow[row[0]] = row
-
-        for fieldIdx, val in enumerate(row):
-            fieldValues[fieldIdx].add(val)
-
-    # find fields that contain only a single value
-    skipFields = set()
-    for fieldIdx, values in iterItems(fieldValues):
-        #logging.debug("fieldIdx %d, values %s" % (fieldIdx, values))
-        if len(values)==1:
-            logging.info("Field %d, '%s', has only a single value. Removing this field from meta data." %
-                    (fieldIdx, headers[fieldIdx] ))
-            skipFields.add(fieldIdx)
-
-    # write the header line, removing unused fields
-    ofh.write("\t".join(sliceRow(headers, skipFields)))
-    ofh.write("\n")
+    # read the meta data into columns and remove the fields that contain only a single value
+    metaCols = MetaColumns(metaFname)
+    skipFields = metaCols.singleValueCols()
+    for fieldIdx in skipFields:
+        logging.info("Field %d, '%s', has only a single value. Removing this field from meta data." %
+                (fieldIdx, metaCols.headers[fieldIdx] ))
+    metaCols.removeCols(skipFields)
 
-    # and write the rows in the right order, also removing unused fields
-    for matrixName in matrixSampleNames:
-        ofh.write("\t".join(sliceRow(metaToRow[matrixName], skipFields)))
-        ofh.write("\n")
-    ofh.close()
+    # put the rows into the order of the matrix
+    metaToRow = dict(zip(metaCols.rowNames(), range(metaCols.rowCount())))
+    metaCols.reorderRows([metaToRow[matrixName] for matrixName in matrixSampleNames])
 
+    tmpFname = fixedMetaFname+".tmp"
+    metaCols.writeTsv(tmpFname)
     os.rename(tmpFname, fixedMetaFname)
 
-    return matrixSampleNames, mustFilterMatrix
+    return matrixSampleNames, mustFilterMatrix, metaCols
 
 def writeCoords(coordName, coords, sampleNames, coordBinFname, coordJson, useTwoBytes, coordInfo, textOutName):
     """ write coordinates given as a dictionary to coordBin and coordJson, in the order of sampleNames
@@ -2290,6 +4064,196 @@ def writeCoords(coordName, coords, sampleNames, coordBinFname, coordJson, useTwo
     logging.debug("Wrote %d coordinates to %s and %s" % (len(sampleNames), coordBinFname, textOutName))
     return coordInfo, xVals, yVals
 
+def writeCoordArrays(coordName, xArr, yArr, isMissing, sampleNames, coordBinFname, useTwoBytes, coordInfo, textOutName):
+    """ write coordinates from scaleCoordArrays to coordBinFname and textOutName, with the same output as
+    writeCoords. Returns coordInfo.
+    """
+    logging.info("Writing coordinates for %s" % (coordName))
+    logging.debug("Writing coordinates to %s" % (coordBinFname))
+
+    missCount = int(isMissing.sum())
+    if missCount!=0:
+        missNames = [sampleNames[i] for i in np.flatnonzero(isMissing)[:3]]
+        logging.info("%s: %d cells have meta and coords. %d cells have meta but no coord. E.g. %s" % \
+            (coordName, len(sampleNames), missCount, missNames))
+        if len(sampleNames)-missCount==0:
+            errAbort("No coordinates that are also in meta. Check coord and meta cell identifiers.")
+
+    # all little endian, x and y interleaved
+    if useTwoBytes:
+        binArr = np.empty(2*len(xArr), dtype="<u2")
+    else:
+        binArr = np.empty(2*len(xArr), dtype="<f4")
+    binArr[0::2] = xArr
+    binArr[1::2] = yArr
+    binData = binArr.tobytes()
+
+    tmpFname = coordBinFname+".tmp"
+    with open(tmpFname, "wb") as binFh:
+        binFh.write(binData)
+    os.rename(tmpFname, coordBinFname)
+    coordInfo["md5"] = hashlib.md5(binData).hexdigest()[:MD5LEN]
+
+    minX = 2^32
+    minY = 2^32
+    maxX = -2^32
+    maxY = -2^32
+    # special values (12345,12345) mean "unknown cellId"
+    isShown = (xArr!=HIDDENCOORD) & (yArr!=HIDDENCOORD)
+    if isShown.any():
+        minX = min(minX, xArr[isShown].min().item())
+        minY = min(minY, yArr[isShown].min().item())
+        maxX = max(maxX, xArr[isShown].max().item())
+        maxY = max(maxY, yArr[isShown].max().item())
+
+    coordInfo["minX"] = minX
+    coordInfo["maxX"] = maxX
+    coordInfo["minY"] = minY
+    coordInfo["maxY"] = maxY
+    if useTwoBytes:
+        coordInfo["type"] = "Uint16"
+    else:
+        coordInfo["type"] = "Float32"
+
+    textOutTmp = textOutName+".tmp"
+    textOfh = open(textOutTmp, "w")
+    for sampleName, x, y, isMiss in zip(sampleNames, xArr.tolist(), yArr.tolist(), isMissing.tolist()):
+        if isMiss:
+            continue
+        textOfh.write("%s\t%f\t%f\n" % (sampleName, x, y))
+    textOfh.close()
+    runGzip(textOutTmp, textOutName)
+
+    logging.debug("Wrote %d coordinates to %s and %s" % (len(sampleNames), coordBinFname, textOutName))
+    return coordInfo
+
+# coordinate tiles: the side length of the density grid of every tile and, for coordTileLevels=0,
+# the maximum number of cells in a tile of the last level and the maximum number of levels
+tileGridSize = 32
+tileMaxCells = 50000
+tileMaxLevels = 9
+
+def spreadBits(arr):
+    " insert a 0 bit before every bit of the 16 bit numbers in arr, as uint32. For Morton codes. "
+    arr = arr.astype(np.uint32)
+    arr = (arr | (arr << 8)) & 0x00FF00FF
+    arr = (arr | (arr << 4)) & 0x0F0F0F0F
+    arr = (arr | (arr << 2)) & 0x33333333
+    arr = (arr | (arr << 1)) & 0x55555555
+    return arr
+
+def autoTileLevels(xArr, yArr):
+    " return the number of levels needed so that no tile of the last level has more than tileMaxCells cells "
+    if len(xArr)==0:
+        return 1
+    for levels in range(1, tileMaxLevels+1):
+        shift = 17 - levels
+        tileKeys = (xArr.astype(np.uint32) >> shift) << (levels-1) | (yArr.astype(np.uint32) >> shift)
+        if np.bincount(tileKeys).max() <= tileMaxCells:
+            break
+    return levels
+
+def writeCoordTiles(xArr, yArr, binFname, jsonFname, levels):
+    """ write a tile pyramid for the Uint16 coordinates in xArr/yArr, in the order of the meta data.
+    At level z, the 0-65535 square is cut into 2^z*2^z tiles. binFname contains the shown cells, sorted by
+    the Morton code of their tile at the last level, so at every level, the cells of a tile are a
+    contiguous range:
+    - the cell indices as Uint32
+    - the coordinates of these cells, as Uint16 pairs x,y
+    - for every tile of every level, a tileGridSize*tileGridSize grid with the number of cells, as
+      zlib-compressed Uint32, row by row
+    jsonFname has the byte offsets and for every tile, key "z/x/y", the list
+    [firstCell, cellCount, gridOffset, gridLength]. Tiles without cells are not in the list.
+    If levels is 0, the number of levels is chosen automatically.
+    Returns a dict with the general info about the tiles, for coordInfo. """
+    isShown = ~((xArr==HIDDENCOORD) & (yArr==HIDDENCOORD))
+    cellIdx = np.flatnonzero(isShown)
+    xs = xArr[isShown].astype(np.uint32)
+    ys = yArr[isShown].astype(np.uint32)
+
+    if levels==0:
+        levels = autoTileLevels(xs, ys)
+    levels = min(levels, tileMaxLevels)
+    lastZ = levels-1
+    gridBits = int(math.log(tileGridSize, 2))
+
+    # sort by tile at the last level. Morton codes keep the tiles of every level together.
+    tileCodes = spreadBits(xs >> (16-lastZ)) | (spreadBits(ys >> (16-lastZ)) << 1)
+    order = np.argsort(tileCodes, kind="stable")
+    tileCodes = tileCodes[order]
+    cellIdx = cellIdx[order]
+    xs = xs[order]
+    ys = ys[order]
+
+    cellCount = len(cellIdx)
+    idxData = cellIdx.astype("<u4").tobytes()
+    coordArr = np.empty(2*cellCount, dtype="<u2")
+    coordArr[0::2] = xs
+    coordArr[1::2] = ys
+    coordData = coordArr.tobytes()
+
+    tileIndex = OrderedDict()
+    tileIndex["levels"] = levels
+    tileIndex["gridSize"] = tileGridSize
+    tileIndex["cellCount"] = cellCount
+    tileIndex["cellIdxOffset"] = 0
+    tileIndex["coordOffset"] = len(idxData)
+    tiles = OrderedDict()
+    tileIndex["tiles"] = tiles
+
+    gridParts = []
+    offset = len(idxData)+len(coordData)
+    gridCells = tileGridSize*tileGridSize
+    chunkTiles = 4096 # number of density grids that are counted at once
+    for z in range(levels):
+        if cellCount==0:
+            break
+        # the cell ranges of the tiles
+        levelCodes = tileCodes >> (2*(lastZ-z))
+        tileStarts = np.flatnonzero(np.concatenate( ([True], levelCodes[1:]!=levelCodes[:-1]) ))
+        tileEnds = np.append(tileStarts[1:], cellCount)
+        tileCount = len(tileStarts)
+
+        # the position of every cell in the density grid of its tile
+        gridShift = 16-z-gridBits
+        gridX = (xs >> gridShift) & (tileGridSize-1)
+        gridY = (ys >> gridShift) & (tileGridSize-1)
+        cellBins = (gridY*tileGridSize + gridX).astype(np.int64)
+
+        for chunkStart in range(0, tileCount, chunkTiles):
+            chunkEnd = min(chunkStart+chunkTiles, tileCount)
+            firstCell = tileStarts[chunkStart]
+            lastCell = tileEnds[chunkEnd-1]
+            tileRank = np.repeat(np.arange(chunkEnd-chunkStart), tileEnds[chunkStart:chunkEnd]-tileStarts[chunkStart:chunkEnd])
+            grids = np.bincount(tileRank*gridCells + cellBins[firstCell:lastCell], minlength=(chunkEnd-chunkStart)*gridCells)
+            grids = grids.astype("<u4").reshape( (chunkEnd-chunkStart, gridCells) )
+
+            for tileNo in range(chunkStart, chunkEnd):
+                start = int(tileStarts[tileNo])
+                count = int(tileEnds[tileNo])-start
+                tileX = int(xs[start] >> (16-z))
+                tileY = int(ys[start] >> (16-z))
+                gridData = zlib.compress(grids[tileNo-chunkStart].tobytes())
+                tiles["%d/%d/%d" % (z, tileX, tileY)] = [start, count, offset, len(gridData)]
+                gridParts.append(gridData)
+                offset += len(gridData)
+
+    binData = b"".join([idxData, coordData]+gridParts)
+    tmpFname = binFname+".tmp"
+    with open(tmpFname, "wb") as ofh:
+        ofh.write(binData)
+    os.rename(tmpFname, binFname)
+    writeJson(tileIndex, jsonFname)
+
+    logging.info("Wrote %d tiles on %d levels for %d cells to %s" % (len(tiles), levels, cellCount, binFname))
+
+    tileInfo = OrderedDict()
+    tileInfo["levels"] = levels
+    tileInfo["gridSize"] = tileGridSize
+    tileInfo["md5"] = hashlib.md5(binData).hexdigest()[:MD5LEN]
+    tileInfo["jsonMd5"] = md5WithPython(jsonFname)[:MD5LEN]
+    return tileInfo
+
 def runCommand(cmd, verbose=False):
     " run command "
     if verbose:
@@ -2306,6 +4270,30 @@ def runCommand(cmd, verbose=False):
         errAbort("Could not run: %s" % cmd)
     return 0
 
+def formatMatrixRows(mat, sep="\t"):
+    """ return a list of strings, one per row of the 2D numpy array mat, with the numbers separated by sep.
+    The numbers look like str() of each value, but every distinct value is converted only once. """
+    strs = np.full(mat.shape, str(mat.dtype.type(0)), dtype=object)
+    nonZero = np.nonzero(mat)
+    uniqVals, uniqIdx = np.unique(mat[nonZero], return_inverse=True)
+    strs[nonZero] = np.array([str(x) for x in uniqVals], dtype=object)[uniqIdx]
+    return [sep.join(row) for row in strs.tolist()]
+
+def writeMatrixRows(ofh, rowNames, rows):
+    " write a list of rows with their names to ofh, as a tab-separated matrix "
+    if len(rows)==0:
+        return
+    if numpyLoaded:
+        lines = formatMatrixRows(np.array(rows))
+    else:
+        lines = ["\t".join([str(x) for x in row]) for row in rows]
+
+    for rowName, line in zip(rowNames, lines):
+        ofh.write(rowName)
+        ofh.write("\t")
+        ofh.write(line)
+        ofh.write("\n")
+
 def copyMatrixTrim(inFname, outFname, filtSampleNames, doFilter, geneToSym, matType):
     """ copy matrix and compress it. If doFilter is true: keep only the samples in filtSampleNames
     Returns the format of the matrix, "float" or "int", or None if not known
@@ -2348,6 +4336,8 @@ def copyMatrixTrim(inFname, outFname, filtSampleNames, doFilter, geneToSym, matT
 
     assert(len(keepIdx)!=0)
     logging.debug("Keeping %d fields" % len(keepIdx))
+    if numpyLoaded:
+        keepIdx = np.array(keepIdx)
 
     tmpFname = outFname+".tmp"
 
@@ -2356,16 +4346,22 @@ def copyMatrixTrim(inFname, outFname, filtSampleNames, doFilter, geneToSym, matT
     ofh.write("\t".join(filtSampleNames))
     ofh.write("\n")
 
+    # the rows are written in blocks of around 10 million values
+    blockSize = max(1, min(1000, 10000000 // len(keepIdx)))
     count = 0
+    rowNames, rows = [], []
     for geneId, sym, exprArr in matIter.iterRows():
-        newRow = [geneId+"|"+sym]
-        for idx in keepIdx:
-            newRow.append(str(exprArr[idx]))
-        ofh.write("\t".join(newRow))
-        ofh.write("\n")
+        rowNames.append(geneId+"|"+sym)
+        if numpyLoaded:
+            rows.append(exprArr[keepIdx])
+        else:
+            rows.append([exprArr[idx] for idx in keepIdx])
         count += 1
-        if count%1000==0:
+        if len(rows)==blockSize:
+            writeMatrixRows(ofh, rowNames, rows)
+            rowNames, rows = [], []
             logging.info("Wrote %d text rows" % count)
+    writeMatrixRows(ofh, rowNames, rows)
     ofh.close()
     matIter.close()
 
@@ -2873,6 +4869,77 @@ def makeMids(xVals, yVals, labelVec, labelVals, coordInfo):
 
     return midInfo
 
+def makeMidsArrays(xArr, yArr, labelVec, labelVals):
+    """ like makeMids, with the same results, but for numpy arrays of coordinates: sorts the cells by label
+    once and calculates the midpoints of all clusters together. Requires numpy. """
+    logging.debug("Making cluster labels for %s" % labelVals)
+    assert(len(xArr)==len(labelVec)==len(yArr))
+
+    labelArr = np.asarray(labelVec, dtype=np.int64)
+    isShown = ~((xArr==HIDDENCOORD) & (yArr==HIDDENCOORD))
+    labelArr = labelArr[isShown]
+    order = np.argsort(labelArr, kind="stable")
+    xs = xArr[isShown][order]
+    ys = yArr[isShown][order]
+    if xs.dtype.kind in "iu":
+        xs = xs.astype(np.int64) # the sums must not overflow
+        ys = ys.astype(np.int64)
+
+    counts = np.bincount(labelArr, minlength=len(labelVals))
+    ends = np.cumsum(counts)
+    starts = ends - counts
+
+    # the midpoints of all clusters
+    hasCells = (counts!=0)
+    xSums = np.zeros(len(labelVals), dtype=xs.dtype)
+    ySums = np.zeros(len(labelVals), dtype=ys.dtype)
+    xSums[hasCells] = np.add.reduceat(xs, starts[hasCells])
+    ySums[hasCells] = np.add.reduceat(ys, starts[hasCells])
+    midXs = xSums.tolist()
+    midYs = ySums.tolist()
+    for i, count in enumerate(counts.tolist()):
+        if count!=0:
+            midXs[i] = midXs[i] / float(count)
+            midYs[i] = midYs[i] / float(count)
+
+    # the distance of every cell to the midpoint of its cluster
+    cellMidX = np.repeat(np.array(midXs, dtype=np.float64), counts)
+    cellMidY = np.repeat(np.array(midYs, dtype=np.float64), counts)
+    dists = np.sqrt((xs-cellMidX)**2+(ys-cellMidY)**2)
+
+    midInfo = []
+    for clustIdx, clusterName in enumerate(labelVals):
+        count = int(counts[clustIdx])
+        if count==0:
+            midInfo.append([HIDDENCOORD, HIDDENCOORD, clusterName])
+            continue
+
+        if count<3:
+            midInfo.append([midXs[clustIdx], midYs[clustIdx], clusterName])
+            continue
+
+        # take only the best 70% of the points closest to the midpoints. Like sorting (dist, x, y), but
+        # only the points at exactly the cutoff distance have to be sorted.
+        start, end = int(starts[clustIdx]), int(ends[clustIdx])
+        clustDists = dists[start:end]
+        clustXs = xs[start:end]
+        clustYs = ys[start:end]
+        bestCount = int(0.7*count)
+        maxDist = np.partition(clustDists, bestCount-1)[bestCount-1]
+        isBest = (clustDists < maxDist)
+        tieIdx = np.flatnonzero(clustDists==maxDist)
+        tieIdx = tieIdx[np.lexsort( (clustYs[tieIdx], clustXs[tieIdx]) )][:bestCount-int(isBest.sum())]
+
+        # now recalc the midpoint
+        xSum = clustXs[isBest].sum().item() + clustXs[tieIdx].sum().item()
+        ySum = clustYs[isBest].sum().item() + clustYs[tieIdx].sum().item()
+        fixMidX = xSum / float(bestCount)
+        fixMidY = ySum / float(bestCount)
+
+        midInfo.append([fixMidX, fixMidY, clusterName])
+
+    return midInfo
+
 def readHeaders(fname):
     " return headers of a file "
     logging.info("Reading headers from file %s" % fname)
@@ -3010,9 +5077,9 @@ def parseLineInfo(inFname, limits):
     logging.debug("Lines read, new limits are: %s" % repr(limits))
     return lines, limits
 
-def convertExprMatrix(inConf, outMatrixFname, outConf, metaSampleNames, geneToSym, outDir, needFilterMatrix):
+def convertExprMatrix(inConf, outMatrixFname, outConf, metaSampleNames, geneToSym, outDir, needFilterMatrix, matrixOpts):
     """ trim a copy of the expression matrix for downloads, also create an indexed
-    and compressed version
+    and compressed version. matrixOpts are the settings from getMatrixOpts.
     """
     matType = inConf.get("matrixType")
     if matType=="auto":
@@ -3025,19 +5092,25 @@ def convertExprMatrix(inConf, outMatrixFname, outConf, metaSampleNames, geneToSy
     # removing those sample names that are not in the meta data
     matrixFname = getAbsPath(inConf, "exprMatrix")
     outConf["fileVersions"]["inMatrix"] = getFileVersion(matrixFname)
-    try:
-        matType = copyMatrixTrim(matrixFname, outMatrixFname, metaSampleNames, needFilterMatrix, geneToSym, matType)
-    except ValueError:
-        logging.warn("This is rare: mis-guessed the matrix data type, trying again and using floating point numbers. To avoid this message in the future, you can set matrixType='float' in cellbrowser.conf.")
-        matType = copyMatrixTrim(matrixFname, outMatrixFname, metaSampleNames, needFilterMatrix, geneToSym, "float")
 
     # step2: compress matrix and index to file
-    binMat = join(outDir, "exprMatrix.bin")
-    binMatIndex = join(outDir, "exprMatrix.json")
-    discretBinMat = join(outDir, "discretMat.bin")
-    discretMatrixIndex = join(outDir, "discretMat.json")
-
-    matType = matrixToBin(outMatrixFname, geneToSym, binMat, binMatIndex, discretBinMat, discretMatrixIndex, metaSampleNames, matType=matType)
+    opts = dict(matrixOpts)
+    opts["workers"] = getWorkerCount(inConf)
+    opts["mtxChunkSize"] = inConf.get("mtxChunkSize")
+    opts["tmpDir"] = inConf.get("tmpDir", getConfig("tmpDir"))
+    if opts["tmpDir"] is not None:
+        opts["tmpDir"] = expanduser(opts["tmpDir"])
+
+    if not isMtx(matrixFname) and (needFilterMatrix or ".csv" in matrixFname.lower()):
+        # the copy has to be rewritten: do both steps while parsing the matrix only once
+        try:
+            matType = matrixToBin(matrixFname, geneToSym, outDir, metaSampleNames, opts, matType=matType, trimFname=outMatrixFname)
+        except ValueError:
+            logging.warn("This is rare: mis-guessed the matrix data type, trying again and using floating point numbers. To avoid this message in the future, you can set matrixType='float' in cellbrowser.conf.")
+            matType = matrixToBin(matrixFname, geneToSym, outDir, metaSampleNames, opts, matType="float", trimFname=outMatrixFname)
+    else:
+        matType = copyMatrixTrim(matrixFname, outMatrixFname, metaSampleNames, needFilterMatrix, geneToSym, matType)
+        matType = matrixToBin(outMatrixFname, geneToSym, outDir, metaSampleNames, opts, matType=matType)
 
     if matType=="int" or matType=="forceInt":
         outConf["matrixArrType"] = "Uint32"
@@ -3045,6 +5118,24 @@ def convertExprMatrix(inConf, outMatrixFname, outConf, metaSampleNames, geneToSy
         outConf["matrixArrType"] = "Float32"
     else:
         assert(False)
+    for optName, val in iterItems(matrixOpts):
+        outConf[optName] = val
+    binMatIndex = join(outDir, "exprMatrix.json")
+    if isfile(geneIndexFname(binMatIndex)):
+        outConf["geneIndex"] = basename(geneIndexFname(binMatIndex))
+    elif "geneIndex" in outConf:
+        del outConf["geneIndex"]
+    # the browser loads the header and the page directory in one request
+    geneSearchFname = join(outDir, "geneSearch.bin")
+    outConf["geneSearch"] = {"fname" : basename(geneSearchFname), "dirSize" : geneSearchDirSize(geneSearchFname)}
+    if matrixOpts["cellMatrix"]:
+        outConf["cellMatrixIndex"] = "cellMatrix.json"
+    elif "cellMatrixIndex" in outConf:
+        del outConf["cellMatrixIndex"]
+    if matrixOpts["clusterAggr"] is not None:
+        outConf["clusterAggrIndex"] = "clusterAggr.json"
+    elif "clusterAggrIndex" in outConf:
+        del outConf["clusterAggrIndex"]
 
     outConf["fileVersions"]["outMatrix"] = getFileVersion(outMatrixFname)
 
@@ -3053,82 +5144,131 @@ def copyConf(inConf, outConf, keyName):
     if keyName in inConf:
         outConf[keyName] = inConf[keyName]
 
+def checkCoordTiles(inConf, useTwoBytes):
+    " return the number of levels for the coordinate tiles, 0 for automatic, or None if no tiles are written "
+    if not inConf.get("coordTiles", False):
+        return None
+    if not numpyLoaded:
+        logging.warn("coordTiles requires numpy, which is not installed. Not writing coordinate tiles.")
+        return None
+    if not useTwoBytes:
+        logging.warn("coordTiles requires two-byte coordinates. Not writing coordinate tiles.")
+        return None
+    return int(inConf.get("coordTileLevels", 0))
+
+def coordLayoutToBin(args):
+    """ convert one layout from the 'coords' list in cellbrowser.conf: the binary file, the text file, the
+    cluster labels and, if tileLevels is not None, the tiles. If fixedOrder is None, the clusters are
+    ordered by the positions of their labels in this layout, see orderClusters. Runs in a worker process.
+    Returns (coordInfo, name of text file). """
+    coordIdx, inCoordInfo, sampleNames, useTwoBytes, flipY, labelVec, labelVals, fixedOrder, tileLevels, outDir = args
+
+    hasLabels = (labelVec is not None)
+    coordFname = inCoordInfo["file"]
+    coordLabel = inCoordInfo["shortLabel"]
+    logging.info("Parsing coordinates for "+coordLabel)
+    # 'limits' is everything needed to transform coordinates to the final 0-1.0  or 0-65535 coord system
+    # with numpy, all coordinates are kept in arrays
+    if numpyLoaded:
+        coordArrs, limits = parseCoordArrays(coordFname, useTwoBytes, flipY)
+    else:
+        coords, limits = parseCoordsAsDict(coordFname, useTwoBytes, flipY)
+
+    hasLines = False
+    # parse lines, updating the max-max ranges
+    if "lineFile" in inCoordInfo:
+        lineCoords, limits = parseLineInfo(inCoordInfo["lineFile"], limits)
+        hasLines = True
+
+    coordName = "coords_%d" % coordIdx
+    coordDir = join(outDir, "coords", coordName)
+    makeDir(coordDir)
+    coordBin = join(coordDir, "coords.bin")
+    coordJson = join(coordDir, "coords.json")
+
+    coordInfo = OrderedDict()
+    coordInfo["name"] = coordName
+    coordInfo["shortLabel"] = coordLabel
+    if "radius" in inCoordInfo:
+        coordInfo["radius"] = inCoordInfo["radius"]
+    if "colorOnMeta" in inCoordInfo:
+        coordInfo["colorOnMeta"] = inCoordInfo["colorOnMeta"]
+
+    cleanName = sanitizeName(coordLabel.replace(" ", "_"))
+    textOutBase = cleanName+".coords.tsv.gz"
+    textOutName = join(outDir, textOutBase)
+    # now that we have the global limits, scale everything and write
+    if numpyLoaded:
+        xArr, yArr, isMissing = scaleCoordArrays(coordArrs, limits, sampleNames)
+        coordInfo = writeCoordArrays(coordLabel, xArr, yArr, isMissing, sampleNames, coordBin, useTwoBytes, coordInfo, textOutName)
+        if tileLevels is not None:
+            coordInfo["tiles"] = writeCoordTiles(xArr, yArr, join(coordDir, "tiles.bin"), join(coordDir, "tiles.json"), tileLevels)
+    else:
+        coordDict = scaleCoords(coords, limits)
+        coordInfo, xVals, yVals = writeCoords(coordLabel, coordDict, sampleNames, coordBin, coordJson, useTwoBytes, coordInfo, textOutName)
+
+    clusterInfo = {}
+    if hasLines:
+        lineFlipY = inCoordInfo.get("lineFlipY", flipY)
+        lineData = scaleLines(lineCoords, limits, lineFlipY)
+        clusterInfo["lines"] = lineData
+    if hasLabels:
+        logging.debug("Calculating cluster midpoints for "+coordLabel)
+        if numpyLoaded:
+            clusterMids = makeMidsArrays(xArr, yArr, labelVec, labelVals)
+        else:
+            clusterMids = makeMids(xVals, yVals, labelVec, labelVals, coordInfo)
+        if fixedOrder is None:
+            clusterOrder = orderClusters(clusterMids)
+        else:
+            clusterOrder = fixedOrder
+        clusterInfo["labels"] = clusterMids
+        clusterInfo["order"] = clusterOrder
+
+        clusterLabelFname = join(coordDir, "clusterLabels.json")
+        with open(clusterLabelFname, "w") as midFh:
+            json.dump(clusterInfo, midFh, indent=2)
+        logging.debug("Wrote cluster labels, midpoints and order to %s" % clusterLabelFname)
+        addMd5(coordInfo, clusterLabelFname, keyName="labelMd5")
+
+    return coordInfo, textOutBase
+
 def convertCoords(inConf, outConf, sampleNames, outMeta, outDir):
-    " convert the coordinates "
+    """ convert the coordinates. The layouts are converted in parallel if inConf has 'workers', see
+    coordLayoutToBin. """
     coordFnames = makeAbsDict(inConf, "coords")
 
     flipY = inConf.get("flipY", False)
     #useTwoBytes = inConf.get("useTwoBytes", None)
     useTwoBytes = True
 
-    hasLabels = False
+    labelVec, labelVals = None, []
+    fixedOrder = None
     if "labelField" in inConf and inConf["labelField"] is not None:
-        hasLabels = True
         clusterLabelField = inConf["labelField"]
         labelVec, labelVals = parseTsvColumn(outMeta, clusterLabelField)
         outConf["labelField"] = clusterLabelField
+        fixedOrder = getClusterOrder(inConf, outConf, labelVals, outDir)
 
-    outFnames = []
-    coordConf = []
+    tileLevels = checkCoordTiles(inConf, useTwoBytes)
 
-    for coordIdx, inCoordInfo in enumerate(coordFnames):
-        coordFname = inCoordInfo["file"]
-        coordLabel = inCoordInfo["shortLabel"]
-        logging.info("Parsing coordinates for "+coordLabel)
-        # 'limits' is everything needed to transform coordinates to the final 0-1.0  or 0-65535 coord system
-        coords, limits = parseCoordsAsDict(coordFname, useTwoBytes, flipY)
+    def iterLayoutArgs():
+        " yield the arguments for coordLayoutToBin for every layout "
+        for coordIdx, inCoordInfo in enumerate(coordFnames):
+            yield coordIdx, inCoordInfo, sampleNames, useTwoBytes, flipY, labelVec, labelVals, fixedOrder, tileLevels, outDir
 
-        hasLines = False
-        # parse lines, updating the max-max ranges
-        if "lineFile" in inCoordInfo:
-            lineCoords, limits = parseLineInfo(inCoordInfo["lineFile"], limits)
-            hasLines = True
-
-        # now that we have the global limits, scale everything
-        coordDict = scaleCoords(coords, limits)
-
-        coordName = "coords_%d" % coordIdx
-        coordDir = join(outDir, "coords", coordName)
-        makeDir(coordDir)
-        coordBin = join(coordDir, "coords.bin")
-        coordJson = join(coordDir, "coords.json")
-
-        coordInfo = OrderedDict()
-        coordInfo["name"] = coordName
-        coordInfo["shortLabel"] = coordLabel
-        if "radius" in inCoordInfo:
-            coordInfo["radius"] = inCoordInfo["radius"]
-        if "colorOnMeta" in inCoordInfo:
-            coordInfo["colorOnMeta"] = inCoordInfo["colorOnMeta"]
-
-        cleanName = sanitizeName(coordLabel.replace(" ", "_"))
-        textOutBase = cleanName+".coords.tsv.gz"
-        textOutName = join(outDir, textOutBase)
+    # the layouts come back in the order of the config file, their log messages are written together
+    outFnames = []
+    coordConf = []
+    workers = min(getWorkerCount(inConf), len(coordFnames))
+    for layoutRes, logRecords in iterPoolOrdered(runWithLogCollector,
+            ((coordLayoutToBin, args, logging.getLogger().level) for args in iterLayoutArgs()), workers):
+        for record in logRecords:
+            logging.getLogger().handle(record)
+        if layoutRes is None:
+            sys.exit(1)
+        coordInfo, textOutBase = layoutRes
         outFnames.append(textOutBase)
-        coordInfo, xVals, yVals = writeCoords(coordLabel, coordDict, sampleNames, coordBin, coordJson, useTwoBytes, coordInfo, textOutName)
-
-        clusterInfo = {}
-        if hasLines:
-            lineFlipY = inCoordInfo.get("lineFlipY", flipY)
-            lineData = scaleLines(lineCoords, limits, lineFlipY)
-            clusterInfo["lines"] = lineData
-        if hasLabels:
-            logging.debug("Calculating cluster midpoints for "+coordLabel)
-            clusterMids= makeMids(xVals, yVals, labelVec, labelVals, coordInfo)
-            clusterOrder = orderClusters(clusterMids, outConf)
-            clusterInfo["labels"] = clusterMids
-            clusterInfo["order"] = clusterOrder
-        else:
-            labelVals = []
-
-
-        if hasLabels:
-            clusterLabelFname = join(coordDir, "clusterLabels.json")
-            midFh = open(clusterLabelFname, "w")
-            json.dump(clusterInfo, midFh, indent=2)
-            logging.debug("Wrote cluster labels, midpoints and order to %s" % clusterLabelFname)
-            addMd5(coordInfo, clusterLabelFname, keyName="labelMd5")
-
         coordConf.append( coordInfo )
 
     outConf["coords"] = coordConf
@@ -3214,7 +5354,7 @@ def readQuickGenes(inConf, geneToSym, outDir, outConf):
     if quickGeneFname:
 
         matrixJsonFname = join(outDir, "exprMatrix.json")
-        validGenes = set(readJson(matrixJsonFname))
+        validGenes = set(readExprIndex(matrixJsonFname))
 
         fname = getAbsPath(inConf, "quickGenesFile")
         quickGenes = parseGeneInfo(geneToSym, fname)
@@ -3277,14 +5417,15 @@ def convertMeta(inDir, inConf, outConf, outDir, finalMetaFname):
     metaIdxFname = join(outDir, "meta.index")
 
     matrixFname = getAbsPath(inConf, "exprMatrix")
-    sampleNames, needFilterMatrix = metaReorder(matrixFname, metaFname, finalMetaFname)
+    sampleNames, needFilterMatrix, metaCols = metaReorder(matrixFname, metaFname, finalMetaFname)
 
     outConf["sampleCount"] = len(sampleNames)
     outConf["matrixWasFiltered"] = needFilterMatrix
 
     colorFname = inConf.get("colors")
     enumFields = inConf.get("enumFields")
-    fieldConf, validFieldNames = metaToBin(inConf, outConf, finalMetaFname, colorFname, metaDir, enumFields)
+    fieldConf, validFieldNames = metaToBin(inConf, outConf, finalMetaFname, colorFname, metaDir, enumFields, metaCols=metaCols)
+    del metaCols
     outConf["metaFields"] = fieldConf
 
     labelField = outConf.get("labelField")
@@ -3443,10 +5584,27 @@ def readOldSampleNames(datasetDir, lastConf):
             metaSampleNames.append(splitOnce(line, "\t")[0])
     return metaSampleNames
 
-def matrixOrSamplesHaveChanged(datasetDir, inMatrixFname, outMatrixFname, outConf):
+# dataset.json settings that change the format of exprMatrix.bin, with their values for older datasets
+matrixOptDefaults = {"sparseCutoff" : 0, "matrixCodec" : "zlib", "matrixFilter" : "none", "matrixQuant" : "none", "discretMatrix" : False,
+    "geneSearchTrigrams" : False, "cellMatrix" : False, "clusterAggr" : None, "clusterAggrMedian" : False}
+
+def getMatrixOpts(inConf):
+    " return the settings in matrixOptDefaults from cellbrowser.conf, checked "
+    return {"sparseCutoff" : checkSparseCutoff(inConf.get("sparseCutoff", 0.3)),
+            "matrixCodec" : checkExprCodec(inConf.get("matrixCodec")),
+            "matrixFilter" : checkExprFilter(inConf.get("matrixFilter")),
+            "matrixQuant" : checkExprQuant(inConf.get("matrixQuant")),
+            "discretMatrix" : checkDiscretMatrix(inConf.get("discretMatrix")),
+            "geneSearchTrigrams" : bool(inConf.get("geneSearchTrigrams", False)),
+            "cellMatrix" : checkCellMatrix(inConf.get("cellMatrix")),
+            "clusterAggr" : checkClusterAggr(inConf),
+            "clusterAggrMedian" : bool(inConf.get("clusterAggrMedian", False))}
+
+def matrixOrSamplesHaveChanged(datasetDir, inMatrixFname, outMatrixFname, outConf, matrixOpts={}):
     """ compare filesize stored in datasetDir/cellbrowser.json.bak with file
     size of inMatrixFname and also compare the sample names with the sample names in
-    outMatrixFname
+    outMatrixFname. matrixOpts are the settings in matrixOptDefaults, they have to be the same as in the
+    last run.
     """
     logging.info("Determining if %s needs to be created" % outMatrixFname)
     if not isfile(outMatrixFname):
@@ -3477,12 +5635,23 @@ def matrixOrSamplesHaveChanged(datasetDir, inMatrixFname, outMatrixFname, outCon
         logging.info("input matrix has input file size that is different from previously processed matrix, have to reindex the expression matrix. Old file: %s, current file: %d" % (oldMatrixInfo, nowSize))
         return True
 
+    for optName, val in iterItems(matrixOpts):
+        oldVal = lastConf.get(optName, matrixOptDefaults[optName])
+        if oldVal!=val:
+            logging.info("%s has changed from %s to %s, have to reindex the expression matrix" % (optName, oldVal, val))
+            return True
+
     if not "fileVersions" in outConf:
         outConf["fileVersions"] = {}
 
     outConf["fileVersions"]["inMatrix"] = oldMatrixInfo
     outConf["fileVersions"]["outMatrix"] = lastConf["fileVersions"]["outMatrix"]
     outConf["matrixArrType"] = lastConf["matrixArrType"]
+    for optName in matrixOpts:
+        outConf[optName] = lastConf.get(optName, matrixOptDefaults[optName])
+    for key in ["geneIndex", "geneSearch", "cellMatrixIndex", "clusterAggrIndex"]:
+        if key in lastConf:
+            outConf[key] = lastConf[key]
 
     metaSampleNames = readOldSampleNames(datasetDir, lastConf)
 
@@ -3515,34 +5684,112 @@ def readJson(fname, keepOrder=False):
         data = json.load(open(fname))
     return data
 
-def orderClusters(labelCoords, outConf):
-    " given the cluster label coordinates, order them by similarity "
-    #labelCoords = readJson(clusterLabelFname)
-
-    # create dict with label1 -> list of (dist, label2)
-    dists = defaultdict(list)
-    for i, (x1, y1, label1) in enumerate(labelCoords):
-        for x2, y2, label2 in labelCoords[i:]:
-            dist = math.sqrt((x2-x1)**2+(y2-y1)**2)
-            dists[label1].append((dist, label2))
-            dists[label2].append((dist, label1))
-
-    labelOrder = []
-    doneLabels = set()
-
-    currLabel = labelCoords[0][2]
-    for i in range(0, len(labelCoords)):
-        otherLabels = dists[currLabel]
-        otherLabels.sort()
-        for dist, label in otherLabels:
-            if not label in doneLabels:
-                currLabel = label
-                labelOrder.append(currLabel)
-                doneLabels.add(currLabel)
+clusterOrderMethods = ["nearest", "hierarchical", "alpha"]
+
+def orderClusters(labelCoords):
+    """ given the cluster label coordinates, order them by similarity: start with the first label and
+    then always go to the closest label that is not in the order yet. Ties are broken by label name. """
+    labels = [label for x, y, label in labelCoords]
+    if len(labels)==0:
+        return []
+
+    if not numpyLoaded:
+        # create dict with label1 -> list of (dist, label2)
+        dists = defaultdict(list)
+        for i, (x1, y1, label1) in enumerate(labelCoords):
+            for x2, y2, label2 in labelCoords[i+1:]:
+                dist = math.sqrt((x2-x1)**2+(y2-y1)**2)
+                dists[label1].append((dist, label2))
+                dists[label2].append((dist, label1))
+        for otherLabels in dists.values():
+            otherLabels.sort()
+        neighbors = [[label for dist, label in dists[label1]] for label1 in labels]
+        labelToIdx = dict(zip(labels, range(len(labels))))
+        neighbors = [[labelToIdx[label] for label in neighList] for neighList in neighbors]
+    else:
+        # all distances at once, then for every label the other labels sorted by distance and name
+        xs = np.array([x for x, y, label in labelCoords], dtype=np.float64)
+        ys = np.array([y for x, y, label in labelCoords], dtype=np.float64)
+        dists = np.sqrt((xs[np.newaxis, :]-xs[:, np.newaxis])**2 + (ys[np.newaxis, :]-ys[:, np.newaxis])**2)
+        np.fill_diagonal(dists, np.inf) # a label is not its own neighbor
+        nameRanks = np.empty(len(labels), dtype=np.int64)
+        nameRanks[sorted(range(len(labels)), key=labels.__getitem__)] = np.arange(len(labels))
+        neighbors = np.lexsort( (np.broadcast_to(nameRanks, dists.shape), dists) ).tolist()
+
+    isDone = [False]*len(labels)
+    currIdx = 0
+    isDone[currIdx] = True
+    labelOrder = [labels[currIdx]]
+    for i in range(1, len(labels)):
+        for neighIdx in neighbors[currIdx]:
+            if not isDone[neighIdx]:
                 break
+        currIdx = neighIdx
+        isDone[currIdx] = True
+        labelOrder.append(labels[currIdx])
 
     return labelOrder
 
+def exprClusterOrder(aggrJsonFname, labelField, labelVals):
+    """ return the labels ordered by the leaves of a hierarchical clustering (average linkage,
+    1-Pearson correlation) of the clusters' mean expression in clusterAggr.bin, or None if this is not
+    possible. Requires scipy. """
+    try:
+        import scipy.cluster.hierarchy, scipy.spatial.distance
+    except ImportError:
+        logging.warn("clusterOrderMethod=hierarchical requires scipy, which is not installed. Using clusterOrderMethod=nearest.")
+        return None
+
+    index = readJson(aggrJsonFname)
+    if index["field"]!=labelField:
+        logging.warn("clusterOrderMethod=hierarchical: clusterAggr.bin was built for the field %s, not for the labelField %s. "
+            "Using clusterOrderMethod=nearest." % (index["field"], labelField))
+        return None
+
+    clusterNames = index["clusters"]
+    statCount = len(index["stats"])
+    clusterCount = len(clusterNames)
+    aggrBinFname = join(dirname(aggrJsonFname), "clusterAggr.bin")
+    recs = np.fromfile(aggrBinFname, dtype="<f4").reshape( (-1, statCount, clusterCount) )
+    means = recs[:, index["stats"].index("mean"), :].T.astype(np.float64) # one row per cluster
+
+    if clusterCount < 3:
+        order = list(range(clusterCount))
+    else:
+        with np.errstate(invalid="ignore", divide="ignore"):
+            corrs = np.corrcoef(means)
+        corrs = np.nan_to_num(corrs) # clusters without expression are not correlated with any other
+        dists = np.clip(1.0 - corrs, 0, 2)
+        np.fill_diagonal(dists, 0)
+        condDists = scipy.spatial.distance.squareform(dists, checks=False)
+        tree = scipy.cluster.hierarchy.linkage(condDists, method="average")
+        order = scipy.cluster.hierarchy.leaves_list(tree).tolist()
+
+    labelOrder = [clusterNames[i] for i in order]
+    logging.info("Ordered %d clusters by hierarchical clustering of their mean expression" % len(labelOrder))
+    # labels that are not in clusterAggr.bin go to the end
+    doneLabels = set(labelOrder)
+    labelOrder.extend([label for label in labelVals if label not in doneLabels])
+    return labelOrder
+
+def getClusterOrder(inConf, outConf, labelVals, outDir):
+    """ return the cluster order that is the same for all layouts, depending on clusterOrderMethod in
+    cellbrowser.conf. Returns None for the default, 'nearest', which is calculated for every layout. """
+    method = inConf.get("clusterOrderMethod", "nearest")
+    if method not in clusterOrderMethods:
+        errAbort("clusterOrderMethod %s is not valid. Possible values are: %s" % (method, ", ".join(clusterOrderMethods)))
+
+    if method=="alpha":
+        return sorted(labelVals)
+
+    if method=="hierarchical":
+        if "clusterAggrIndex" not in outConf:
+            logging.warn("clusterOrderMethod=hierarchical requires clusterAggr=True. Using clusterOrderMethod=nearest.")
+            return None
+        return exprClusterOrder(join(outDir, outConf["clusterAggrIndex"]), inConf["labelField"], labelVals)
+
+    return None
+
 def metaHasChanged(datasetDir, metaOutFname):
     " return true if md5 of metaOutFname is different from the one in datasetDir/dataset.json:fileVersions -> outMeta -> md5"
     oldJsonFname = join(datasetDir, "dataset.json")
@@ -3593,8 +5840,12 @@ def convertDataset(inDir, inConf, outConf, datasetDir, redo):
     outMetaFname = join(datasetDir, "meta.tsv")
 
     # try not to recreate files that have been created before, as it is all quite slow (=Python)
-    doMatrix = matrixOrSamplesHaveChanged(datasetDir, inMatrixFname, outMatrixFname, outConf)
+    matrixOpts = getMatrixOpts(inConf)
+    doMatrix = matrixOrSamplesHaveChanged(datasetDir, inMatrixFname, outMatrixFname, outConf, matrixOpts)
     doMeta = metaHasChanged(datasetDir, outMetaFname)
+    if doMeta and not doMatrix and matrixOpts["clusterAggr"] is not None:
+        logging.info("Meta data has changed, have to reindex the expression matrix for clusterAggr.bin")
+        doMatrix = True
 
     geneToSym = -1 # None would mean "there are no gene symbols to map to"
 
@@ -3617,7 +5868,7 @@ def convertDataset(inDir, inConf, outConf, datasetDir, redo):
 
     if doMatrix or redo=='matrix':
         geneToSym = readGeneSymbols(inConf.get("geneIdType"), inMatrixFname)
-        convertExprMatrix(inConf, outMatrixFname, outConf, sampleNames, geneToSym, datasetDir, needFilterMatrix)
+        convertExprMatrix(inConf, outMatrixFname, outConf, sampleNames, geneToSym, datasetDir, needFilterMatrix, matrixOpts)
         # in case script crashes after this, keep the current state of the config
         writeConfig(inConf, outConf, datasetDir)
     else:
@@ -4182,7 +6433,7 @@ def resolveOutDir(outDir):
             outDir = confDirs[outDir]
     return outDir
 
-def build(confFnames, outDir, port=None, doDebug=False, devMode=False, redo=None):
+def build(confFnames, outDir, port=None, doDebug=False, devMode=False, redo=None, workers=None, tmpDir=None):
     " build browser from config files confFnames into directory outDir and serve on port "
     outDir = resolveOutDir(outDir)
 
@@ -4210,6 +6461,10 @@ def build(confFnames, outDir, port=None, doDebug=False, devMode=False, redo=None
 
         inConf = loadConfig(inConfFname)
         inDir = dirname(abspath(inConfFname))
+        if workers is not None:
+            inConf["workers"] = workers
+        if tmpDir is not None:
+            inConf["tmpDir"] = tmpDir
 
         # detect hierarchical mode and construct the output path
         dataRoot = findRoot(inConfFname)
@@ -4421,9 +6676,9 @@ def cbBuildCli():
         confFnames = glob.glob("*/cellbrowser.conf")
         for cf in confFnames:
             logging.info("Recursive mode: processing %s" % cf)
-            build(cf, outDir, redo=options.redo)
+            build(cf, outDir, redo=options.redo, workers=options.workers, tmpDir=options.tmpDir)
     else:
-        build(confFnames, outDir, port, redo=options.redo)
+        build(confFnames, outDir, port, redo=options.redo, workers=options.workers, tmpDir=options.tmpDir)
 
 def readMatrixAnndata(matrixFname, samplesOnRows=False, genome="hg38"):
     " read an expression matrix and return an adata object. Supports .mtx, .h5 and .tsv (not .tsv.gz) "
@@ -5594,34 +7849,207 @@ def readGenesBarcodes(geneFname, barcodeFname):
     barcodes = [l.strip() for l in openFile(barcodeFname) if l!="\n"]
     return genes, barcodes
 
-def open10xMtxForRows(mtxFname, geneFname, barcodeFname):
+def readMtxHeader(ifh):
+    """ read the header of a Matrix Market file and return rowCount, colCount, entryCount and the
+    format line, e.g. ['%%MatrixMarket', 'matrix', 'coordinate', 'integer', 'general'] """
+    formatLine = ifh.readline().strip().split()
+    line = ifh.readline()
+    while line.startswith("%"):
+        line = ifh.readline()
+    rowCount, colCount, entryCount = [int(x) for x in line.split()]
+    return rowCount, colCount, entryCount, [x.lower() for x in formatLine]
+
+def openMtx(mtxFname):
+    " open a .mtx or .mtx.gz file for reading, with gunzip if possible, as it is faster and uses a second CPU "
+    if mtxFname.endswith(".gz") and which("gunzip")!=None:
+        proc, ifh = popen(["gunzip", "-c", mtxFname], doWait=False)
+        return ifh
+    return openFile(mtxFname)
+
+def iterMtxChunks(mtxFname, chunkSize):
+    """ yield (rows, cols, vals) numpy arrays with about chunkSize entries of a Matrix Market file,
+    rows and cols are 0-based """
+    ifh = openMtx(mtxFname)
+    rowCount, colCount, entryCount, mtxFormat = readMtxHeader(ifh)
+    isPattern = (mtxFormat[3]=="pattern")
+    if isPattern:
+        fieldCount = 2
+    else:
+        fieldCount = 3
+
+    rest = ""
+    while True:
+        text = ifh.read(chunkSize*16) # an entry is rarely shorter than 16 bytes
+        if len(text)==0:
+            break
+        text = rest+text
+        lastNl = text.rfind("\n")
+        rest = text[lastNl+1:]
+        text = text[:lastNl+1]
+        if len(text)==0:
+            continue
+        arr = textToArray(text, np.float64).reshape( (-1, fieldCount) )
+        rows = arr[:, 0].astype(np.int64)-1
+        cols = arr[:, 1].astype(np.int64)-1
+        if isPattern:
+            vals = np.ones(len(arr))
+        else:
+            vals = arr[:, 2]
+        yield rows, cols, vals
+
+    if rest.strip()!="":
+        errAbort("%s: last line has no newline at the end of the file" % mtxFname)
+    ifh.close()
+
+def mtxToCsr(mtxFname, geneCount, cellCount, transpose, chunkSize, outDir=None, tmpDir=None):
+    """ convert a Matrix Market file to a CSR matrix with genes on rows in two passes,
+    reading only chunkSize entries at a time. The indptr/indices/data arrays are memory-mapped
+    temporary files in a new directory under tmpDir, so the matrix does not have to fit into memory.
+    If outDir is set, they are kept there as indptr.npy, indices.npy and data.npy. """
+    import scipy.sparse, tempfile
+
+    ifh = openMtx(mtxFname)
+    rowCount, colCount, entryCount, mtxFormat = readMtxHeader(ifh)
+    ifh.close()
+
+    if mtxFormat[3]=="integer":
+        dataType = np.int64 # same types as scipy.io.mmread
+    else:
+        dataType = np.float64
+    if entryCount < 2**31:
+        idxType = np.int32
+    else:
+        idxType = np.int64
+
+    if outDir is None:
+        arrDir = tempfile.mkdtemp(prefix="cbMtx", dir=tmpDir)
+    else:
+        arrDir = outDir
+    logging.info("Reading %s in chunks of %d entries, this needs around %d MB of memory. "
+        "The %d entries are written to memory-mapped files in %s (%d MB)" % \
+        (mtxFname, chunkSize, (min(chunkSize, entryCount)*150)/(1024*1024), entryCount, arrDir,
+        (entryCount*(np.dtype(idxType).itemsize+np.dtype(dataType).itemsize))/(1024*1024)))
+
+    # pass 1: count the entries per gene to get the row start offsets
+    counts = np.zeros(geneCount, dtype=np.int64)
+    for rows, cols, vals in iterMtxChunks(mtxFname, chunkSize):
+        if transpose:
+            rows = cols
+        counts += np.bincount(rows, minlength=geneCount)
+
+    if counts.sum()!=entryCount:
+        errAbort("%s: header says there are %d entries, but found %d" % (mtxFname, entryCount, counts.sum()))
+
+    indptr = np.zeros(geneCount+1, dtype=idxType)
+    np.cumsum(counts, out=indptr[1:])
+
+    # pass 2: copy every entry to the next free position of its gene
+    indices = np.lib.format.open_memmap(join(arrDir, "indices.npy"), dtype=idxType, mode="w+", shape=(entryCount,))
+    data = np.lib.format.open_memmap(join(arrDir, "data.npy"), dtype=dataType, mode="w+", shape=(entryCount,))
+    nextPos = indptr[:-1].astype(np.int64)
+    for rows, cols, vals in iterMtxChunks(mtxFname, chunkSize):
+        if transpose:
+            rows, cols = cols, rows
+        order = np.argsort(rows, kind="stable")
+        rows = rows[order]
+        chunkCounts = np.bincount(rows, minlength=geneCount)
+        groupStarts = np.cumsum(chunkCounts)-chunkCounts
+        pos = nextPos[rows] + (np.arange(len(rows)) - groupStarts[rows])
+        indices[pos] = cols[order]
+        data[pos] = vals[order]
+        nextPos += chunkCounts
+
+    mat = scipy.sparse.csr_matrix((data, indices, indptr), shape=(geneCount, cellCount), copy=False)
+    mat.sum_duplicates()
+
+    if outDir is None:
+        # the data stays accessible as long as it is mapped, so we can clean up already
+        try:
+            os.remove(join(arrDir, "indices.npy"))
+            os.remove(join(arrDir, "data.npy"))
+            os.rmdir(arrDir)
+        except OSError:
+            logging.debug("Could not remove %s" % arrDir)
+    else:
+        indices.flush()
+        data.flush()
+        del indices, data
+        np.save(join(outDir, "indptr.npy"), mat.indptr)
+        # if there were duplicates, the arrays are shorter now, they are new arrays or views of the
+        # memory-mapped ones. Write them to other files and move these over the old ones, the
+        # old ones stay mapped until mat is not used anymore.
+        if mat.nnz!=entryCount:
+            for name, arr in [("indices", mat.indices), ("data", mat.data)]:
+                tmpFname = join(outDir, name+".tmp.npy")
+                np.save(tmpFname, arr)
+                os.rename(tmpFname, join(outDir, name+".npy"))
+    return mat
+
+def open10xMtxForRows(mtxFname, geneFname, barcodeFname, chunkSize=None, tmpDir=None):
     """ open the three files required for 10x matrices and return mat, genes, barcodes
     also convert the csc matrix to a csr matrix so row access is fast.
+    With numpy, the matrix is converted in chunks of chunkSize entries (default 5 million) into a
+    memory-mapped CSR matrix, with temporary files under tmpDir, otherwise it is loaded completely with scipy.
     """
     import scipy.io
 
     genes, barcodes = readGenesBarcodes(geneFname, barcodeFname)
-    logging.info("Loading expression matrix from %s..." % mtxFname)
-    mat = scipy.io.mmread(mtxFname)
 
-    logging.info("Dimensions of matrix: %d , %d" % mat.shape)
+    ifh = openMtx(mtxFname)
+    rowCount, colCount, entryCount, mtxFormat = readMtxHeader(ifh)
+    ifh.close()
+
+    logging.info("Dimensions of matrix: %d , %d" % (rowCount, colCount))
     #geneCount, cellCount = mat.shape
 
-    if mat.shape[0]==len(genes)-1:
+    if rowCount==len(genes)-1:
         genes = genes[1:]
         logging.info("The genes file seems to have a GEO-like header, removed the first gene, genecount is now %d" % len(genes))
 
-    if mat.shape[1]==len(barcodes)-1:
+    if colCount==len(barcodes)-1:
         barcodes = barcodes[1:]
         logging.info("The barcodes file seems to have a GEO-like header, removed the first barcode, count is now %d" % len(barcodes))
 
-    if mat.shape[0]==len(barcodes):
+    transpose = False
+    if rowCount==len(barcodes):
         logging.info("Matrix looks like it's in transposed format (genes on columns), so transposing matrix now")
-        mat = mat.transpose()
-        logging.info("New dimensions of matrix: %d , %d" % mat.shape)
-
-    logging.info("Converting matrix to row-based layout...")
-    mat = mat.tocsr()
+        transpose = True
+        rowCount, colCount = colCount, rowCount
+        logging.info("New dimensions of matrix: %d , %d" % (rowCount, colCount))
+
+    if numpyLoaded and mtxFormat[2] == "coordinate" and mtxFormat[3] in ["integer", "real", "pattern"] \
+            and mtxFormat[4]=="general":
+        if chunkSize is None:
+            chunkSize = 5000000
+
+        mat = None
+        cache = getMatrixCache()
+        if cache is not None:
+            entryDir, info = cache.find(mtxFname, "csr")
+            if entryDir is not None and info["shape"]==[rowCount, colCount] and info["transpose"]==transpose:
+                import scipy.sparse
+                arrs = [np.load(join(entryDir, name+".npy"), mmap_mode="c") for name in ["data", "indices", "indptr"]]
+                mat = scipy.sparse.csr_matrix(tuple(arrs), shape=(rowCount, colCount), copy=False)
+
+        if mat is None:
+            if cache is None:
+                mat = mtxToCsr(mtxFname, rowCount, colCount, transpose, chunkSize, tmpDir=tmpDir)
+            else:
+                newDir = cache.newEntry()
+                mat = mtxToCsr(mtxFname, rowCount, colCount, transpose, chunkSize, outDir=newDir)
+                if str(mat.dtype).startswith("int"):
+                    matType = "int"
+                else:
+                    matType = "float"
+                info = {"matType":matType, "shape":[rowCount, colCount], "transpose":transpose}
+                cache.addEntry(newDir, mtxFname, "csr", info)
+    else:
+        logging.info("Loading expression matrix from %s..." % mtxFname)
+        mat = scipy.io.mmread(mtxFname)
+        if transpose:
+            mat = mat.transpose()
+        logging.info("Converting matrix to row-based layout...")
+        mat = mat.tocsr()
 
     #print(mat.shape[0])
     #print(len(genes))
@@ -5657,17 +8085,14 @@ def mtxToTsvGz(mtxFname, geneFname, barcodeFname, outFname, translateIds=False):
     ofh.write("\t".join(barcodes))
     ofh.write("\n")
 
-    for i in range(0, len(genes)):
-        if i%1000==0:
-            logging.info("%d genes written..." % i)
-        ofh.write(genes[i])
-        ofh.write("\t")
-        arr = mat[i].toarray()
-        fmt = "%d"
-        if arr.dtype==np.int64:
-            np.savetxt(ofh, arr, "%d", "\t", "\n")
-        else:
-            np.savetxt(ofh, arr, "%g", "\t", "\n")
+    # convert blocks of rows of around 10 million values to dense arrays and write them
+    blockSize = max(1, min(1000, 10000000 // max(1, len(barcodes))))
+    for start in range(0, len(genes), blockSize):
+        logging.info("%d genes written..." % start)
+        arr = mat[start:start+blockSize].toarray()
+        if arr.dtype.kind=="f":
+            arr = arr.astype(np.float32) # same precision as cbBuild
+        writeMatrixRows(ofh, genes[start:start+blockSize], arr)
     ofh.close()
 
     moveOrGzip(tmpFname, outFname)
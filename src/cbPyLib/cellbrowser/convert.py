@@ -1,30 +1,37 @@
 # various format converters for single cell data:
 # - cellranger, mtx to tsv, matcat, metaCat etc
 
-import logging, optparse, io, sys, os, shutil, operator, glob, re, json
+import logging, optparse, io, sys, os, shutil, operator, glob, re, json, random, time
 from collections import defaultdict
 
 from .cellbrowser import runGzip, openFile, errAbort, setDebug, moveOrGzip, makeDir, iterItems
 from .cellbrowser import mtxToTsvGz, writeCellbrowserConf, getAllFields, readMatrixAnndata
 from .cellbrowser import anndataMatrixToTsv, loadConfig, sanitizeName, lineFileNextRow, scanpyToCellbrowser, build
 from .cellbrowser import generateHtmls, getObsKeys
+from .cellbrowser import isMtx, MatrixMtxReader, MatrixTsvReader, exprCodecNames, checkExprCodec, exprEncodeBatch, decompressRecord
+from .cellbrowser import exprFilterNames
 
 from os.path import join, basename, dirname, isfile, isdir, relpath, abspath, getsize, getmtime, expanduser
 
 def cbToolCli_parseArgs(showHelp=False):
     " setup logging, parse command line arguments and options. -h shows auto-generated help page "
-    parser = optparse.OptionParser("""usage: %prog [options] mtx2tsv|matCat|metaCat - convert various single-cell related files
+    parser = optparse.OptionParser("""usage: %prog [options] mtx2tsv|matCat|metaCat|codecBench - convert various single-cell related files
 
     mtx2tsv   - convert matrix market to .tsv.gz
     matCat - merge expression matrices with one line per gene into a big matrix.
         Matrices must have identical genes in the same order and the same number of
         lines. Handles .csv files, otherwise defaults to tab-sep input. gzip OK.
     metaCat - concat/join meta tables on the first (cell ID) field
+    codecBench - compress a random sample of genes from an expression matrix with all
+        possible values of the cellbrowser.conf settings matrixCodec and matrixFilter and show
+        the compression ratio and speed. Default number of genes is 300. The decompression
+        time is for Python's zlib and lz4 modules, not for the decoders of the web browser.
 
     Examples:
     - %prog mtx2tsv matrix.mtx genes.tsv barcodes.tsv exprMatrix.tsv.gz - convert .mtx to .tsv.gz file
     - %prog matCat mat1.tsv.gz mat2.tsv.gz exprMatrix.tsv.gz - concatenate expression matrices
     - %prog metaCat meta.tsv seurat/meta.tsv scanpy/meta.tsv newMeta.tsv - merge meta matrices
+    - %prog codecBench exprMatrix.tsv.gz 1000 - compare codecs on 1000 genes
     """)
 
     parser.add_option("-d", "--debug", dest="debug", action="store_true",
@@ -56,7 +63,7 @@ def cbToolCli():
 
     cmd = args[0]
 
-    cmds = ["mtx2tsv", "matCat", "metaCat"]
+    cmds = ["mtx2tsv", "matCat", "metaCat", "codecBench"]
 
     if cmd=="mtx2tsv":
         mtxFname = args[1]
@@ -85,9 +92,75 @@ def cbToolCli():
             inFnames.pop()
 
         metaCat(inFnames, outFname, options)
+    elif cmd=="codecBench":
+        geneCount = 300
+        if len(args)>2:
+            geneCount = int(args[2])
+        codecBench(args[1], geneCount)
     else:
         errAbort("Command %s is not a valid command. Valid commands are: %s" % (cmd, ", ".join(cmds)))
 
+def sampleMatrixRows(matrixFname, geneCount):
+    " return the matrix type and a random sample of geneCount rows of a matrix, in the format of exprEncodeBatch "
+    import numpy as np
+    if isMtx(matrixFname):
+        matReader = MatrixMtxReader()
+        matReader.open(matrixFname)
+        rowIter = matReader.iterRowsSparse()
+    else:
+        matReader = MatrixTsvReader()
+        matReader.open(matrixFname)
+        rowIter = matReader.iterRows()
+
+    # reservoir sampling: every row has the same chance to end up in the sample
+    rand = random.Random(1)
+    rows = []
+    for i, (geneId, sym, exprArr) in enumerate(rowIter):
+        if i < geneCount:
+            j = i
+            rows.append(None)
+        else:
+            j = rand.randint(0, i)
+            if j >= geneCount:
+                continue
+        # the readers return views into large blocks of the matrix: keep copies, so the blocks can be freed
+        if type(exprArr)==tuple:
+            cellIdx, vals, cellCount = exprArr
+            rows[j] = (geneId, sym, (np.array(cellIdx), np.array(vals), cellCount))
+        else:
+            rows[j] = (geneId, sym, np.array(exprArr))
+    matReader.close()
+    return matReader.getMatType(), rows
+
+def codecBench(matrixFname, geneCount):
+    " compress a sample of genes from a matrix with all codecs for exprMatrix.bin and print a table with the results "
+    matType, rows = sampleMatrixRows(matrixFname, geneCount)
+    logging.info("Compressing %d genes" % len(rows))
+
+    rawSize = None
+    print("\t".join(["codec", "filter", "size", "ratio", "compressMB/sec", "pyDecompressMsec/gene"]))
+    for codec in exprCodecNames:
+        if checkExprCodec(codec)!=codec:
+            continue
+
+        for exprFilter in exprFilterNames:
+            startTime = time.time()
+            encRows = exprEncodeBatch( (rows, {"matType" : matType, "sparseCutoff" : 0.3, "matrixCodec" : codec, "matrixFilter" : exprFilter}) )
+            encTime = time.time() - startTime
+
+            startTime = time.time()
+            recSize = 0
+            for sym, rec, minVal, discretRec, aggrRec in encRows:
+                recSize += len(decompressRecord(rec, codec))
+            decTime = time.time() - startTime
+
+            comprSize = sum([len(rec) for sym, rec, minVal, discretRec, aggrRec in encRows])
+            if rawSize is None:
+                rawSize = recSize
+
+            print("%s\t%s\t%d\t%.2f\t%.1f\t%.3f" % (codec, exprFilter, comprSize, float(rawSize)/comprSize,
+                rawSize/(1024*1024*max(encTime, 0.000001)), 1000*decTime/len(encRows)))
+
 def matCat(inFnames, outFname):
     tmpFname = outFname+".tmp"
     ofh = openFile(tmpFname, "w")
@@ -648,6 +648,62 @@ def writeCatFile(clusterToCells, catFname):
             ofh.write("%s\t%s\n" % (cellId, clusterName))
     ofh.close()
 
+def clusterStats(exprArr, clusterCellIds):
+    """ return the medians of the clusters as strings and the number of non-zero values of the last
+    cluster, for one row """
+    medianList = []
+    for cellIds in clusterCellIds:
+        exprList = []
+        for cellId in cellIds:
+            exprList.append(exprArr[cellId])
+        n = len(cellIds)
+        if len(exprList)==0:
+            median = 0
+        else:
+            median = sorted(exprList)[n//2] # approx OK, no special case for even n's
+        medianList.append(str(median))
+        bedScore = len([x for x in exprList if x!=0]) # score = non-zero medians
+    return medianList, bedScore
+
+def iterRowsWithText(mr, cellIndices, clusterCellIds):
+    """ yield (geneId, line, medianList, bedScore) for all rows of the MatrixTsvReader mr. line
+    contains only the values of cellIndices, tab-separated. medianList and bedScore are from
+    clusterStats. With numpy, blocks of rows are formatted at once and the medians and non-zero
+    counts are taken with cellbrowser.clusterAggregate, like for clusterAggr.bin. """
+    if not cellbrowser.numpyLoaded:
+        for geneId, sym, exprArr in mr.iterRows():
+            medianList, bedScore = clusterStats(exprArr, clusterCellIds)
+            yield geneId, "\t".join([str(exprArr[idx]) for idx in cellIndices]), medianList, bedScore
+        return
+
+    import numpy as np
+    cellIndices = np.array(cellIndices, dtype=np.intp)
+    isEmpty = [len(cellIds)==0 for cellIds in clusterCellIds]
+    blockSize = max(1, min(1000, 10000000 // max(1, len(mr.sampleNames))))
+
+    def iterBlock(block):
+        mat = np.array([exprArr for geneId, exprArr in block])
+        lines = cellbrowser.formatMatrixRows(mat[:, cellIndices])
+        aggr = cellbrowser.clusterAggregate(mat, clusterCellIds, withDeciles=False)
+        medians = aggr["median"]
+        bedScores = aggr["nonZero"][:, -1]
+        for i, (geneId, exprArr) in enumerate(block):
+            # like clusterStats, the median of an empty cluster is the integer 0
+            medianList = ["0" if isEmpty[j] else str(x) for j, x in enumerate(medians[i])]
+            yield geneId, lines[i], medianList, int(bedScores[i])
+
+    block = []
+    for geneId, sym, exprArr in mr.iterRows():
+        block.append( (geneId, exprArr) )
+        if len(block)==blockSize:
+            for row in iterBlock(block):
+                yield row
+            block = []
+
+    if len(block)!=0:
+        for row in iterBlock(block):
+            yield row
+
 def makeBarGraphBigBed(genome, inMatrixFname, outMatrixFname, geneType, clusterToCells, \
         clusterOrder, clusterFname, bbFname):
     """ create a barGraph bigBed file for an expression matrix
@@ -727,36 +783,18 @@ def makeBarGraphBigBed(genome, inMatrixFname, outMatrixFname, geneType, clusterT
     bedFh = open(bedFname, "w")
 
     skipCount = 0
-    for geneId, sym, exprArr in mr.iterRows():
+    for geneId, newLine, medianList, bedScore in iterRowsWithText(mr, allCellIndices, clusterCellIds):
         logging.debug("Writing BED and matrix line for %s" % geneId)
 
         # write the new matrix row
         offset = matOfh.tell()
         rowHeader = "%s\t" % (geneId)
         matOfh.write(rowHeader)
-
-        newRow = []
-        for idx in allCellIndices:
-            newRow.append(str(exprArr[idx]))
-        newLine = "\t".join(newRow)
         matOfh.write(newLine)
         matOfh.write("\n")
         lineLen = len(geneId)+len(newLine)+2 # include tab and newline
 
-        medianList = []
-
-        for cellIds in clusterCellIds:
-            exprList = []
-            for cellId in cellIds:
-                exprList.append(exprArr[cellId])
-            n = len(cellIds)
-            if len(exprList)==0:
-                median = 0
-            else:
-                median = sorted(exprList)[n//2] # approx OK, no special case for even n's
-            medianList.append(str(median))
-            bedScore = len([x for x in exprList if x!=0]) # score = non-zero medians
-            bedScore = min(1000, bedScore)
+        bedScore = min(1000, bedScore)
 
         if geneId not in geneLocs:
             geneId2 = geneId.replace(".", "-", 1) # does this make sense? (for R)